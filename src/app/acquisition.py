@@ -0,0 +1,196 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import serial
+
+from qm1592 import FrameDecoder
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# A decoded frame, the time it was read in nanoseconds since the epoch, and
+# the source given to the reader that read it
+Sample = namedtuple("Sample", ["timestamp_ns", "frame", "source"])
+
+
+# Wall clock derived from time.monotonic_ns()
+#
+# Timestamps are anchored to the wall clock once and then advance with the
+# monotonic clock, so they are evenly spaced no matter how busy the process
+# is.  If the wall clock is stepped (e.g. NTP syncing after boot at a track
+# with no network until now) the anchor is moved to follow it.
+#
+# now_ns() is called from the reader, consumer and monitor threads.  The
+# anchor is one tuple replaced whole, so a thread never reads the wall time
+# of one anchor with the monotonic time of another.
+class SampleClock:
+    def __init__(self, max_drift_ms=500, check_interval=60):
+        self.max_drift_ns = max_drift_ms * 1_000_000
+        self.check_interval_ns = check_interval * 1_000_000_000
+        self.anchor()
+
+    def anchor(self):
+        mono_ns = time.monotonic_ns()
+        self._anchor = (time.time_ns(), mono_ns)
+        self._next_check_ns = mono_ns + self.check_interval_ns
+
+    def now_ns(self):
+        mono_ns = time.monotonic_ns()
+        wall_ns, anchor_mono_ns = self._anchor
+        if mono_ns >= self._next_check_ns:
+            self._next_check_ns = mono_ns + self.check_interval_ns
+            drift_ns = time.time_ns() - (wall_ns + mono_ns - anchor_mono_ns)
+            if abs(drift_ns) > self.max_drift_ns:
+                logger.warning("Wall clock stepped by %.3f s", drift_ns / 1e9)
+                self.anchor()
+                wall_ns, anchor_mono_ns = self._anchor
+        return wall_ns + mono_ns - anchor_mono_ns
+
+
+# Serial reader thread
+#
+# Does nothing but read the meter, decode frames and stamp them, so slow
+# sinks downstream cannot delay reads or skew timestamps.  Frames are handed
+# to the consumer through a bounded queue; if the consumer falls so far
+# behind that the queue fills, new frames are dropped and counted as
+# overruns rather than blocking the serial port.
+#
+# Several readers can share one samples queue, each stamping its samples
+# with its own source (e.g. the meter it reads) so one consumer can handle
+# every meter.
+#
+# The port is opened, and reopened after an error, with exponential backoff
+# from retry_delay up to max_retry_delay seconds between attempts.
+#
+# For replaying a capture, open_serial returns the port to read instead of
+# opening the device, block makes the reader wait for the consumer instead
+# of dropping frames, and the reader finishes when the port raises EOFError.
+class SerialReader(threading.Thread):
+    def __init__(
+        self,
+        device,
+        baudrate=9600,
+        queue_size=1024,
+        clock=None,
+        open_serial=None,
+        block=False,
+        source=None,
+        samples=None,
+        retry_delay=1.0,
+        max_retry_delay=30.0,
+    ):
+        super().__init__(name=f"serial-reader {device}", daemon=True)
+        self.device = device
+        self.baudrate = baudrate
+        self.clock = clock or SampleClock()
+        self.open_serial = open_serial
+        self.block = block
+        self.source = source
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.finished = False
+        self.decoder = FrameDecoder()
+        if samples is None:
+            samples = queue.Queue(maxsize=queue_size)
+        self.samples = samples
+        self._stopping = threading.Event()
+
+        # Counters
+        self.frames_read = 0
+        self.overruns = 0
+        self.reconnects = 0
+
+    def stop(self):
+        self._stopping.set()
+
+    # Next sample for the consumer, or None if nothing arrived in time
+    def get(self, timeout=1):
+        try:
+            return self.samples.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def run(self):
+        raise_thread_priority()
+        source = self.source
+        ser = self._open()
+        if ser is None:
+            return
+        try:
+            while not self._stopping.is_set():
+                # Read everything the meter has sent, or wait for at least one byte
+                try:
+                    data = ser.read(ser.in_waiting or 1)
+                except serial.SerialException:
+                    logger.error("Serial communication error on %s", self.device)
+                    ser.close()
+                    ser = self._reopen()
+                    if ser is None:
+                        return
+                    continue
+                except EOFError:
+                    logger.info("End of serial input")
+                    self.finished = True
+                    break
+                if not data:
+                    continue
+                timestamp_ns = self.clock.now_ns()
+                for frame in self.decoder.feed(data):
+                    self._put(Sample(timestamp_ns, frame, source))
+        finally:
+            if ser is not None:
+                ser.close()
+
+    def _put(self, sample):
+        self.frames_read += 1
+        if self.block:
+            self.samples.put(sample)
+            return
+        try:
+            self.samples.put_nowait(sample)
+        except queue.Full:
+            self.overruns += 1
+            if self.overruns == 1 or self.overruns % 100 == 0:
+                logger.warning(
+                    "Sample queue full, %d frames dropped so far", self.overruns
+                )
+
+    # Open the port, or return None if stopped before it could be opened
+    def _open(self):
+        if self.open_serial:
+            return self.open_serial()
+        delay = self.retry_delay
+        while not self._stopping.is_set():
+            try:
+                return serial.Serial(self.device, self.baudrate, timeout=1)
+            except serial.SerialException:
+                logger.error(
+                    "Unable to open %s, retrying in %.0f s", self.device, delay
+                )
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        return None
+
+    # loop until serial communication is restored
+    def _reopen(self):
+        ser = self._open()
+        if ser is None:
+            return None
+        self.reconnects += 1
+        logger.info("Serial communication restored on %s", self.device)
+        # Drop the partial frame from before the error
+        self.decoder.reset()
+        return ser
+
+
+# Ask the scheduler to favour the calling thread.  Lowering niceness needs
+# CAP_SYS_NICE, so this quietly does nothing when not permitted.
+def raise_thread_priority(niceness=-10):
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        logger.debug("Unable to raise priority of %s", threading.current_thread().name)
@@ -0,0 +1,63 @@
+import math
+from array import array
+from collections import namedtuple
+
+from qm1592 import merge_flags
+from rolling_stats import ENERGY, ENERGY_SCALE, MAX_DECI_DB
+
+# Levels over one interval: start time in ns since the epoch, Leq, Lmax and
+# Lmin in dB, the number of samples they were computed from and the meter
+# flags over the interval (see qm1592.merge_flags)
+IntervalLevels = namedtuple(
+    "IntervalLevels", ["timestamp_ns", "leq", "lmax", "lmin", "count", "flags"]
+)
+
+
+# Summarise a sequence of levels in tenths of a dB.  Each statistic is one
+# pass in C over the whole array (the energy sum through the precomputed
+# energy table), rather than Python work per sample.
+def summarise(timestamp_ns, deci_dbs, flags=0):
+    count = len(deci_dbs)
+    energy = sum(map(ENERGY.__getitem__, deci_dbs))
+    return IntervalLevels(
+        timestamp_ns,
+        round(10 * math.log10(energy / (count * ENERGY_SCALE)), 1),
+        max(deci_dbs) / 10,
+        min(deci_dbs) / 10,
+        count,
+        flags,
+    )
+
+
+# Aggregate every decoded level into fixed intervals
+#
+# Intervals are aligned to multiples of the interval since the epoch, so a
+# given interval always has the same timestamp.  add() returns the levels
+# for the previous interval when a sample arrives in a new one, else None.
+# The meter flags of each sample are merged into the interval's flags.
+class IntervalAggregator:
+    def __init__(self, interval_ms):
+        self.interval_ns = interval_ms * 1_000_000
+        self._start_ns = None
+        self._levels = array("H")
+        self._flags = 0
+
+    def add(self, timestamp_ns, dB, flags=0):
+        start_ns = timestamp_ns - timestamp_ns % self.interval_ns
+        completed = None
+        if start_ns != self._start_ns:
+            completed = self.flush()
+            self._start_ns = start_ns
+            self._flags = flags
+        elif flags != self._flags:
+            self._flags = merge_flags(self._flags, flags)
+        self._levels.append(min(max(round(dB * 10), 0), MAX_DECI_DB))
+        return completed
+
+    # Levels for the interval in progress, which is then discarded
+    def flush(self):
+        if not self._levels:
+            return None
+        completed = summarise(self._start_ns, self._levels, self._flags)
+        self._levels = array("H")
+        return completed
@@ -0,0 +1,315 @@
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque, namedtuple
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# An alert: a unique id for deduplication, a coalescing key (alerts with
+# the same key are grouped into bursts, None means never coalesce), the
+# message and an optional title
+Alert = namedtuple("Alert", ["id", "key", "message", "title"])
+
+
+# --------------------- Logger side ---------------------
+
+
+# Sends alerts from the logger to the alert sender over a Unix socket
+#
+# send() never blocks: alerts are queued and a background thread delivers
+# them one at a time, waiting for the sender to acknowledge each one.  An
+# alert that is not acknowledged (sender not running, connection lost) is
+# sent again after reconnecting, so delivery is at least once; the sender
+# drops repeats by id.  The alert being delivered is held apart from the
+# queue, and if the queue fills the newest alert is dropped and counted.
+class AlertClient:
+    def __init__(self, socket_path, queue_size=1000, ack_timeout=30.0):
+        self.socket_path = socket_path
+        self.ack_timeout = ack_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._in_flight = None
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="alert-client", daemon=True
+        )
+
+        # Counters
+        self.alerts_sent = 0
+        self.alerts_dropped = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def send(self, message, key=None, title=None):
+        try:
+            self._queue.put_nowait(Alert(uuid.uuid4().hex, key, message, title))
+        except queue.Full:
+            self.alerts_dropped += 1
+            logger.warning("Alert queue full, dropping: %s", message)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + (self._in_flight is not None)
+
+    # Give queued alerts a chance to go out before the process exits
+    def close(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while self.queue_depth and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self._stopping.set()
+
+    def _run(self):
+        conn = None
+        reader = None
+        alert = None
+        while not self._stopping.is_set():
+            if alert is None:
+                try:
+                    alert = self._queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self._in_flight = alert
+            try:
+                if conn is None:
+                    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    conn.settimeout(self.ack_timeout)
+                    conn.connect(self.socket_path)
+                    reader = conn.makefile("r")
+                conn.sendall((json.dumps(alert._asdict()) + "\n").encode())
+                while True:
+                    line = reader.readline()
+                    if not line:
+                        raise ConnectionError("Alert sender closed the connection")
+                    if json.loads(line).get("ack") == alert.id:
+                        break
+            except (OSError, ValueError) as e:
+                logger.debug("Alert not delivered, will retry: %s", e)
+                if conn is not None:
+                    conn.close()
+                conn = None
+                self._stopping.wait(1)
+                continue
+            self._in_flight = None
+            alert = None
+            self.alerts_sent += 1
+        if conn is not None:
+            conn.close()
+
+
+# --------------------- Sender side ---------------------
+
+
+# Delivers alerts through a send function, e.g. to Pushover
+#
+# The first alert for a key is sent straight away.  Further alerts with the
+# same key within coalesce_window seconds are held back, and when the
+# window ends one summary is sent with the latest message and how many were
+# held back.  Failed sends are retried with backoff.  Each submitted alert
+# is acknowledged through its callback only once it has been sent or
+# folded into a burst, and alerts already seen are acknowledged without
+# being sent again.
+class AlertDispatcher:
+    def __init__(self, send, coalesce_window=30.0, max_backoff=60.0, history=1000):
+        self.send = send
+        self.coalesce_window = coalesce_window
+        self.max_backoff = max_backoff
+        self.history = history
+
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="alert-dispatcher", daemon=True
+        )
+
+        # Ids already delivered, and callbacks for alerts waiting to be sent
+        self._delivered = OrderedDict()
+        self._waiting = {}
+        # Open bursts by key: [window end, alerts held back, latest alert]
+        self._bursts = {}
+        # Alerts (or summaries) that failed to send
+        self._retry = deque()
+        self._backoff = 1.0
+        self._next_retry = 0.0
+
+        # Counters
+        self.alerts_received = 0
+        self.alerts_sent = 0
+        self.alerts_coalesced = 0
+        self.duplicates = 0
+        self.send_failures = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopping.set()
+        self._queue.put(None)
+        self._thread.join(5)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._retry)
+
+    # Accept an alert from any thread; callback() runs once it is handled
+    def submit(self, alert, callback=None):
+        self._queue.put((alert, callback))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                item = self._queue.get(timeout=self._next_timeout())
+            except queue.Empty:
+                item = None
+            if item is not None:
+                self._handle(*item)
+            now = time.monotonic()
+            if self._retry and now >= self._next_retry:
+                self._send_retries()
+            self._close_bursts(now)
+
+    def _next_timeout(self):
+        deadlines = [burst[0] for burst in self._bursts.values()]
+        if self._retry:
+            deadlines.append(self._next_retry)
+        if not deadlines:
+            return 1.0
+        return min(max(min(deadlines) - time.monotonic(), 0.0), 1.0)
+
+    def _handle(self, alert, callback):
+        self.alerts_received += 1
+        if alert.id in self._delivered:
+            self.duplicates += 1
+            if callback:
+                callback()
+            return
+        if alert.id in self._waiting:
+            # Resent while still waiting to go out: acknowledge both together
+            self.duplicates += 1
+            self._waiting[alert.id].append(callback)
+            return
+        self._waiting[alert.id] = [callback]
+
+        burst = self._bursts.get(alert.key) if alert.key is not None else None
+        if burst is not None:
+            burst[1] += 1
+            burst[2] = alert
+            self.alerts_coalesced += 1
+            self._done(alert.id)
+            return
+        if alert.key is not None:
+            self._bursts[alert.key] = [time.monotonic() + self.coalesce_window, 0, None]
+        if self._retry or not self._deliver(alert.message, alert.title):
+            self._retry.append(alert)
+            return
+        self._done(alert.id)
+
+    # Send a summary for each burst whose window has ended
+    def _close_bursts(self, now):
+        for key, burst in list(self._bursts.items()):
+            if now < burst[0]:
+                continue
+            held, latest = burst[1], burst[2]
+            if not held:
+                del self._bursts[key]
+                continue
+            # Start a new window so a burst that carries on stays coalesced
+            self._bursts[key] = [now + self.coalesce_window, 0, None]
+            message = (
+                f"{latest.message} (+{held} more in {self.coalesce_window:g} s)"
+            )
+            summary = latest._replace(id=None, message=message)
+            if self._retry or not self._deliver(summary.message, summary.title):
+                self._retry.append(summary)
+
+    def _send_retries(self):
+        while self._retry:
+            alert = self._retry[0]
+            if not self._deliver(alert.message, alert.title):
+                return
+            self._retry.popleft()
+            if alert.id is not None:
+                self._done(alert.id)
+
+    def _deliver(self, message, title):
+        try:
+            self.send(message, title)
+        except Exception as e:
+            self.send_failures += 1
+            self._next_retry = time.monotonic() + self._backoff
+            logger.error("Error sending alert, retrying in %.0f s: %s", self._backoff, e)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            return False
+        self.alerts_sent += 1
+        self._backoff = 1.0
+        return True
+
+    def _done(self, alert_id):
+        for callback in self._waiting.pop(alert_id, []):
+            if callback:
+                callback()
+        self._delivered[alert_id] = True
+        while len(self._delivered) > self.history:
+            self._delivered.popitem(last=False)
+
+
+# Accepts alerts from AlertClient connections and hands them to a dispatcher
+class AlertServer:
+    def __init__(self, socket_path, dispatcher):
+        self.socket_path = socket_path
+        self.dispatcher = dispatcher
+        self._server = None
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        threading.Thread(target=self._accept, name="alert-server", daemon=True).start()
+        logger.info("Listening for alerts on %s", self.socket_path)
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _accept(self):
+        while self._server is not None:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            threading.Thread(
+                target=self._serve, args=(conn,), name="alert-connection", daemon=True
+            ).start()
+
+    def _serve(self, conn):
+        lock = threading.Lock()
+
+        def acknowledge(alert_id):
+            with lock:
+                try:
+                    conn.sendall((json.dumps({"ack": alert_id}) + "\n").encode())
+                except OSError:
+                    # The client will send it again and get the next ack
+                    pass
+
+        with conn, conn.makefile("r") as reader:
+            for line in reader:
+                try:
+                    alert = Alert(**json.loads(line))
+                except (TypeError, ValueError):
+                    logger.warning("Ignoring malformed alert: %s", line.strip())
+                    continue
+                self.dispatcher.submit(alert, lambda i=alert.id: acknowledge(i))
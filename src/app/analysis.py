@@ -0,0 +1,578 @@
+import argparse
+import configparser
+import csv
+import math
+import os
+import sys
+from datetime import datetime, timezone
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from rolling_stats import MAX_DECI_DB, STATISTICS
+
+# Offline analysis of the daily CSV logs
+#
+# The noise logs (timestamp,dB) or compliance logs (timestamp,Leq,Lmax,...)
+# of a whole season are read in large binary chunks and parsed with numpy,
+# never a row at a time, and summarised per session and per local clock
+# hour as they go, so memory stays bounded however many days are read.
+# Timestamps are the logs' local wall clock times and are kept as
+# milliseconds since 1970-01-01T00:00 in that local time.
+
+CHUNK_BYTES = 8 << 20
+
+HOUR_MS = 3_600_000
+
+# Position of each digit of "YYYY-MM-DDTHH:MM:SS.mmm" at the start of a row
+TIMESTAMP_LENGTH = 23
+TIMESTAMP_DIGITS = np.array(
+    [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18, 20, 21, 22]
+)
+
+NEWLINE = ord("\n")
+COMMA = ord(",")
+POINT = ord(".")
+ZERO = ord("0")
+
+# Sound energy of each level bin in tenths of a dB, 10^(L/10)
+ENERGY = 10 ** (np.arange(MAX_DECI_DB + 1) / 100)
+
+SUMMARY_FIELDS = [
+    "start", "end", "hours", "samples", "leq", "l10", "l50", "l90", "lmax",
+    "lmin", "seconds_above", "percent_above", "episodes",
+]
+EPISODE_FIELDS = [
+    "start", "end", "duration", "peak", "peak_time", "leq", "samples",
+]
+
+
+# Chunks of whole rows from each file in turn
+def read_chunks(paths, chunk_bytes=CHUNK_BYTES):
+    for path in paths:
+        with open(path, "rb") as f:
+            partial = b""
+            while True:
+                data = f.read(chunk_bytes)
+                if not data:
+                    break
+                cut = data.rfind(b"\n") + 1
+                if not cut:
+                    partial += data
+                    continue
+                yield partial + data[:cut]
+                partial = data[cut:]
+            if partial.strip():
+                yield partial + b"\n"
+
+
+# Days since 1970-01-01 of each proleptic Gregorian date
+def days_from_civil(year, month, day):
+    year = year - (month <= 2)
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + np.where(month > 2, -3, 9)) + 2) // 5 + day - 1
+    day_of_era = (
+        year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    )
+    return era * 146097 + day_of_era - 719468
+
+
+# Value of each decimal number data[start:end], e.g. "87.4"
+def parse_decimal(data, start, end):
+    width = int((end - start).max(initial=0))
+    if not width:
+        return np.zeros(len(start))
+    index = start[:, None] + np.arange(width)
+    inside = index < end[:, None]
+    chars = data[np.minimum(index, len(data) - 1)]
+    digit = inside & (chars >= ZERO) & (chars <= ZERO + 9)
+    point = inside & (chars == POINT)
+
+    # Accumulate every digit, then divide by ten for each digit after the point
+    value = np.zeros(len(start))
+    for column in range(width):
+        value = np.where(
+            digit[:, column], value * 10 + (chars[:, column] - ZERO), value
+        )
+    decimals = (digit & (np.cumsum(point, axis=1) > 0)).sum(axis=1)
+    return value / 10.0**decimals
+
+
+# Timestamps and levels of every row in a chunk
+#
+# Returns local milliseconds, the level, the maximum and the minimum level
+# in tenths of a dB.  For compliance logs the level is the interval's Leq,
+# the maximum its Lmax and the minimum its Lmin; for noise logs all three
+# are the sample's level.  Rows that do not
+# start with a timestamp (e.g. headers) are skipped.
+def parse_chunk(chunk, compliance=False):
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    ends = np.flatnonzero(data == NEWLINE)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    rows = ends - starts > TIMESTAMP_LENGTH + 1
+    starts, ends = starts[rows], ends[rows]
+    rows = (data[starts + 10] == ord("T")) & (data[starts + TIMESTAMP_LENGTH] == COMMA)
+    starts, ends = starts[rows], ends[rows]
+
+    digits = data[starts[:, None] + TIMESTAMP_DIGITS].astype(np.int64) - ZERO
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    timestamp_ms = (
+        days_from_civil(year, month, day) * 86_400_000
+        + (digits[:, 8] * 10 + digits[:, 9]) * HOUR_MS
+        + (digits[:, 10] * 10 + digits[:, 11]) * 60_000
+        + (digits[:, 12] * 10 + digits[:, 13]) * 1000
+        + digits[:, 14] * 100 + digits[:, 15] * 10 + digits[:, 16]
+    )
+
+    # Field boundaries from the commas following each timestamp
+    commas = np.append(np.flatnonzero(data == COMMA), len(data))
+    field_start = starts + TIMESTAMP_LENGTH + 1
+    field_end = np.minimum(commas[np.searchsorted(commas, field_start)], ends)
+    level = to_deci_db(parse_decimal(data, field_start, field_end))
+    maximum = minimum = level
+    if compliance:
+        maximum, max_end = next_field(data, commas, field_end, ends, level)
+        minimum, _ = next_field(data, commas, max_end, ends, level)
+    return timestamp_ms, level, maximum, minimum
+
+
+# Level in tenths of a dB of the field after the one ending at field_end,
+# or default in rows without one, and the end of the field
+def next_field(data, commas, field_end, ends, default):
+    present = field_end < ends
+    start = np.where(present, field_end + 1, ends)
+    end = np.minimum(commas[np.searchsorted(commas, start)], ends)
+    value = np.where(present, to_deci_db(parse_decimal(data, start, end)), default)
+    return value, end
+
+
+def to_deci_db(dB):
+    return np.clip(np.rint(dB * 10), 0, MAX_DECI_DB).astype(np.int64)
+
+
+# Level statistics over part of the logs
+#
+# Levels are counted in a histogram of tenths of a dB, so summaries of
+# segments can be merged and the percentiles read out at the end.  Each
+# sample counts for the time until the next sample, up to the maximum gap.
+class LevelSummary:
+    def __init__(self, start_ms):
+        self.start_ms = start_ms
+        self.end_ms = start_ms
+        self.samples = 0
+        self.energy = 0.0
+        self.maximum = -1
+        self.minimum = MAX_DECI_DB + 1
+        self.histogram = np.zeros(MAX_DECI_DB + 1, dtype=np.int64)
+        self.duration_ms = 0
+        self.above_ms = 0
+
+    def add(self, timestamp_ms, level, maximum, minimum, duration_ms, limit):
+        self.end_ms = int(timestamp_ms[-1] + duration_ms[-1])
+        self.samples += len(level)
+        self.energy += ENERGY[level].sum()
+        self.maximum = max(self.maximum, int(maximum.max()))
+        self.minimum = min(self.minimum, int(minimum.min()))
+        self.histogram += np.bincount(level, minlength=MAX_DECI_DB + 1)
+        self.duration_ms += int(duration_ms.sum())
+        self.above_ms += int(duration_ms[level > limit * 10].sum())
+
+    def merge(self, other):
+        self.end_ms = other.end_ms
+        self.samples += other.samples
+        self.energy += other.energy
+        self.maximum = max(self.maximum, other.maximum)
+        self.minimum = min(self.minimum, other.minimum)
+        self.histogram += other.histogram
+        self.duration_ms += other.duration_ms
+        self.above_ms += other.above_ms
+
+    # Level at the given percentile (0-100), nearest rank as in rolling_stats
+    def percentile(self, percent):
+        rank = max(math.ceil(percent / 100 * self.samples), 1)
+        return int(np.searchsorted(np.cumsum(self.histogram), rank)) / 10
+
+    def row(self, episodes=0):
+        return [
+            format_ms(self.start_ms),
+            format_ms(self.end_ms),
+            f"{self.duration_ms / HOUR_MS:.3f}",
+            self.samples,
+            f"{10 * math.log10(self.energy / self.samples):.1f}",
+            self.percentile(90),
+            self.percentile(50),
+            self.percentile(10),
+            self.maximum / 10,
+            self.minimum / 10,
+            f"{self.above_ms / 1000:.2f}",
+            f"{100 * self.above_ms / max(self.duration_ms, 1):.2f}",
+            episodes,
+        ]
+
+
+# Detection level of each window of samples, in tenths of a dB, computed
+# as RollingStatistics.statistic() would
+def window_statistic(windows, name):
+    size = windows.shape[1]
+    if name == "max":
+        return windows.max(axis=1).astype(float)
+    if name == "leq":
+        return 100 * np.log10(ENERGY[windows].mean(axis=1))
+    ordered = np.sort(windows, axis=1)
+    if name == "median":
+        if size % 2:
+            return ordered[:, size // 2].astype(float)
+        return (ordered[:, size // 2 - 1] + ordered[:, size // 2]) / 2
+    exceeded = {"l10": 10, "l90": 90}[name]
+    rank = max(math.ceil((100 - exceeded) / 100 * size), 1)
+    return ordered[:, rank - 1].astype(float)
+
+
+# Violation episodes, found the way slm-log.py finds them
+#
+# The detection level is the statistic over the last window_samples
+# samples.  An episode starts when it rises above entry_level and ends on
+# the first sample at or below exit_level, which is not part of it, and is
+# kept if it lasted min_duration seconds.  As in EpisodeTracker, it begins
+# with the run of samples above exit_level in the window that raised the
+# detection level.  The window, the on/off state and any unfinished episode
+# are carried from one chunk to the next.
+class EpisodeFinder:
+    def __init__(
+        self,
+        entry_level,
+        exit_level=None,
+        min_duration=0.0,
+        window_samples=4,
+        statistic="median",
+    ):
+        self.entry_level = entry_level * 10
+        self.exit_level = (entry_level if exit_level is None else exit_level) * 10
+        self.min_duration_ms = min_duration * 1000
+        self.window_samples = window_samples
+        self.statistic = statistic
+        self.reset()
+
+    def reset(self):
+        self._history = np.zeros(0, dtype=np.int64)
+        self._history_ms = np.zeros(0, dtype=np.int64)
+        self._active = False
+        self._open = None
+
+    # Feed consecutive samples, returns the episodes that finished
+    def add(self, timestamp_ms, level):
+        count = len(level)
+        levels = np.concatenate((self._history, level))
+        times = np.concatenate((self._history_ms, timestamp_ms))
+        lead = len(levels) - count
+        keep = max(len(levels) - self.window_samples + 1, 0)
+        self._history = levels[keep:]
+        self._history_ms = times[keep:]
+
+        # +1 enters (or stays in) an episode, -1 ends it, 0 keeps the state,
+        # including for samples before the window is full
+        signal = np.zeros(count, dtype=np.int8)
+        if len(levels) >= self.window_samples:
+            windows = sliding_window_view(levels, self.window_samples)
+            detection = window_statistic(windows, self.statistic)
+            signal[count - len(detection) :] = np.where(
+                detection > self.entry_level,
+                1,
+                np.where(detection <= self.exit_level, -1, 0),
+            )
+        last_signal = np.where(signal != 0, np.arange(count), -1)
+        np.maximum.accumulate(last_signal, out=last_signal)
+        active = np.where(
+            last_signal >= 0, signal[last_signal] > 0, self._active
+        )
+        self._active = bool(active[-1])
+
+        episodes = []
+        edges = np.diff(active.astype(np.int8), prepend=0, append=0)
+        run_starts = np.flatnonzero(edges == 1)
+        run_ends = np.flatnonzero(edges == -1)
+        if self._open and not active[0]:
+            episodes += self._close()
+        for start, end in zip(run_starts, run_ends):
+            if self._open is None:
+                index = lead + start
+                first = self._lead_in(levels, index)
+                if first < index:
+                    self._extend(times[first:index], levels[first:index])
+            self._extend(timestamp_ms[start:end], level[start:end])
+            if end < count:
+                episodes += self._close()
+        return episodes
+
+    # End any episode in progress, e.g. at the end of a session
+    def flush(self):
+        episodes = self._close() if self._open else []
+        self.reset()
+        return episodes
+
+    # Index of the first of the samples above exit_level in the window
+    # before levels[index]
+    def _lead_in(self, levels, index):
+        first = index
+        while (
+            first > max(index - self.window_samples + 1, 0)
+            and levels[first - 1] > self.exit_level
+        ):
+            first -= 1
+        return first
+
+    def _extend(self, timestamp_ms, level):
+        peak = int(level.argmax())
+        episode = self._open
+        if episode is None:
+            self._open = [
+                timestamp_ms[0], timestamp_ms[-1], level[peak], timestamp_ms[peak],
+                ENERGY[level].sum(), len(level),
+            ]
+            return
+        episode[1] = timestamp_ms[-1]
+        if level[peak] > episode[2]:
+            episode[2] = level[peak]
+            episode[3] = timestamp_ms[peak]
+        episode[4] += ENERGY[level].sum()
+        episode[5] += len(level)
+
+    def _close(self):
+        start, end, peak, peak_time, energy, samples = self._open
+        self._open = None
+        if end - start < self.min_duration_ms:
+            return []
+        return [[
+            format_ms(start),
+            format_ms(end),
+            f"{(end - start) / 1000:.2f}",
+            peak / 10,
+            format_ms(peak_time),
+            round(10 * math.log10(energy / samples), 1),
+            samples,
+        ]]
+
+
+# Local milliseconds formatted like the logs' timestamps
+def format_ms(timestamp_ms):
+    local = datetime.fromtimestamp(int(timestamp_ms) / 1000, timezone.utc)
+    return local.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+# Summaries of a season of logs
+#
+# A new session starts after a gap of more than session_gap seconds with no
+# samples.  Returns the session rows, the hourly rows and the episodes.
+def analyse(
+    paths,
+    finder,
+    limit,
+    compliance=False,
+    session_gap=1800,
+    max_gap=5.0,
+    chunk_bytes=CHUNK_BYTES,
+):
+    session_gap_ms = session_gap * 1000
+    max_gap_ms = int(max_gap * 1000)
+    sessions, hours, episodes = [], [], []
+    hour_starts = []
+    session = hour = None
+    session_episodes = 0
+    previous_ms = None
+
+    def close_session():
+        nonlocal session_episodes
+        found = finder.flush()
+        episodes.extend(found)
+        sessions.append(session.row(session_episodes + len(found)))
+        session_episodes = 0
+
+    # Summarise samples whose durations are known, splitting them where a
+    # session or an hour changes
+    def process(timestamp_ms, level, maximum, minimum, duration_ms):
+        nonlocal session, hour, session_episodes, previous_ms
+        gaps = np.diff(timestamp_ms, prepend=previous_ms or timestamp_ms[0])
+        new_session = gaps > session_gap_ms
+        if session is None:
+            new_session[0] = True
+        hour_of = timestamp_ms // HOUR_MS
+        new_hour = np.diff(hour_of, prepend=hour.start_ms // HOUR_MS if hour else -1)
+        cuts = np.flatnonzero(new_session | (new_hour != 0))
+        bounds = np.append(cuts, len(level))
+        if bounds[0] != 0:
+            bounds = np.insert(bounds, 0, 0)
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            if new_session[start]:
+                if session is not None:
+                    close_session()
+                session = None
+            if new_session[start] or hour_of[start] != hour.start_ms // HOUR_MS:
+                if hour is not None:
+                    hours.append(hour.row())
+                    hour_starts.append(hour.start_ms)
+                hour = LevelSummary(int(hour_of[start] * HOUR_MS))
+            segment = LevelSummary(int(timestamp_ms[start]))
+            segment.add(
+                timestamp_ms[start:end],
+                level[start:end],
+                maximum[start:end],
+                minimum[start:end],
+                duration_ms[start:end],
+                limit,
+            )
+            if session is None:
+                session = segment
+            else:
+                session.merge(segment)
+            hour.merge(segment)
+            found = finder.add(timestamp_ms[start:end], level[start:end])
+            session_episodes += len(found)
+            episodes.extend(found)
+        previous_ms = int(timestamp_ms[-1])
+
+    # Each sample's duration is the gap to the next, or none for the last of
+    # a session, so the last sample of a chunk waits for the next chunk
+    carried = None
+    for chunk in read_chunks(paths, chunk_bytes):
+        columns = parse_chunk(chunk, compliance)
+        if carried:
+            columns = [np.concatenate(pair) for pair in zip(carried, columns)]
+        if len(columns[0]) < 2:
+            carried = columns
+            continue
+        gaps = np.diff(columns[0])
+        duration_ms = np.where(
+            gaps > session_gap_ms, 0, np.clip(gaps, 0, max_gap_ms)
+        )
+        process(*[column[:-1] for column in columns], duration_ms)
+        carried = [column[-1:] for column in columns]
+    if carried and len(carried[0]):
+        process(*carried, np.zeros(1, dtype=np.int64))
+    if session is not None:
+        close_session()
+        hours.append(hour.row())
+        hour_starts.append(hour.start_ms)
+
+    # Count episodes by the hour they started in
+    starts = sorted(episode[0] for episode in episodes)
+    for row, start_ms in zip(hours, hour_starts):
+        row[-1] = int(
+            np.searchsorted(starts, format_ms(start_ms + HOUR_MS))
+            - np.searchsorted(starts, format_ms(start_ms))
+        )
+    return sessions, hours, episodes
+
+
+def write_csv(path, fields, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(fields)
+        writer.writerows(rows)
+
+
+def print_table(fields, rows, out=sys.stdout):
+    table = [fields] + [[str(value) for value in row] for row in rows]
+    widths = [max(len(row[i]) for row in table) for i in range(len(fields))]
+    for row in table:
+        line = "  ".join(value.rjust(width) for value, width in zip(row, widths))
+        print(line, file=out)
+
+
+def main():
+    # Default to the logger's limits
+    config = configparser.ConfigParser()
+    config.read("slm-log.ini")
+    monitoring = config["Monitoring"] if config.has_section("Monitoring") else {}
+    maximum_noise_level = float(monitoring.get("maximum_noise_level", 85))
+
+    parser = argparse.ArgumentParser(
+        description="Summarise daily noise or compliance logs per session and per hour"
+    )
+    parser.add_argument(
+        "logs", nargs="+", help="daily logs, e.g. logs/*-noise.csv"
+    )
+    parser.add_argument(
+        "--output", help="directory for sessions.csv, hourly.csv and episodes.csv"
+    )
+    parser.add_argument("--limit", type=float, default=maximum_noise_level)
+    parser.add_argument(
+        "--exit-level",
+        type=float,
+        default=float(monitoring.get("violation_exit_level", maximum_noise_level - 3)),
+    )
+    parser.add_argument(
+        "--min-duration",
+        type=float,
+        default=float(monitoring.get("violation_min_duration", 0)) / 1000,
+        help="seconds",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        help="samples (default: the logger's violation window)",
+    )
+    parser.add_argument(
+        "--statistic",
+        choices=STATISTICS,
+        default=monitoring.get("violation_statistic", "median"),
+    )
+    parser.add_argument(
+        "--session-gap", type=float, default=1800, help="seconds (default: 1800)"
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=5.0,
+        help="longest time in seconds one sample counts for (default: 5)",
+    )
+    args = parser.parse_args()
+
+    # Read in date order, which is name order for the daily logs
+    paths = sorted(args.logs, key=os.path.basename)
+    compliance = [path.endswith("-compliance.csv") for path in paths]
+    if any(compliance) and not all(compliance):
+        parser.error("mix of noise and compliance logs, analyse them separately")
+
+    # The logger's window, converted to samples of these logs if it is set
+    # as a duration.  Samples missing from the logs make this approximate.
+    if args.window is None:
+        window_duration = int(monitoring.get("violation_window_duration", 0))
+        if window_duration:
+            interval_key = (
+                "compliance_sample_interval" if compliance[0] else "sample_interval"
+            )
+            interval = int(monitoring.get(interval_key, 0))
+            if not interval:
+                parser.error(
+                    f"violation_window_duration is set but {interval_key} is not, "
+                    "give the window in samples with --window"
+                )
+            args.window = max(math.ceil(window_duration / interval), 1)
+        else:
+            args.window = int(monitoring.get("violation_window_samples", 4))
+
+    finder = EpisodeFinder(
+        args.limit, args.exit_level, args.min_duration, args.window, args.statistic
+    )
+    sessions, hours, episodes = analyse(
+        paths,
+        finder,
+        args.limit,
+        compliance=compliance[0],
+        session_gap=args.session_gap,
+        max_gap=args.max_gap,
+    )
+
+    print_table(SUMMARY_FIELDS, sessions)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+        write_csv(os.path.join(args.output, "sessions.csv"), SUMMARY_FIELDS, sessions)
+        write_csv(os.path.join(args.output, "hourly.csv"), SUMMARY_FIELDS, hours)
+        write_csv(os.path.join(args.output, "episodes.csv"), EPISODE_FIELDS, episodes)
+
+
+if __name__ == "__main__":
+    main()
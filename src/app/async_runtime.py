@@ -0,0 +1,376 @@
+import asyncio
+import logging
+import time
+
+import serial
+
+from acquisition import Sample, SampleClock
+from alerts import Alert
+from influx_writer import InfluxWriterBase
+from qm1592 import FrameDecoder
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# asyncio versions of the serial reader, InfluxDB writer and alert sender,
+# so slm-log.py --asyncio can run everything in one event loop.  Each keeps
+# the counters and the write()/send() interface of its threaded
+# counterpart, so the rest of slm-log.py and the metrics work with either.
+
+
+# Serial reader task
+#
+# The port is opened non-blocking and read from an event loop callback
+# whenever its file descriptor is readable.  Samples go to a bounded
+# asyncio.Queue; when it is full they are dropped and counted as overruns.
+# A port without a file descriptor (e.g. a capture.ReplaySerial) is read in
+# a worker thread instead, waiting for the consumer rather than dropping
+# samples, and the reader finishes when it raises EOFError.
+class AsyncSerialReader:
+    def __init__(
+        self,
+        device,
+        samples,
+        source=None,
+        baudrate=9600,
+        clock=None,
+        open_serial=None,
+        retry_delay=1.0,
+        max_retry_delay=30.0,
+    ):
+        self.device = device
+        self.samples = samples
+        self.source = source
+        self.baudrate = baudrate
+        self.clock = clock or SampleClock()
+        self.open_serial = open_serial
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.finished = False
+        self.decoder = FrameDecoder()
+        self._task = None
+
+        # Counters
+        self.frames_read = 0
+        self.overruns = 0
+        self.reconnects = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def is_alive(self):
+        return self._task is not None and not self._task.done()
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            ser = await self._open()
+            if not hasattr(ser, "fileno"):
+                await self._read_in_thread(ser)
+                return
+            lost = loop.create_future()
+            fd = ser.fileno()
+            loop.add_reader(fd, self._on_readable, ser, lost)
+            try:
+                await lost
+            finally:
+                loop.remove_reader(fd)
+                ser.close()
+            self.reconnects += 1
+            # Drop the partial frame from before the error
+            self.decoder.reset()
+
+    def _on_readable(self, ser, lost):
+        try:
+            data = ser.read(ser.in_waiting or 1)
+        except serial.SerialException:
+            logger.error("Serial communication error on %s", self.device)
+            if not lost.done():
+                lost.set_result(None)
+            return
+        if not data:
+            return
+        timestamp_ns = self.clock.now_ns()
+        source = self.source
+        for frame in self.decoder.feed(data):
+            self.frames_read += 1
+            try:
+                self.samples.put_nowait(Sample(timestamp_ns, frame, source))
+            except asyncio.QueueFull:
+                self.overruns += 1
+                if self.overruns == 1 or self.overruns % 100 == 0:
+                    logger.warning(
+                        "Sample queue full, %d frames dropped so far", self.overruns
+                    )
+
+    async def _read_in_thread(self, port):
+        try:
+            while True:
+                try:
+                    data = await asyncio.to_thread(port.read, 4096)
+                except EOFError:
+                    logger.info("End of serial input")
+                    self.finished = True
+                    return
+                timestamp_ns = self.clock.now_ns()
+                for frame in self.decoder.feed(data):
+                    self.frames_read += 1
+                    await self.samples.put(Sample(timestamp_ns, frame, self.source))
+        finally:
+            port.close()
+
+    async def _open(self):
+        if self.open_serial:
+            return self.open_serial()
+        delay = self.retry_delay
+        while True:
+            try:
+                ser = serial.Serial(self.device, self.baudrate, timeout=0)
+            except serial.SerialException:
+                logger.error(
+                    "Unable to open %s, retrying in %.0f s", self.device, delay
+                )
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+                continue
+            if self.reconnects:
+                logger.info("Serial communication restored on %s", self.device)
+            return ser
+
+
+# InfluxDB writer task using the influxdb-client async write API
+#
+# Batches, counts, spills and journals exactly like
+# influx_writer.InfluxBatchWriter, sharing all of that through
+# influx_writer.InfluxWriterBase; only the loop that sends is here.  The
+# spill file and the journal are read and written in a worker thread so
+# disk I/O never holds up the event loop.  Without a write_api, the
+# coroutine connect() creates one the first time a batch is written.
+class AsyncInfluxWriter(InfluxWriterBase):
+    queue_full = asyncio.QueueFull
+
+    def __init__(self, write_api, bucket, org, queue_size=10000, **kwargs):
+        super().__init__(write_api, bucket, org, **kwargs)
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._stopping = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        run = self._run_journal if self.journal else self._run
+        self._task = asyncio.get_running_loop().create_task(run())
+        return self
+
+    # Stop the task, flushing whatever is still queued
+    async def close(self, timeout=30):
+        if self._task is not None:
+            self._stopping.set()
+            if not self.journal:
+                await self._queue.put(None)
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except asyncio.TimeoutError:
+                logger.error("Timed out flushing points to InfluxDB")
+        logger.info("InfluxDB writer stopped: %s", self.stats())
+
+    async def _run(self):
+        batch = []
+        batch_started = None
+        stopping = False
+        while not stopping:
+            # Wait for the next point, but no longer than the batch age limit
+            if batch:
+                wait = max(0.0, batch_started + self.flush_interval - time.monotonic())
+            else:
+                wait = self.flush_interval
+            try:
+                line = await asyncio.wait_for(self._queue.get(), wait)
+                if line is None:
+                    stopping = True
+                else:
+                    if not batch:
+                        batch_started = time.monotonic()
+                    batch.append(line)
+            except asyncio.TimeoutError:
+                pass
+
+            if batch and (
+                stopping
+                or len(batch) >= self.batch_size
+                or time.monotonic() - batch_started >= self.flush_interval
+            ):
+                await self._flush(batch)
+                batch = []
+            elif self._spilled and time.monotonic() >= self._next_retry:
+                await self._replay_spill()
+
+    async def _run_journal(self):
+        journal = self.journal
+        next_sync = time.monotonic() + journal.sync_interval
+        more = False
+        while True:
+            if not more:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            stopping = self._stopping.is_set()
+            now = time.monotonic()
+            if stopping or now >= next_sync:
+                await asyncio.to_thread(self._sync_journal)
+                next_sync = now + journal.sync_interval
+            more = False
+            if journal.pending and (stopping or now >= self._next_retry):
+                more = await self._send_from_journal()
+            # Give up on a failed write when stopping, the journal keeps it
+            if stopping and not more:
+                break
+
+    # Send the next batch from the journal, returning True if there is more
+    # to send straight away
+    async def _send_from_journal(self):
+        batch = await asyncio.to_thread(self._read_journal)
+        if batch is None:
+            return False
+        lines, position = batch
+        if lines and not await self._send(lines):
+            return False
+        return await asyncio.to_thread(self._acknowledge_journal, lines, position)
+
+    async def _flush(self, batch):
+        # Keep ordering: while a spill exists new batches go behind it
+        if self._spilled:
+            await asyncio.to_thread(self._spill, batch)
+            if time.monotonic() >= self._next_retry:
+                await self._replay_spill()
+            return
+        if not await self._send(batch):
+            await asyncio.to_thread(self._spill, batch)
+
+    # Write one batch, returning True on success
+    async def _send(self, batch):
+        started = time.monotonic()
+        try:
+            if self.write_api is None:
+                self.write_api = await self.connect()
+            await self.write_api.write(**self._write_args(batch))
+        except Exception as e:
+            return self._send_failed(batch, e)
+        return self._sent(batch, started)
+
+    # Send the spill file in batches and truncate it once fully written
+    async def _replay_spill(self):
+        lines = await asyncio.to_thread(self._read_spill)
+        if lines is None:
+            return
+        for start in range(0, len(lines), self.batch_size):
+            if not await self._send(lines[start:start + self.batch_size]):
+                return
+        await asyncio.to_thread(self._clear_spill)
+
+
+# Alert sender task, in place of AlertClient and send_pushover.py
+#
+# Has the send() interface of alerts.AlertClient, but coalesces and sends
+# alerts itself like alerts.AlertDispatcher: the first alert for a key goes
+# straight out, later ones within coalesce_window seconds are summarised
+# when the window ends.  send_function (e.g. send_pushover_message) blocks,
+# so it runs in a worker thread.  A failed send is retried with backoff
+# before the next alert is taken, so while the alert service is down alerts
+# wait in the bounded queue and new ones are dropped once it is full.
+class AsyncAlertDispatcher:
+    def __init__(
+        self, send_function, coalesce_window=30.0, max_backoff=60.0, queue_size=1000
+    ):
+        self.send_function = send_function
+        self.coalesce_window = coalesce_window
+        self.max_backoff = max_backoff
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        # Open bursts by key: [window end, alerts held back, latest alert]
+        self._bursts = {}
+
+        # Counters
+        self.alerts_sent = 0
+        self.alerts_dropped = 0
+        self.alerts_coalesced = 0
+        self.send_failures = 0
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        return self
+
+    def send(self, message, key=None, title=None):
+        try:
+            self._queue.put_nowait(Alert(None, key, message, title))
+        except asyncio.QueueFull:
+            self.alerts_dropped += 1
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    # Give queued alerts a chance to go out before the process exits
+    async def close(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while self._queue.qsize() and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        while True:
+            deadlines = [burst[0] for burst in self._bursts.values()]
+            wait = max(min(deadlines) - time.monotonic(), 0.0) if deadlines else None
+            try:
+                alert = await asyncio.wait_for(self._queue.get(), wait)
+            except asyncio.TimeoutError:
+                alert = None
+            if alert is not None:
+                await self._handle(alert)
+            await self._close_bursts(time.monotonic())
+
+    async def _handle(self, alert):
+        burst = self._bursts.get(alert.key) if alert.key is not None else None
+        if burst is not None:
+            burst[1] += 1
+            burst[2] = alert
+            self.alerts_coalesced += 1
+            return
+        if alert.key is not None:
+            self._bursts[alert.key] = [time.monotonic() + self.coalesce_window, 0, None]
+        await self._deliver(alert)
+
+    # Send a summary for each burst whose window has ended
+    async def _close_bursts(self, now):
+        for key, burst in list(self._bursts.items()):
+            if now < burst[0]:
+                continue
+            held, latest = burst[1], burst[2]
+            if not held:
+                del self._bursts[key]
+                continue
+            # Start a new window so a burst that carries on stays coalesced
+            self._bursts[key] = [now + self.coalesce_window, 0, None]
+            message = (
+                f"{latest.message} (+{held} more in {self.coalesce_window:g} s)"
+            )
+            await self._deliver(latest._replace(message=message))
+
+    async def _deliver(self, alert):
+        backoff = 1.0
+        while True:
+            try:
+                await asyncio.to_thread(self.send_function, alert.message, alert.title)
+            except Exception as e:
+                self.send_failures += 1
+                logger.error("Error sending alert, retrying in %.0f s: %s", backoff, e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            self.alerts_sent += 1
+            return
@@ -0,0 +1,102 @@
+import struct
+import time
+
+# Raw serial capture format
+#
+# A 16 byte header followed by one record per serial read:
+#   header: magic "SLMC", uint16 version, 2 pad bytes, int64 wall-clock
+#           start of the capture in ns since the epoch
+#   record: int64 arrival time in ns since the start of the capture,
+#           uint32 length, then the bytes exactly as read from the port
+MAGIC = b"SLMC"
+VERSION = 1
+HEADER = struct.Struct("<4sHxxq")
+RECORD = struct.Struct("<qI")
+
+
+# Append serial reads with their arrival times to a capture file
+class CaptureWriter:
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._start_mono_ns = time.monotonic_ns()
+        self._file.write(HEADER.pack(MAGIC, VERSION, time.time_ns()))
+
+    def write(self, data):
+        offset_ns = time.monotonic_ns() - self._start_mono_ns
+        self._file.write(RECORD.pack(offset_ns, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+# Open a capture, returning its start time and a generator of
+# (arrival offset in ns, bytes) records
+def read_capture(path):
+    f = open(path, "rb")
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        f.close()
+        raise ValueError(f"{path} is not a serial capture")
+    magic, version, start_ns = HEADER.unpack(header)
+    if magic != MAGIC:
+        f.close()
+        raise ValueError(f"{path} is not a serial capture")
+    if version != VERSION:
+        f.close()
+        raise ValueError(f"{path} has unsupported version {version}")
+
+    def records():
+        with f:
+            while True:
+                header = f.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                offset_ns, length = RECORD.unpack(header)
+                data = f.read(length)
+                if len(data) < length:
+                    return
+                yield offset_ns, data
+
+    return start_ns, records()
+
+
+# Stand-in for serial.Serial that plays back a capture
+#
+# Reads return the captured bytes paced by their original arrival times,
+# divided by speed (2 plays twice as fast), or as fast as they are read
+# when speed is 0.  now_ns() gives the capture's wall-clock time for the
+# bytes last read, so replayed samples keep their original timestamps.
+# Reading past the end raises EOFError.
+class ReplaySerial:
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.start_ns, self._records = read_capture(path)
+        self._pending = b""
+        self._offset_ns = 0
+        self._started_ns = time.monotonic_ns()
+
+    @property
+    def in_waiting(self):
+        return len(self._pending)
+
+    def read(self, size=1):
+        if not self._pending:
+            record = next(self._records, None)
+            if record is None:
+                raise EOFError("End of capture")
+            self._offset_ns, self._pending = record
+            if self.speed:
+                due_ns = self._started_ns + self._offset_ns / self.speed
+                delay = (due_ns - time.monotonic_ns()) / 1e9
+                if delay > 0:
+                    time.sleep(delay)
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+    def now_ns(self):
+        return self.start_ns + self._offset_ns
+
+    def close(self):
+        self._records.close()
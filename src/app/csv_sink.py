@@ -0,0 +1,199 @@
+import logging
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timedelta
+from datetime import time as dt_time
+
+import metrics
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+flush_latency = metrics.histogram(
+    "slm_csv_flush_seconds", "Time taken to flush a CSV log to disk"
+)
+
+# Time index entry: int64 timestamp in ns since the epoch of a row and the
+# byte offset of the row in the log
+INDEX_ENTRY = struct.Struct("<qq")
+
+
+# Nanoseconds since the epoch of local midnight at the start of the next day
+def next_local_midnight_ns(timestamp_ns, tz):
+    local = datetime.fromtimestamp(timestamp_ns / 1e9, tz)
+    midnight = datetime.combine(local.date() + timedelta(days=1), dt_time())
+    return int(tz.localize(midnight).timestamp()) * 1_000_000_000
+
+
+# Daily CSV file kept open between writes
+#
+# Rows go to {directory}/{YYYY-MM-DD}-{name}.csv, where the date is the
+# local date of the row's timestamp, so files roll over at local midnight
+# in tz.  Writes are buffered and flushed every flush_interval seconds; with
+# fsync set each flush is also forced to disk.  With auto_flush off, write()
+# never flushes and flush() is left to the caller, which may call it from
+# another thread: writes and flushes take the same lock, and the fsync of a
+# flush runs on a duplicate of the file descriptor outside it, so a write
+# only ever waits for the buffer to be copied to the kernel.
+#
+# With an index_interval in seconds, a sparse time index is kept alongside
+# each log in {YYYY-MM-DD}-{name}.idx: an INDEX_ENTRY for the first row at
+# or after each multiple of the interval, so a reader can bisect to any
+# time without reading the log (see logquery.py).  Logs are UTF-8 and
+# offsets count the bytes written.  The index is flushed after the log, so
+# it never points past the end of the log.
+class DailyCsvSink:
+    def __init__(
+        self,
+        directory,
+        name,
+        tz,
+        flush_interval=1.0,
+        fsync=False,
+        auto_flush=True,
+        index_interval=0,
+    ):
+        self.directory = directory
+        self.name = name
+        self.tz = tz
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.auto_flush = auto_flush
+        self.index_interval_ns = int(index_interval * 1e9)
+
+        self._file = None
+        self._index = None
+        self._offset = 0
+        self._next_index_ns = 0
+        self._lock = threading.Lock()
+        self._rotate_at_ns = 0
+        self._next_flush = 0.0
+
+        # Counters
+        self.rows_written = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def path(self):
+        return self._file.name if self._file else None
+
+    # Append one row (a complete line, including the newline)
+    def write(self, timestamp_ns, line):
+        with self._lock:
+            if timestamp_ns >= self._rotate_at_ns:
+                self._rotate(timestamp_ns)
+            if timestamp_ns >= self._next_index_ns and self._index is not None:
+                self._index.write(INDEX_ENTRY.pack(timestamp_ns, self._offset))
+                self._next_index_ns = (
+                    timestamp_ns - timestamp_ns % self.index_interval_ns
+                    + self.index_interval_ns
+                )
+            self._file.write(line)
+            # Only rows with text from outside (e.g. car numbers) need encoding
+            self._offset += len(line) if line.isascii() else len(line.encode())
+            self.rows_written += 1
+        if self.auto_flush and time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def flush(self):
+        self._next_flush = time.monotonic() + self.flush_interval
+        with self._lock:
+            if self._file is None:
+                return
+            started = time.monotonic()
+            self._file.flush()
+            if self._index is not None:
+                self._index.flush()
+            fd = os.dup(self._file.fileno()) if self.fsync else None
+        if fd is not None:
+            # Still valid if the file is rotated or closed meanwhile
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.flushes += 1
+        self.last_flush_latency = time.monotonic() - started
+        flush_latency.observe(self.last_flush_latency)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    # Called with the lock held
+    def _close(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._rotate_at_ns = 0
+        if self._index is not None:
+            self._index.close()
+            self._index = None
+
+    # Called with the lock held
+    def _rotate(self, timestamp_ns):
+        self._close()
+        date = datetime.fromtimestamp(timestamp_ns / 1e9, self.tz).strftime("%Y-%m-%d")
+        path = os.path.join(self.directory, f"{date}-{self.name}.csv")
+        self._file = open(path, "a", encoding="utf-8")
+        self._rotate_at_ns = next_local_midnight_ns(timestamp_ns, self.tz)
+        if self.index_interval_ns:
+            index_path = os.path.join(self.directory, f"{date}-{self.name}.idx")
+            self._index = open(index_path, "ab")
+            self._offset = self._file.tell()
+            self._next_index_ns = 0
+        logger.info("Logging to %s", path)
+
+
+# Every daily CSV log written by the process
+#
+# Sinks are created on first use by name and share the directory, time zone
+# and flush settings, so each meter's logs rotate together and can be
+# flushed or closed in one call.
+class DailyCsvLogs:
+    def __init__(
+        self, directory, tz, flush_interval=1.0, fsync=False, index_interval=0
+    ):
+        self.directory = directory
+        self.tz = tz
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.index_interval = index_interval
+        self.auto_flush = True
+        self._sinks = {}
+
+    def sink(self, name):
+        sink = self._sinks.get(name)
+        if sink is None:
+            sink = DailyCsvSink(
+                self.directory,
+                name,
+                self.tz,
+                self.flush_interval,
+                self.fsync,
+                self.auto_flush,
+                self.index_interval,
+            )
+            self._sinks[name] = sink
+        return sink
+
+    # Leave flushing to whoever calls flush(), e.g. a background task
+    def disable_auto_flush(self):
+        self.auto_flush = False
+        for sink in self._sinks.values():
+            sink.auto_flush = False
+
+    def flush(self):
+        for sink in self._sinks.values():
+            sink.flush()
+
+    def close(self):
+        for sink in self._sinks.values():
+            sink.close()
@@ -0,0 +1,139 @@
+import math
+from collections import namedtuple
+
+from rolling_stats import ENERGY, ENERGY_SCALE, MAX_DECI_DB
+
+# One noise violation: start and end in ns since the epoch, the loudest
+# sample and when it happened, the Leq over the episode and its length in
+# samples
+ViolationEpisode = namedtuple(
+    "ViolationEpisode",
+    ["start_ns", "end_ns", "peak_db", "peak_ns", "leq", "samples"],
+)
+
+IDLE = "idle"
+PENDING = "pending"
+ACTIVE = "active"
+
+
+# Violation episode state machine
+#
+# An episode starts when the detection level rises above entry_level and
+# lasts until it falls to exit_level or below, so a level hovering around
+# the limit is one episode rather than many.  A smoothed detection level
+# (e.g. the median) only crosses the limit some samples into a loud event,
+# so given the detection window, an episode starts with the run of samples
+# in the window above the exit level that led up to the crossing, and they
+# count towards its peak and Leq.  Episodes shorter than min_duration
+# seconds are ignored.  update() returns a (kind, episode)
+# event or None:
+#   ("start", episode)  the episode has lasted min_duration, peak so far
+#   ("end", episode)    the episode is over, with its final peak and end
+# should_alert() limits notifications to one per alert_interval seconds.
+class EpisodeTracker:
+    def __init__(
+        self, entry_level, exit_level=None, min_duration=0.0, alert_interval=0.0
+    ):
+        self.entry_level = entry_level
+        self.exit_level = entry_level if exit_level is None else exit_level
+        self.min_duration_ns = int(min_duration * 1e9)
+        self.alert_interval_ns = int(alert_interval * 1e9)
+
+        self.state = IDLE
+        self._last_alert_ns = None
+        self.alerts_suppressed = 0
+        self._reset()
+
+    def _reset(self):
+        self._start_ns = None
+        self._end_ns = None
+        self._peak_deci_db = -1
+        self._peak_ns = None
+        self._energy = 0
+        self._samples = 0
+
+    # The episode so far
+    @property
+    def episode(self):
+        if self.state == IDLE:
+            return None
+        return ViolationEpisode(
+            self._start_ns,
+            self._end_ns,
+            self._peak_deci_db / 10,
+            self._peak_ns,
+            round(10 * math.log10(self._energy / (self._samples * ENERGY_SCALE)), 1),
+            self._samples,
+        )
+
+    # True if an alert for an episode starting now should be sent
+    def should_alert(self, timestamp_ns):
+        if (
+            self._last_alert_ns is not None
+            and timestamp_ns - self._last_alert_ns < self.alert_interval_ns
+        ):
+            self.alerts_suppressed += 1
+            return False
+        self._last_alert_ns = timestamp_ns
+        return True
+
+    # Feed one sample: the detection level (e.g. the rolling median), the
+    # sample's own level, which is used for the peak and Leq, and the
+    # detection window's samples as (timestamp_ns, tenths of a dB), e.g. a
+    # RollingStatistics
+    def update(self, timestamp_ns, level, dB=None, window=()):
+        if dB is None:
+            dB = level
+
+        if self.state == IDLE:
+            if level <= self.entry_level:
+                return None
+            self.state = PENDING
+            self._start_ns = timestamp_ns
+            self._add_lead_in(timestamp_ns, window)
+        elif level <= self.exit_level:
+            event = None
+            if self.state == ACTIVE:
+                event = ("end", self.episode)
+            self.state = IDLE
+            self._reset()
+            return event
+
+        # Still in an episode
+        self._add(timestamp_ns, min(max(round(dB * 10), 0), MAX_DECI_DB))
+
+        if (
+            self.state == PENDING
+            and timestamp_ns - self._start_ns >= self.min_duration_ns
+        ):
+            self.state = ACTIVE
+            return ("start", self.episode)
+        return None
+
+    # Start the episode with the loud samples in the window before this one
+    def _add_lead_in(self, timestamp_ns, window):
+        exit_deci_db = self.exit_level * 10
+        lead_in = []
+        for sample in reversed([s for s in window if s[0] < timestamp_ns]):
+            if sample[1] <= exit_deci_db:
+                break
+            lead_in.append(sample)
+        for sample_ns, deci_db in reversed(lead_in):
+            if sample_ns < self._start_ns:
+                self._start_ns = sample_ns
+            self._add(sample_ns, deci_db)
+
+    def _add(self, timestamp_ns, deci_db):
+        if deci_db > self._peak_deci_db:
+            self._peak_deci_db = deci_db
+            self._peak_ns = timestamp_ns
+        self._energy += ENERGY[deci_db]
+        self._samples += 1
+        self._end_ns = timestamp_ns
+
+    # End any episode in progress, e.g. at shutdown
+    def flush(self):
+        event = ("end", self.episode) if self.state == ACTIVE else None
+        self.state = IDLE
+        self._reset()
+        return event
@@ -0,0 +1,389 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# Timestamps are in nanoseconds (influxdb_client.WritePrecision.NS, not
+# imported here because importing influxdb_client takes a while)
+WRITE_PRECISION = "ns"
+
+write_latency = metrics.histogram(
+    "slm_influxdb_write_seconds", "Time taken by each InfluxDB batch write"
+)
+write_failures = metrics.counter(
+    "slm_influxdb_write_failures_total", "InfluxDB batch writes that failed"
+)
+
+
+# Escape a measurement name for InfluxDB line protocol
+def escape_measurement(name):
+    return str(name).replace(",", "\\,").replace(" ", "\\ ")
+
+
+# Escape a tag key or value for InfluxDB line protocol
+def escape_tag(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+        .replace(" ", "\\ ")
+    )
+
+
+# Format a single field value for InfluxDB line protocol
+def format_field(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return f"{value}i"
+    if isinstance(value, float):
+        return repr(value)
+    escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return f'"{escaped}"'
+
+
+# Build one line protocol record with a nanosecond timestamp
+def to_line_protocol(measurement, tags, fields, timestamp_ns):
+    line = escape_measurement(measurement)
+    for key in sorted(tags):
+        line += f",{escape_tag(key)}={escape_tag(tags[key])}"
+    line += " " + ",".join(
+        f"{escape_tag(key)}={format_field(value)}" for key, value in fields.items()
+    )
+    return f"{line} {int(timestamp_ns)}"
+
+
+# State shared by the InfluxDB writers: settings, counters, the journal,
+# the spill file, and the bookkeeping around each batch write.  Subclasses
+# provide the queue (raising queue_full when it is full) and the loop that
+# sends from it, either InfluxBatchWriter's thread or
+# async_runtime.AsyncInfluxWriter's task.
+class InfluxWriterBase:
+    queue_full = queue.Full
+
+    def __init__(
+        self,
+        write_api,
+        bucket,
+        org,
+        batch_size=100,
+        flush_interval=1.0,
+        spill_path="influx-spill.lp",
+        max_backoff=60.0,
+        connect=None,
+        journal=None,
+        backfill_batch_size=5000,
+    ):
+        self.write_api = write_api
+        self.connect = connect
+        self.journal = journal
+        self.backfill_batch_size = backfill_batch_size
+        self.bucket = bucket
+        self.org = org
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.max_backoff = max_backoff
+
+        # Backend state
+        self._backoff = 1.0
+        self._next_retry = 0.0
+        self._spilled = os.path.exists(spill_path) and os.path.getsize(spill_path) > 0
+
+        # Counters
+        self.points_queued = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.points_spilled = 0
+        self.batches_written = 0
+        self.batches_failed = 0
+        self.last_batch_latency = 0.0
+        self.max_batch_latency = 0.0
+
+    # Queue a point for writing; never blocks the caller
+    def write(self, measurement, tags, fields, timestamp_ns):
+        line = to_line_protocol(measurement, tags, fields, timestamp_ns)
+        if self.journal:
+            self._append(line)
+            return
+        try:
+            self._queue.put_nowait(line)
+            self.points_queued += 1
+        except self.queue_full:
+            self.points_dropped += 1
+
+    def _append(self, line):
+        try:
+            self.journal.append(line)
+            self.points_queued += 1
+        except OSError as e:
+            self.points_dropped += 1
+            if self.points_dropped == 1 or self.points_dropped % 100 == 0:
+                logger.error("Error appending to the journal: %s", e)
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "points_queued": self.points_queued,
+            "points_written": self.points_written,
+            "points_dropped": self.points_dropped,
+            "points_spilled": self.points_spilled,
+            "batches_written": self.batches_written,
+            "batches_failed": self.batches_failed,
+            "last_batch_latency": self.last_batch_latency,
+            "max_batch_latency": self.max_batch_latency,
+        }
+
+    # Arguments of write_api.write() for a batch
+    def _write_args(self, batch):
+        return {
+            "bucket": self.bucket,
+            "org": self.org,
+            "record": batch,
+            "write_precision": WRITE_PRECISION,
+        }
+
+    # Count a batch written since started, returning True
+    def _sent(self, batch, started):
+        latency = time.monotonic() - started
+        write_latency.observe(latency)
+        self.last_batch_latency = latency
+        self.max_batch_latency = max(self.max_batch_latency, latency)
+        self.batches_written += 1
+        self.points_written += len(batch)
+        self._backoff = 1.0
+        return True
+
+    # Count a failed batch and back off, returning False
+    def _send_failed(self, batch, e):
+        self.batches_failed += 1
+        write_failures.inc()
+        self._next_retry = time.monotonic() + self._backoff
+        logger.error(
+            "Error writing %d points to InfluxDB, retrying in %.0f s: %s",
+            len(batch),
+            self._backoff,
+            e,
+        )
+        self._backoff = min(self._backoff * 2, self.max_backoff)
+        return False
+
+    # --------------------- Journal ---------------------
+
+    def _sync_journal(self):
+        try:
+            self.journal.sync()
+        except OSError as e:
+            logger.error("Error syncing the journal: %s", e)
+
+    # The next batch from the journal's checkpoint on, and the position
+    # after it, or None if the journal could not be read
+    def _read_journal(self):
+        journal = self.journal
+        try:
+            return journal.read(journal.acknowledged, self.backfill_batch_size)
+        except OSError as e:
+            logger.error("Error reading the journal: %s", e)
+            return None
+
+    # Move the checkpoint past a batch that was sent, returning True if
+    # there is more to send straight away
+    def _acknowledge_journal(self, lines, position):
+        journal = self.journal
+        if position != journal.acknowledged:
+            try:
+                journal.acknowledge(position)
+            except OSError as e:
+                logger.error("Error writing the journal checkpoint: %s", e)
+                return False
+        return len(lines) >= self.backfill_batch_size
+
+    # --------------------- Spill file ---------------------
+
+    def _spill(self, batch):
+        try:
+            with open(self.spill_path, "a") as f:
+                f.write("\n".join(batch) + "\n")
+            self.points_spilled += len(batch)
+            self._spilled = True
+        except OSError as e:
+            self.points_dropped += len(batch)
+            logger.error("Error writing InfluxDB spill file: %s", e)
+
+    # Lines in the spill file, or None if it could not be read
+    def _read_spill(self):
+        try:
+            with open(self.spill_path, "r") as f:
+                return [line for line in f.read().splitlines() if line]
+        except FileNotFoundError:
+            return []
+        except OSError as e:
+            logger.error("Error reading InfluxDB spill file: %s", e)
+            return None
+
+    # Truncate the spill file once it has all been written
+    def _clear_spill(self):
+        open(self.spill_path, "w").close()
+        self._spilled = False
+        logger.info("InfluxDB spill file replayed")
+
+
+# Background InfluxDB writer
+#
+# Samples are queued by the serial loop and written by a worker thread in
+# line protocol batches, flushed when either batch_size points are waiting or
+# the oldest point is flush_interval seconds old.  While InfluxDB is failing,
+# batches are appended to an on-disk spill journal and retried with
+# exponential backoff; once a write succeeds again the journal is replayed
+# and truncated.  Replaying a point twice is harmless because InfluxDB
+# overwrites points with the same series and timestamp.
+#
+# Without a write_api, the worker calls connect() to create one the first
+# time it writes, so creating the client never delays the caller; if that
+# fails it is retried with the same backoff.
+#
+# With a journal (see journal.SampleJournal) nothing is queued in memory or
+# spilled: write() appends the point to the journal and the worker sends
+# whatever has been appended since the checkpoint every flush_interval, up
+# to backfill_batch_size points at a time, moving the checkpoint on as each
+# batch is acknowledged.  After a failed write, or on starting with points
+# left from the last run, it catches up in batches of backfill_batch_size
+# as fast as InfluxDB takes them.  Points still unsent at close() stay in
+# the journal for the next run.
+class InfluxBatchWriter(InfluxWriterBase):
+    def __init__(self, write_api, bucket, org, queue_size=10000, **kwargs):
+        super().__init__(write_api, bucket, org, **kwargs)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_journal if self.journal else self._run,
+            name="influx-writer",
+            daemon=True,
+        )
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    # Stop the worker, flushing whatever is still queued
+    def close(self, timeout=30):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        logger.info("InfluxDB writer stopped: %s", self.stats())
+
+    # --------------------- Worker thread ---------------------
+
+    def _run(self):
+        batch = []
+        batch_started = None
+        while True:
+            # Wait for the next point, but no longer than the batch age limit
+            if batch:
+                wait = max(0.0, batch_started + self.flush_interval - time.monotonic())
+            else:
+                wait = self.flush_interval
+            try:
+                line = self._queue.get(timeout=wait)
+                if not batch:
+                    batch_started = time.monotonic()
+                batch.append(line)
+            except queue.Empty:
+                pass
+
+            stopping = self._stop.is_set()
+            if batch and (
+                stopping
+                or len(batch) >= self.batch_size
+                or time.monotonic() - batch_started >= self.flush_interval
+            ):
+                # Drain anything else already waiting when shutting down
+                if stopping:
+                    batch.extend(self._drain())
+                self._flush(batch)
+                batch = []
+            elif self._spilled and time.monotonic() >= self._next_retry:
+                self._replay_spill()
+
+            if stopping and self._queue.empty() and not batch:
+                break
+
+    def _run_journal(self):
+        journal = self.journal
+        next_sync = time.monotonic() + journal.sync_interval
+        more = False
+        while True:
+            if not more:
+                self._stop.wait(self.flush_interval)
+            stopping = self._stop.is_set()
+            now = time.monotonic()
+            if stopping or now >= next_sync:
+                self._sync_journal()
+                next_sync = now + journal.sync_interval
+            more = False
+            if journal.pending and (stopping or now >= self._next_retry):
+                more = self._send_from_journal()
+            # Give up on a failed write when stopping, the journal keeps it
+            if stopping and not more:
+                break
+
+    # Send the next batch from the journal, returning True if there is more
+    # to send straight away
+    def _send_from_journal(self):
+        batch = self._read_journal()
+        if batch is None:
+            return False
+        lines, position = batch
+        if lines and not self._send(lines):
+            return False
+        return self._acknowledge_journal(lines, position)
+
+    def _drain(self):
+        lines = []
+        while True:
+            try:
+                lines.append(self._queue.get_nowait())
+            except queue.Empty:
+                return lines
+
+    def _flush(self, batch):
+        # Keep ordering: while a spill exists new batches go behind it
+        if self._spilled:
+            self._spill(batch)
+            if time.monotonic() >= self._next_retry:
+                self._replay_spill()
+            return
+        if not self._send(batch):
+            self._spill(batch)
+
+    # Write one batch, returning True on success
+    def _send(self, batch):
+        started = time.monotonic()
+        try:
+            if self.write_api is None:
+                self.write_api = self.connect()
+            self.write_api.write(**self._write_args(batch))
+        except Exception as e:
+            return self._send_failed(batch, e)
+        return self._sent(batch, started)
+
+    # Send the spill journal in batches and truncate it once fully written
+    def _replay_spill(self):
+        lines = self._read_spill()
+        if lines is None:
+            return
+        for start in range(0, len(lines), self.batch_size):
+            if not self._send(lines[start:start + self.batch_size]):
+                return
+        self._clear_spill()
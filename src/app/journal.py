@@ -0,0 +1,226 @@
+import logging
+import os
+import re
+import threading
+import time
+
+import metrics
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+SEGMENT_NAME = re.compile(r"^(\d{12})\.lp$")
+CHECKPOINT = "checkpoint"
+
+sync_latency = metrics.histogram(
+    "slm_journal_sync_seconds", "Time taken to force the journal to disk"
+)
+
+
+# Write-ahead journal of InfluxDB points
+#
+# Every point is appended to the journal as a line of line protocol before
+# it is written anywhere else, and stays there until InfluxDB has
+# acknowledged it.  The journal is a directory of numbered segment files,
+# {directory}/000000000001.lp and so on, with a new segment started every
+# segment_size bytes and at every start, so a segment cut short by a crash
+# is never appended to.  A position in the journal is a (segment, offset)
+# tuple, and the checkpoint file holds the position up to which InfluxDB
+# has acknowledged every point.
+#
+# append() is a single unbuffered write, so a point survives the process
+# crashing as soon as append() returns; sync() forces everything appended
+# so far to disk and is called by the writer every sync_interval, so at
+# most that much is lost if the power fails.  Segments before the
+# checkpoint are deleted as soon as it moves past them.
+#
+# Points carry the timestamps they were sampled at, so sending a point
+# again after a crash or a failed write overwrites it in InfluxDB with the
+# same values rather than adding a duplicate.
+class SampleJournal:
+    def __init__(self, directory, segment_size=4 << 20, sync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_interval = sync_interval
+
+        self._lock = threading.Lock()
+        self._fd = None
+        self._synced_segment = None
+
+        # Counters
+        self.points_appended = 0
+        self.segments_compacted = 0
+
+        os.makedirs(directory, exist_ok=True)
+        segments = self._segments()
+        self.acknowledged = self._read_checkpoint() or (
+            (segments[0], 0) if segments else (1, 0)
+        )
+        self._compact()
+        self._segment = max(segments[-1] if segments else 0, self.acknowledged[0]) + 1
+        self._offset = 0
+        self._open_segment()
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.lp")
+
+    def _segments(self):
+        return sorted(
+            int(match.group(1))
+            for match in map(SEGMENT_NAME.match, os.listdir(self.directory))
+            if match
+        )
+
+    def _open_segment(self):
+        self._fd = os.open(
+            self._path(self._segment), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644
+        )
+
+    # Position after the last point appended
+    @property
+    def end(self):
+        return (self._segment, self._offset)
+
+    # True if some points have not been acknowledged yet
+    @property
+    def pending(self):
+        return self.acknowledged < self.end
+
+    # Append one point, returning the position after it
+    def append(self, line):
+        data = (line + "\n").encode()
+        with self._lock:
+            if self._offset and self._offset + len(data) > self.segment_size:
+                os.close(self._fd)
+                self._segment += 1
+                self._offset = 0
+                self._open_segment()
+            os.write(self._fd, data)
+            self._offset += len(data)
+            self.points_appended += 1
+            return (self._segment, self._offset)
+
+    # Append every point in a file, e.g. a spill file from before the
+    # journal, and then empty it
+    def import_file(self, path):
+        try:
+            with open(path, "r") as f:
+                lines = [line for line in f.read().splitlines() if line]
+        except FileNotFoundError:
+            return 0
+        for line in lines:
+            self.append(line)
+        self.sync()
+        open(path, "w").close()
+        if lines:
+            logger.info("Moved %d points from %s to the journal", len(lines), path)
+        return len(lines)
+
+    # Force every segment written since the last sync to disk.  Segments are
+    # opened again by name, so this never touches the descriptor append()
+    # may be rotating.
+    def sync(self):
+        started = time.monotonic()
+        last = self._segment
+        first = self._synced_segment or last
+        for segment in range(first, last + 1):
+            try:
+                fd = os.open(self._path(segment), os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._synced_segment = last
+        sync_latency.observe(time.monotonic() - started)
+
+    # Up to max_lines points from position on, and the position after them.
+    # A line without its newline is still being written, or was cut short
+    # by a crash if a later segment exists, in which case it is skipped.
+    def read(self, position, max_lines):
+        segment, offset = position
+        lines = []
+        while len(lines) < max_lines:
+            current = self._segment
+            try:
+                f = open(self._path(segment), "rb")
+            except FileNotFoundError:
+                if segment >= current:
+                    break
+                segment, offset = segment + 1, 0
+                continue
+            with f:
+                f.seek(offset)
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        if segment < current:
+                            logger.warning(
+                                "Skipping incomplete point at the end of %s", f.name
+                            )
+                        break
+                    offset += len(raw)
+                    # Power loss can leave zeros where the data should be
+                    line = raw.rstrip(b"\n").strip(b"\0").decode(errors="replace")
+                    if line:
+                        lines.append(line)
+                    if len(lines) >= max_lines:
+                        break
+            if len(lines) >= max_lines or segment >= current:
+                break
+            segment, offset = segment + 1, 0
+        return lines, (segment, offset)
+
+    # Record that InfluxDB has every point up to position and delete the
+    # segments before it.  The checkpoint is replaced atomically; if a crash
+    # loses the latest one the points after the previous one are sent again.
+    def acknowledge(self, position):
+        path = os.path.join(self.directory, CHECKPOINT)
+        with open(path + ".tmp", "w") as f:
+            f.write(f"{position[0]} {position[1]}\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        self.acknowledged = position
+        self._compact()
+
+    # Size of the points not yet acknowledged
+    def pending_bytes(self):
+        segment, offset = self.acknowledged
+        total = -offset
+        for pending in self._segments():
+            if pending >= segment:
+                try:
+                    total += os.path.getsize(self._path(pending))
+                except OSError:
+                    pass
+        return max(total, 0)
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, CHECKPOINT)) as f:
+                segment, offset = f.read().split()
+            return (int(segment), int(offset))
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            logger.error("Ignoring unreadable journal checkpoint, sending everything")
+            return None
+
+    def _compact(self):
+        for segment in self._segments():
+            if segment >= self.acknowledged[0]:
+                break
+            try:
+                os.remove(self._path(segment))
+                self.segments_compacted += 1
+            except OSError as e:
+                logger.error("Error removing journal segment %d: %s", segment, e)
+
+    def close(self):
+        with self._lock:
+            if self._fd is None:
+                return
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
@@ -0,0 +1,316 @@
+import argparse
+import configparser
+import logging
+import math
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pytz
+
+from analysis import ENERGY, format_ms, parse_chunk
+from csv_sink import INDEX_ENTRY
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# Time range queries over the daily CSV logs
+#
+# Each query finds the rows of a log from start up to (not including) end,
+# local times like the logs' own timestamps, in every daily file the range
+# covers.  The time index slm-log.py keeps beside each log gives the offset
+# of a row at most index_interval before the start, and rows are scanned
+# from there, so finding a time reads a few kB whatever the size of the
+# log; logs without an index are bisected by seeking through the file.
+# The rows in between are streamed back untouched, or parsed with numpy a
+# chunk at a time and aggregated into fixed intervals.
+
+TIMESTAMP_LENGTH = 23
+CHUNK_BYTES = 1 << 20
+# Bisection stops once the row is within this many bytes
+SCAN_BYTES = 4096
+INDEX_DTYPE = [("timestamp_ns", "<i8"), ("offset", "<i8")]
+LOG_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+# Entries of a log's time index, or None if it has none
+def read_index(path):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    # Drop an entry cut short by a crash
+    count = len(data) // INDEX_ENTRY.size
+    return np.frombuffer(data, dtype=INDEX_DTYPE, count=count)
+
+
+# Offset of a row at or before the first row at or after key, found by
+# bisecting the file when there is no index
+def bisect_file(f, size, key):
+    low, high = 0, size
+    while high - low > SCAN_BYTES:
+        middle = (low + high) // 2
+        f.seek(middle)
+        f.readline()
+        row = f.readline()
+        if not row or row[:TIMESTAMP_LENGTH] >= key:
+            high = middle
+        else:
+            low = middle
+    f.seek(low)
+    if low:
+        f.readline()
+    return f.tell()
+
+
+# Offset of the first row at or after a time, given both as ns since the
+# epoch (for the index) and as a local timestamp (for the rows)
+def find_offset(f, size, index, timestamp_ns, key):
+    if index is not None and len(index):
+        entry = np.searchsorted(index["timestamp_ns"], timestamp_ns, side="right") - 1
+        start = min(int(index["offset"][entry]), size) if entry >= 0 else 0
+    else:
+        start = bisect_file(f, size, key)
+    f.seek(start)
+    while True:
+        row = f.readline()
+        if not row or row[:TIMESTAMP_LENGTH] >= key:
+            return f.tell() - len(row)
+
+
+# Query over the logs in one directory
+class LogQuery:
+    def __init__(self, directory, tz):
+        self.directory = directory
+        self.tz = tz
+
+    # Daily log files covering a range of local datetimes, with the ns since
+    # the epoch and the row timestamp of each end of the range
+    def _files(self, log, start, end):
+        if not LOG_NAME.match(log):
+            raise ValueError(f"Invalid log name {log}")
+        bounds = []
+        for local in (start, end):
+            timestamp_ns = int(self.tz.localize(local).timestamp() * 1e9)
+            key = local.strftime("%Y-%m-%dT%H:%M:%S.%f")[:TIMESTAMP_LENGTH].encode()
+            bounds.append((timestamp_ns, key))
+        day = start.date()
+        while day <= end.date():
+            path = os.path.join(self.directory, f"{day:%Y-%m-%d}-{log}")
+            if os.path.exists(f"{path}.csv"):
+                yield f"{path}.csv", f"{path}.idx", bounds
+            day += timedelta(days=1)
+
+    # Byte ranges of the rows from start up to end in each daily log
+    def ranges(self, log, start, end):
+        for path, index_path, bounds in self._files(log, start, end):
+            index = read_index(index_path)
+            with open(path, "rb") as f:
+                size = os.fstat(f.fileno()).st_size
+                first = find_offset(f, size, index, *bounds[0])
+                last = find_offset(f, size, index, *bounds[1])
+            if last > first:
+                yield path, first, last
+
+    # Chunks of whole rows from start up to end
+    def chunks(self, log, start, end, chunk_bytes=CHUNK_BYTES):
+        for path, first, last in self.ranges(log, start, end):
+            with open(path, "rb") as f:
+                f.seek(first)
+                remaining = last - first
+                partial = b""
+                while remaining:
+                    data = f.read(min(chunk_bytes, remaining))
+                    if not data:
+                        break
+                    remaining -= len(data)
+                    cut = data.rfind(b"\n") + 1
+                    if not cut:
+                        partial += data
+                        continue
+                    yield partial + data[:cut]
+                    partial = data[cut:]
+                if partial:
+                    yield partial + b"\n"
+
+    # Rows of Leq, Lmax, Lmin and count for every interval_ms of local time
+    # from start up to end, as CSV lines
+    def aggregate(self, log, start, end, interval_ms):
+        compliance = "compliance" in log
+        pending = None
+        for chunk in self.chunks(log, start, end):
+            timestamp_ms, level, maximum, minimum = parse_chunk(chunk, compliance)
+            if not len(timestamp_ms):
+                continue
+            bins = timestamp_ms // interval_ms
+            starts = np.flatnonzero(np.r_[True, bins[1:] != bins[:-1]])
+            intervals = [
+                list(interval)
+                for interval in zip(
+                    bins[starts].tolist(),
+                    np.add.reduceat(ENERGY[level], starts).tolist(),
+                    np.diff(np.r_[starts, len(bins)]).tolist(),
+                    np.maximum.reduceat(maximum, starts).tolist(),
+                    np.minimum.reduceat(minimum, starts).tolist(),
+                )
+            ]
+            # An interval split across chunks is merged before it is written
+            if pending is not None:
+                if pending[0] == intervals[0][0]:
+                    first = intervals[0]
+                    first[1] += pending[1]
+                    first[2] += pending[2]
+                    first[3] = max(first[3], pending[3])
+                    first[4] = min(first[4], pending[4])
+                else:
+                    yield format_interval(pending, interval_ms)
+            pending = intervals.pop()
+            for interval in intervals:
+                yield format_interval(interval, interval_ms)
+        if pending is not None:
+            yield format_interval(pending, interval_ms)
+
+    # CSV output for a query, raw rows unless an interval is given
+    def query(self, log, start, end, interval_ms=None):
+        if interval_ms:
+            for line in self.aggregate(log, start, end, interval_ms):
+                yield line.encode()
+        else:
+            yield from self.chunks(log, start, end)
+
+
+def format_interval(interval, interval_ms):
+    bin_index, energy, count, maximum, minimum = interval
+    leq = 10 * math.log10(energy / count)
+    return (
+        f"{format_ms(bin_index * interval_ms)},{leq:.1f},{maximum / 10},"
+        f"{minimum / 10},{count}\n"
+    )
+
+
+# Local datetime from e.g. 2024-05-04T14:32:05 or "2024-05-04 14:32"
+def parse_time(value):
+    return datetime.fromisoformat(value)
+
+
+# Start and end of a query; the end defaults to one minute after the start
+def parse_range(start, end=None):
+    start = parse_time(start)
+    end = parse_time(end) if end else start + timedelta(minutes=1)
+    if end <= start:
+        raise ValueError("end must be after start")
+    return start, end
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    log_query = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/query":
+            self.send_error(404)
+            return
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            start, end = parse_range(params["start"], params.get("end"))
+            interval = params.get("aggregate")
+            interval_ms = round(float(interval) * 1000) if interval else None
+            chunks = self.log_query.query(
+                params.get("log", "noise"), start, end, interval_ms
+            )
+            # Find the first rows before answering, so errors get a 400
+            first = next(chunks, b"")
+        except (KeyError, ValueError) as e:
+            self.send_error(400, f"Bad query: {e}")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/csv; charset=utf-8")
+        self.end_headers()
+        try:
+            self.wfile.write(first)
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+# Serve /query?start=...&end=...&log=...&aggregate=... until interrupted
+def serve(log_query, address, port):
+    handler = type("Handler", (QueryHandler,), {"log_query": log_query})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    logger.info("Serving log queries on http://%s:%d/query", address, port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    # Default to the logger's logs and time zone
+    config = configparser.ConfigParser()
+    config.read("slm-log.ini")
+
+    parser = argparse.ArgumentParser(
+        description="Look up the levels logged over a time range"
+    )
+    parser.add_argument("start", nargs="?", help="local time, e.g. 2024-05-04T14:32:05")
+    parser.add_argument("end", nargs="?", help="local time (default: start + 1 minute)")
+    parser.add_argument(
+        "--log",
+        default="noise",
+        help="log name, e.g. noise, noise-compliance or noise-pit-lane",
+    )
+    parser.add_argument(
+        "--aggregate",
+        type=float,
+        help="Leq, Lmax, Lmin and count per this many seconds",
+    )
+    parser.add_argument(
+        "--directory", default=config.get("CSV", "directory", fallback="logs")
+    )
+    parser.add_argument(
+        "--timezone", default=config.get("Monitoring", "timezone", fallback="UTC")
+    )
+    parser.add_argument("--serve", action="store_true", help="serve queries over HTTP")
+    parser.add_argument(
+        "--address", default=config.get("Query", "address", fallback="127.0.0.1")
+    )
+    parser.add_argument(
+        "--port", type=int, default=config.getint("Query", "port", fallback=8090)
+    )
+    args = parser.parse_args()
+
+    log_query = LogQuery(args.directory, pytz.timezone(args.timezone))
+    if args.serve:
+        serve(log_query, args.address, args.port)
+        return
+    if not args.start:
+        parser.error("a start time is required unless serving")
+    try:
+        start, end = parse_range(args.start, args.end)
+    except ValueError as e:
+        parser.error(str(e))
+    interval_ms = round(args.aggregate * 1000) if args.aggregate else None
+    try:
+        for chunk in log_query.query(args.log, start, end, interval_ms):
+            sys.stdout.buffer.write(chunk)
+    except BrokenPipeError:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# Metrics by name, in registration order
+REGISTRY = {}
+
+# Default histogram buckets in seconds, from 100 us to 10 s
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus-style metrics
+#
+# Updating a metric is a plain attribute increment so it can sit on the hot
+# path; everything else happens when the endpoint is scraped.  A metric can
+# also be given a function returning its value, for counters that already
+# live elsewhere (e.g. SerialReader.reconnects), which costs nothing until
+# it is scraped.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, function=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        value = self.function() if self.function else self.value
+        yield self.name, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield f'{self.name}_bucket{{le="{format_value(bound)}"}}', total
+        yield f"{self.name}_sum", self.sum
+        yield f"{self.name}_count", total
+
+
+def _register(metric):
+    REGISTRY[metric.name] = metric
+    return metric
+
+
+def counter(name, documentation, function=None):
+    return _register(Counter(name, documentation, function))
+
+
+def gauge(name, documentation, function=None):
+    return _register(Gauge(name, documentation, function))
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, documentation, buckets))
+
+
+# All metrics in the Prometheus text exposition format
+def exposition():
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        try:
+            for name, value in metric.samples():
+                lines.append(f"{name} {format_value(value)}")
+        except Exception as e:
+            logger.debug("Error collecting %s: %s", metric.name, e)
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve /metrics from a background thread
+def start_server(address, port):
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on http://%s:%d/metrics", address, port)
+    return server
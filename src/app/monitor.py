@@ -0,0 +1,353 @@
+import argparse
+import configparser
+import curses
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from datetime import datetime
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+
+# --------------------- Logger side ---------------------
+
+
+# Serves snapshots of the logger's state to live monitors over a Unix socket
+#
+# A background thread calls snapshot() every interval seconds, but only
+# while a monitor is connected, and sends the result as one line of JSON to
+# every monitor.  Nothing is done per frame: snapshot() reads state the
+# sample loop has already computed.  Sends never block; a monitor that
+# falls so far behind that its socket buffer fills is disconnected.
+class MonitorServer:
+    def __init__(self, socket_path, snapshot, interval=0.25, max_clients=8):
+        self.socket_path = socket_path
+        self.snapshot = snapshot
+        self.interval = interval
+        self.max_clients = max_clients
+
+        self._server = None
+        self._clients = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+        # Counters
+        self.snapshots_sent = 0
+        self.clients_dropped = 0
+
+    @property
+    def clients(self):
+        return len(self._clients)
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(self.socket_path)
+        self._server.listen()
+        threading.Thread(
+            target=self._accept, name="monitor-server", daemon=True
+        ).start()
+        threading.Thread(
+            target=self._publish, name="monitor-publisher", daemon=True
+        ).start()
+        logger.info("Serving the live monitor on %s", self.socket_path)
+        return self
+
+    def close(self):
+        self._stopping.set()
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        with self._lock:
+            for conn in self._clients:
+                conn.close()
+            self._clients = []
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def _accept(self):
+        while self._server is not None:
+            try:
+                conn, _ = self._server.accept()
+            except OSError:
+                return
+            with self._lock:
+                if len(self._clients) >= self.max_clients:
+                    logger.warning("Too many monitors, refusing another")
+                    conn.close()
+                    continue
+                conn.setblocking(False)
+                self._clients.append(conn)
+            logger.info("Monitor connected, %d watching", len(self._clients))
+
+    def _publish(self):
+        next_send = time.monotonic()
+        while not self._stopping.is_set():
+            next_send += self.interval
+            self._stopping.wait(max(next_send - time.monotonic(), 0))
+            if not self._clients:
+                # Nobody watching, don't fall behind while idle
+                next_send = time.monotonic()
+                continue
+            try:
+                data = (json.dumps(self.snapshot()) + "\n").encode()
+            except Exception as e:
+                logger.error("Error taking monitor snapshot: %s", e)
+                continue
+            with self._lock:
+                for conn in list(self._clients):
+                    try:
+                        sent = conn.send(data)
+                    except OSError:
+                        sent = 0
+                    if sent < len(data):
+                        # Gone, or too far behind to catch up
+                        self._clients.remove(conn)
+                        self.clients_dropped += 1
+                        conn.close()
+                        logger.info(
+                            "Monitor disconnected, %d watching", len(self._clients)
+                        )
+            self.snapshots_sent += 1
+
+
+# --------------------- Monitor side ---------------------
+
+STATE_LABELS = {"idle": "OK", "pending": "OVER LIMIT", "active": "VIOLATION"}
+
+# Screen layout: header rows, then a block of rows per meter
+HEADER_ROWS = 3
+METER_ROWS = 5
+
+
+def format_level(dB):
+    return "  --.-" if dB is None else f"{dB:6.1f}"
+
+
+def format_bytes(size):
+    for unit in ("B", "kB", "MB"):
+        if size < 1000:
+            return f"{size:.0f} {unit}"
+        size /= 1000
+    return f"{size:.1f} GB"
+
+
+def format_time(timestamp_ns):
+    return datetime.fromtimestamp(timestamp_ns / 1e9).strftime("%H:%M:%S")
+
+
+# Terminal screen that only redraws what changed
+#
+# Every piece of text is drawn in a fixed-width field, and the last text
+# and attribute drawn at each position is remembered; put() does nothing if
+# a field has not changed, and the changes for a frame go to the terminal
+# in one update.
+class MonitorScreen:
+    def __init__(self, stdscr):
+        self.stdscr = stdscr
+        self._drawn = {}
+        self.colours = {"OK": 0, "OVER LIMIT": 0, "VIOLATION": curses.A_REVERSE}
+        if curses.has_colors():
+            curses.start_color()
+            curses.use_default_colors()
+            curses.init_pair(1, curses.COLOR_GREEN, -1)
+            curses.init_pair(2, curses.COLOR_YELLOW, -1)
+            curses.init_pair(3, curses.COLOR_RED, -1)
+            self.colours = {
+                "OK": curses.color_pair(1),
+                "OVER LIMIT": curses.color_pair(2) | curses.A_BOLD,
+                "VIOLATION": curses.color_pair(3) | curses.A_BOLD | curses.A_REVERSE,
+            }
+
+    def put(self, row, col, text, width, attr=0):
+        text = text[:width].ljust(width)
+        if self._drawn.get((row, col)) == (text, attr):
+            return
+        height, screen_width = self.stdscr.getmaxyx()
+        if row >= height or col >= screen_width:
+            return
+        try:
+            self.stdscr.addstr(row, col, text[: screen_width - col], attr)
+        except curses.error:
+            # Writing the bottom right corner moves the cursor off screen
+            pass
+        self._drawn[(row, col)] = (text, attr)
+
+    # Forget what was drawn, e.g. after the terminal is resized
+    def invalidate(self):
+        self._drawn.clear()
+        self.stdscr.erase()
+
+    def update(self):
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def show_message(self, message):
+        self.put(1, 0, message, 78)
+
+    def render(self, snapshot, received):
+        self.put(0, 0, "Sound Level Monitor", 30, curses.A_BOLD)
+        self.put(0, 58, format_time(snapshot["time_ns"]), 20)
+        age = time.monotonic() - received
+        self.show_message("" if age < 5 else f"No update for {age:.0f} s")
+
+        health = snapshot["health"]
+        self.put(
+            2,
+            0,
+            f"InfluxDB queue {health['influx_queue']}  "
+            f"dropped {health['influx_dropped']}  "
+            f"journal {format_bytes(health['journal_pending_bytes'])}  "
+            f"overruns {health['overruns']}  reconnects {health['reconnects']}  "
+            f"alerts {health['alerts_queued']}",
+            80,
+        )
+
+        for index, meter in enumerate(snapshot["meters"]):
+            row = HEADER_ROWS + index * METER_ROWS
+            self.put(row, 0, meter["location"], 40, curses.A_BOLD)
+            label = STATE_LABELS.get(meter["state"], meter["state"])
+            self.put(row, 40, label, 12, self.colours.get(label, 0))
+            since = ""
+            if meter["episode_start_ns"] is not None:
+                since = (
+                    f"since {format_time(meter['episode_start_ns'])}, "
+                    f"peak {meter['episode_peak']:.1f}"
+                )
+            self.put(row, 53, since, 27)
+            self.put(
+                row + 1,
+                2,
+                f"dB {format_level(meter['dB'])}   "
+                f"Median {format_level(meter['median'])}   "
+                f"Leq {format_level(meter['leq'])}   "
+                f"Limit {meter['limit']:.1f}",
+                78,
+                curses.A_BOLD,
+            )
+            self.put(
+                row + 2,
+                2,
+                f"{meter['statistic'].capitalize()} over the {meter['window']}: "
+                f"{format_level(meter['window_dB']).strip()}",
+                78,
+            )
+            sample_age = meter["sample_age"]
+            self.put(
+                row + 3,
+                2,
+                f"Range {meter['range'] or 'unknown'}  "
+                f"{meter['speed'] or 'speed unknown'}  {meter['status']}",
+                50,
+            )
+            self.put(
+                row + 3,
+                52,
+                "no samples"
+                if sample_age is None
+                else f"sample {sample_age:.1f} s ago",
+                26,
+            )
+
+
+# Connect to the logger, or return None if it is not running
+def connect(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        return None
+    conn.setblocking(False)
+    return conn
+
+
+# Show the logger's state until interrupted, redrawing at most fps times a
+# second and only when a new snapshot has arrived
+def run(stdscr, socket_path, fps):
+    curses.curs_set(0)
+    screen = MonitorScreen(stdscr)
+    frame_interval = 1 / fps
+    conn = None
+    buffer = b""
+    snapshot = None
+    received = 0.0
+    dirty = True
+    next_frame = time.monotonic()
+    size = stdscr.getmaxyx()
+
+    while True:
+        if conn is None:
+            conn = connect(socket_path)
+            if conn is None:
+                screen.show_message(f"Waiting for slm-log.py on {socket_path}")
+                screen.update()
+                time.sleep(1)
+                continue
+            buffer = b""
+
+        # Read whatever arrives until the next frame is due
+        timeout = max(next_frame - time.monotonic(), 0)
+        readable, _, _ = select.select([conn], [], [], timeout)
+        if readable:
+            try:
+                data = conn.recv(65536)
+            except OSError:
+                data = b""
+            if not data:
+                conn.close()
+                conn = None
+                continue
+            buffer += data
+            *lines, buffer = buffer.split(b"\n")
+            if lines:
+                # Only the latest snapshot is worth drawing
+                snapshot = json.loads(lines[-1])
+                received = time.monotonic()
+                dirty = True
+            continue
+
+        next_frame += frame_interval
+        if next_frame < time.monotonic():
+            next_frame = time.monotonic() + frame_interval
+        # Nothing reads keys, so curses never sees the resize itself
+        terminal = os.get_terminal_size()
+        if (terminal.lines, terminal.columns) != size:
+            size = (terminal.lines, terminal.columns)
+            curses.resizeterm(*size)
+            screen.invalidate()
+            dirty = True
+        if snapshot is not None and (dirty or time.monotonic() - received >= 5):
+            screen.render(snapshot, received)
+            screen.update()
+            dirty = False
+
+
+def main():
+    config = configparser.ConfigParser()
+    config.read("slm-log.ini")
+    default_socket = config.get("Monitor", "socket", fallback="slm-monitor.sock")
+
+    parser = argparse.ArgumentParser(
+        description="Live view of a running slm-log.py in the terminal"
+    )
+    parser.add_argument("--socket", default=default_socket)
+    parser.add_argument(
+        "--fps", type=float, default=4, help="screen updates per second (default 4)"
+    )
+    args = parser.parse_args()
+
+    try:
+        curses.wrapper(run, args.socket, args.fps)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,445 @@
+import argparse
+import bisect
+import configparser
+import csv
+import logging
+import os
+import socket
+import threading
+from collections import deque, namedtuple
+from datetime import datetime, timezone
+
+import pytz
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# A car crossing the timing loop: time in ns since the epoch, car number
+# and transponder
+Passing = namedtuple("Passing", ["timestamp_ns", "car", "transponder"])
+
+# A passing with the time it was expected at the meter and the loudest
+# logged sample within the tolerance of that time (None if there was none)
+PassingLevel = namedtuple(
+    "PassingLevel", ["passing", "expected_ns", "peak_db", "peak_ns"]
+)
+
+# Column names recognised in timing exports, lower case
+TIME_COLUMNS = ("timestamp", "time", "passing_time", "time_of_day")
+CAR_COLUMNS = ("car", "number", "car_number", "no")
+TRANSPONDER_COLUMNS = ("transponder", "transponder_id", "tx")
+
+PASSING_FIELDS = [
+    "passing_time", "car", "transponder", "expected_time", "peak", "peak_time",
+]
+
+
+# ns since the epoch of a time from the timing system, either seconds since
+# the epoch or an ISO time, taken as local time in tz unless it has an offset
+def parse_timestamp(value, tz):
+    value = value.strip()
+    try:
+        return round(float(value) * 1e6) * 1000
+    except ValueError:
+        pass
+    moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if moment.tzinfo is None:
+        moment = tz.localize(moment)
+    return round(moment.timestamp() * 1e6) * 1000
+
+
+# One line of the live feed, transponder,car,timestamp.  The car and
+# transponder are written to the CSV logs, so they must be printable ASCII.
+def parse_passing(line, tz):
+    transponder, car, timestamp = (field.strip() for field in line.split(","))
+    for field in (transponder, car):
+        if not (field.isascii() and field.isprintable()):
+            raise ValueError(f"invalid field {field!r}")
+    if not car:
+        raise ValueError("no car number")
+    return Passing(parse_timestamp(timestamp, tz), car, transponder)
+
+
+# Streaming join of timing loop passings with the logged samples and the
+# violation episodes of one meter
+#
+# A car crossing the loop at t is expected at the meter at t + offset
+# (negative if the meter is before the loop), and is matched with anything
+# within tolerance of that time.  Passings are kept sorted by expected
+# time, so both joins are sorted merges:
+#   add_sample() feeds the samples in time order and returns each passing
+#     whose window has closed, with the loudest sample in its window
+#   cars() lists the cars expected during an episode, nearest its peak
+#     first
+# A passing can arrive after the car has passed the meter (the meter is
+# before the loop, or the timing system is slow), so the samples of the
+# last few seconds are kept to start its window from.  Likewise an episode
+# can only be matched once every passing that could belong to it has
+# arrived.  hold() keeps an item until the sample clock passes the
+# last loop time that could still match, plus feed_delay for the timing
+# system to report it, and release() hands back the items that are ready.
+#
+# Passings are forgotten once they are retention seconds old, except those
+# an episode may still be matched with: keep() marks the start of the
+# episode in progress, and held items keep theirs until released.
+#
+# Passings arrive from the feed thread, so everything is under one lock.
+class PassingJoin:
+    def __init__(self, offset=0.0, tolerance=3.0, feed_delay=1.0, retention=600.0):
+        self.offset_ns = int(offset * 1e9)
+        self.tolerance_ns = int(tolerance * 1e9)
+        self.feed_delay_ns = int(feed_delay * 1e9)
+        self.retention_ns = int(retention * 1e9)
+
+        self._lock = threading.Lock()
+        # Expected times at the meter, and the passings in the same order
+        self._expected = []
+        self._passings = []
+        # Passings whose window is still open: [expected_ns, passing, peak
+        # in tenths of a dB, time of peak]
+        self._open = []
+        # Items waiting for their passings: (release_ns, start_ns, item)
+        self._held = deque()
+        # Start of the episode in progress, None if there is none
+        self._keep_ns = None
+        # Recent samples, (timestamp_ns, tenths of a dB), for passings that
+        # arrive late
+        self._recent = deque()
+        self._history_ns = (
+            2 * self.tolerance_ns + max(-self.offset_ns, 0) + self.feed_delay_ns
+        )
+
+    def add(self, passing):
+        expected_ns = passing.timestamp_ns + self.offset_ns
+        window = [expected_ns, passing, -1, None]
+        with self._lock:
+            index = bisect.bisect_right(self._expected, expected_ns)
+            self._expected.insert(index, expected_ns)
+            self._passings.insert(index, passing)
+            # The part of the window already logged
+            for timestamp_ns, deci_db in self._recent:
+                if abs(timestamp_ns - expected_ns) <= self.tolerance_ns:
+                    if deci_db > window[2]:
+                        window[2] = deci_db
+                        window[3] = timestamp_ns
+            index = bisect.bisect_right([w[0] for w in self._open], expected_ns)
+            self._open.insert(index, window)
+
+    def add_sample(self, timestamp_ns, dB):
+        completed = []
+        deci_db = round(dB * 10)
+        tolerance_ns = self.tolerance_ns
+        with self._lock:
+            windows = self._open
+            # Every window is the same width, so they close in order
+            while windows and windows[0][0] + tolerance_ns < timestamp_ns:
+                completed.append(passing_level(windows.pop(0)))
+            for window in windows:
+                if window[0] - tolerance_ns > timestamp_ns:
+                    break
+                if deci_db > window[2]:
+                    window[2] = deci_db
+                    window[3] = timestamp_ns
+            recent = self._recent
+            recent.append((timestamp_ns, deci_db))
+            while recent[0][0] < timestamp_ns - self._history_ns:
+                recent.popleft()
+            oldest_ns = timestamp_ns - self.retention_ns
+            if self._keep_ns is not None:
+                oldest_ns = min(oldest_ns, self._keep_ns - self.tolerance_ns)
+            if self._held:
+                oldest_ns = min(oldest_ns, self._held[0][1] - self.tolerance_ns)
+            self._trim(oldest_ns)
+        return completed
+
+    # Every passing whose window is still open, e.g. when logging stops
+    def flush(self):
+        with self._lock:
+            windows, self._open = self._open, []
+        return [passing_level(window) for window in windows]
+
+    # Cars expected at the meter between start and end (within the
+    # tolerance), nearest to around first
+    def cars(self, start_ns, end_ns, around_ns):
+        with self._lock:
+            low = bisect.bisect_left(self._expected, start_ns - self.tolerance_ns)
+            high = bisect.bisect_right(self._expected, end_ns + self.tolerance_ns)
+            candidates = sorted(
+                range(low, high), key=lambda i: abs(self._expected[i] - around_ns)
+            )
+            cars = [self._passings[i].car for i in candidates]
+        return list(dict.fromkeys(cars))
+
+    # Keep the passings from start_ns on, for an episode that has started
+    def keep(self, start_ns):
+        with self._lock:
+            self._keep_ns = start_ns
+
+    # Keep item, an episode from start to end, until every passing that
+    # could match it has arrived
+    def hold(self, start_ns, end_ns, item):
+        release_ns = end_ns + self.tolerance_ns - self.offset_ns + self.feed_delay_ns
+        with self._lock:
+            self._held.append((max(release_ns, end_ns), start_ns, item))
+            self._keep_ns = None
+
+    # Items held until now_ns or earlier, or every item if now_ns is None
+    def release(self, now_ns=None):
+        released = []
+        with self._lock:
+            held = self._held
+            while held and (now_ns is None or held[0][0] <= now_ns):
+                released.append(held.popleft()[2])
+        return released
+
+    # Forget passings expected before oldest_ns
+    def _trim(self, oldest_ns):
+        if self._expected and self._expected[0] < oldest_ns:
+            index = bisect.bisect_left(self._expected, oldest_ns)
+            del self._expected[:index]
+            del self._passings[:index]
+
+
+# PassingLevel of a closed window
+def passing_level(window):
+    expected_ns, passing, peak, peak_ns = window
+    return PassingLevel(passing, expected_ns, peak / 10 if peak >= 0 else None, peak_ns)
+
+
+# Accepts passings from the timing system over TCP, one
+# transponder,car,timestamp line each, and hands them to a callback
+class PassingFeed:
+    def __init__(self, address, port, callback, tz):
+        self.address = address
+        self.port = port
+        self.callback = callback
+        self.tz = tz
+        self._server = None
+
+        # Counters
+        self.passings_received = 0
+        self.lines_rejected = 0
+
+    def start(self):
+        self._server = socket.create_server((self.address, self.port))
+        threading.Thread(target=self._accept, name="passing-feed", daemon=True).start()
+        logger.info("Listening for passings on %s:%d", self.address, self.port)
+        return self
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    def _accept(self):
+        while self._server is not None:
+            try:
+                conn, peer = self._server.accept()
+            except OSError:
+                return
+            logger.info("Timing feed connected from %s", peer[0])
+            threading.Thread(
+                target=self._serve, args=(conn,), name="passing-connection", daemon=True
+            ).start()
+
+    def _serve(self, conn):
+        # Bytes that are not UTF-8 are replaced, and the line rejected
+        with conn, conn.makefile("r", encoding="utf-8", errors="replace") as reader:
+            try:
+                for line in reader:
+                    if not line.strip():
+                        continue
+                    try:
+                        passing = parse_passing(line, self.tz)
+                    except ValueError:
+                        self.lines_rejected += 1
+                        logger.warning("Ignoring malformed passing: %r", line.strip())
+                        continue
+                    self.passings_received += 1
+                    self.callback(passing)
+            except OSError as e:
+                logger.warning("Timing feed disconnected: %s", e)
+
+
+# --------------------- Batch ---------------------
+
+
+# Passings from a timing export, sorted by time.  The export is a CSV file
+# with a header naming the time, car and transponder columns, or with no
+# header and the columns transponder,car,timestamp like the live feed.
+def read_passings(path, tz):
+    with open(path, newline="") as f:
+        rows = list(csv.reader(f))
+    if not rows:
+        return []
+    header = [name.strip().lower() for name in rows[0]]
+
+    def column(names):
+        return next((header.index(name) for name in names if name in header), None)
+
+    time_index = column(TIME_COLUMNS)
+    car_index = column(CAR_COLUMNS)
+    transponder_index = column(TRANSPONDER_COLUMNS)
+    if time_index is None or car_index is None:
+        transponder_index, car_index, time_index = 0, 1, 2
+    else:
+        rows = rows[1:]
+
+    passings = []
+    for row in rows:
+        try:
+            timestamp_ns = parse_timestamp(row[time_index], tz)
+        except (IndexError, ValueError):
+            continue
+        transponder = ""
+        if transponder_index is not None:
+            transponder = row[transponder_index].strip()
+        passings.append(Passing(timestamp_ns, row[car_index].strip(), transponder))
+    passings.sort()
+    return passings
+
+
+# Local milliseconds since 1970-01-01T00:00, as the logs' timestamps are
+# read by analysis.parse_chunk
+def local_ms(timestamp_ns, tz):
+    moment = datetime.fromtimestamp(timestamp_ns / 1e9, tz)
+    return round(moment.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+# Loudest logged sample within tolerance_ms of each expected time (local ms,
+# sorted), reading the noise logs a chunk at a time.  Returns the peaks in
+# tenths of a dB (-1 where there were no samples) and their times.
+def join_levels(paths, expected_ms, tolerance_ms):
+    # Imported here so the logger itself does not need NumPy
+    import numpy as np
+
+    from analysis import parse_chunk, read_chunks
+
+    expected_ms = np.asarray(expected_ms, dtype=np.int64)
+    peaks = np.full(len(expected_ms), -1, dtype=np.int64)
+    peak_ms = np.zeros(len(expected_ms), dtype=np.int64)
+    for chunk in read_chunks(paths):
+        timestamp_ms, level, _, _ = parse_chunk(chunk)
+        if not len(timestamp_ms):
+            continue
+        # Sorted merge: the window of each passing as a slice of the chunk
+        low = np.searchsorted(timestamp_ms, expected_ms - tolerance_ms, "left")
+        high = np.searchsorted(timestamp_ms, expected_ms + tolerance_ms, "right")
+        for index in np.flatnonzero(high > low).tolist():
+            window = level[low[index] : high[index]]
+            loudest = int(window.argmax())
+            if window[loudest] > peaks[index]:
+                peaks[index] = window[loudest]
+                peak_ms[index] = timestamp_ms[low[index] + loudest]
+    return peaks, peak_ms
+
+
+# Cars expected during each episode (start, end and peak in local ms),
+# nearest the peak first
+def join_episodes(episodes, expected_ms, cars, tolerance_ms):
+    results = []
+    for start_ms, end_ms, peak_ms in episodes:
+        low = bisect.bisect_left(expected_ms, start_ms - tolerance_ms)
+        high = bisect.bisect_right(expected_ms, end_ms + tolerance_ms)
+        nearest = sorted(range(low, high), key=lambda i: abs(expected_ms[i] - peak_ms))
+        results.append(list(dict.fromkeys(cars[i] for i in nearest)))
+    return results
+
+
+# Local ms of a log timestamp, e.g. 2024-05-04T14:32:05.250
+def parse_log_time(value):
+    moment = datetime.fromisoformat(value).replace(tzinfo=timezone.utc)
+    return round(moment.timestamp() * 1000)
+
+
+def format_log_time(timestamp_ms):
+    moment = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc)
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+def main():
+    # Default to the logger's time zone and timing settings
+    config = configparser.ConfigParser()
+    config.read("slm-log.ini")
+
+    parser = argparse.ArgumentParser(
+        description="Match a timing export against the noise and violation logs"
+    )
+    parser.add_argument("export", help="timing export, CSV of passings")
+    parser.add_argument(
+        "--violations", nargs="*", default=[], help="e.g. logs/*-violations.csv"
+    )
+    parser.add_argument("--noise", nargs="*", default=[], help="e.g. logs/*-noise.csv")
+    parser.add_argument(
+        "--offset",
+        type=float,
+        default=config.getint("Timing", "offset", fallback=0) / 1000,
+        help="seconds from the timing loop to the meter",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=config.getint("Timing", "tolerance", fallback=3000) / 1000,
+        help="seconds either side of the expected time",
+    )
+    parser.add_argument(
+        "--timezone", default=config.get("Monitoring", "timezone", fallback="UTC")
+    )
+    parser.add_argument("--output", default=".", help="directory for the results")
+    args = parser.parse_args()
+
+    tz = pytz.timezone(args.timezone)
+    passings = read_passings(args.export, tz)
+    offset_ms = round(args.offset * 1000)
+    tolerance_ms = round(args.tolerance * 1000)
+    expected_ms = [local_ms(p.timestamp_ns, tz) + offset_ms for p in passings]
+    order = sorted(range(len(passings)), key=expected_ms.__getitem__)
+    passings = [passings[i] for i in order]
+    expected_ms = [expected_ms[i] for i in order]
+    cars = [passing.car for passing in passings]
+    os.makedirs(args.output, exist_ok=True)
+    print(f"{len(passings)} passings from {args.export}")
+
+    # Each violation with the cars expected during it
+    rows = []
+    for path in args.violations:
+        with open(path, newline="") as f:
+            rows.extend(row[:7] for row in csv.reader(f) if len(row) >= 7)
+    episodes = [
+        (parse_log_time(row[0]), parse_log_time(row[1]), parse_log_time(row[4]))
+        for row in rows
+    ]
+    matches = join_episodes(episodes, expected_ms, cars, tolerance_ms)
+    path = os.path.join(args.output, "violations-cars.csv")
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f, lineterminator="\n")
+        for row, match in zip(rows, matches):
+            writer.writerow(row + [" ".join(match)])
+    matched = sum(1 for match in matches if match)
+    print(f"{matched} of {len(rows)} violations matched to cars, written to {path}")
+
+    # Each passing with the loudest level logged near it
+    if args.noise:
+        peaks, peak_ms = join_levels(sorted(args.noise), expected_ms, tolerance_ms)
+        path = os.path.join(args.output, "passings.csv")
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f, lineterminator="\n")
+            writer.writerow(PASSING_FIELDS)
+            for passing, expected, peak, peak_time in zip(
+                passings, expected_ms, peaks.tolist(), peak_ms.tolist()
+            ):
+                writer.writerow(
+                    [
+                        format_log_time(expected - offset_ms),
+                        passing.car,
+                        passing.transponder,
+                        format_log_time(expected),
+                        peak / 10 if peak >= 0 else "",
+                        format_log_time(peak_time) if peak >= 0 else "",
+                    ]
+                )
+        print(f"Peak level of each passing written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+from collections import namedtuple
+
+# Frames from the meter are separated by 0xA5 (165 -> '¥').  The first byte
+# of each frame is a key identifying what the rest of the frame holds.
+DELIMITER = 0xA5
+
+KEY_DB = 0x0D
+KEY_FAST = 0x02
+KEY_SLOW = 0x03
+KEY_MAX = 0x04
+KEY_MIN = 0x05
+KEY_RECORD_ON = 0x0A
+KEY_RECORD_OFF = 0x1A
+KEY_RANGE_50_100 = 0x4B
+KEY_RANGE_80_130 = 0x4C
+KEY_RANGE_30_130 = 0x40
+KEY_RANGE_30_80 = 0x30
+
+# Typed frames yielded by the decoder
+DbFrame = namedtuple("DbFrame", ["dB"])
+RangeFrame = namedtuple("RangeFrame", ["low", "high"])
+SpeedFrame = namedtuple("SpeedFrame", ["speed"])
+MinMaxFrame = namedtuple("MinMaxFrame", ["mode"])
+RecordFrame = namedtuple("RecordFrame", ["on"])
+ShortFrame = namedtuple("ShortFrame", ["key", "payload"])
+UnknownFrame = namedtuple("UnknownFrame", ["key", "payload"])
+
+
+# Get the high and low nibbles of a byte
+def get_high_nibble(byte):
+    return (byte & 0xF0) >> 4
+
+
+def get_low_nibble(byte):
+    return byte & 0x0F
+
+
+# Tenths of a dB held by each value of the two BCD bytes of a dB frame: the
+# high byte holds the hundreds and tens, the low byte the ones and tenths
+BCD_HIGH_DECI = tuple(
+    get_high_nibble(byte) * 1000 + get_low_nibble(byte) * 100 for byte in range(256)
+)
+BCD_LOW_DECI = tuple(
+    get_high_nibble(byte) * 10 + get_low_nibble(byte) for byte in range(256)
+)
+
+
+# Convert the two BCD bytes of a dB frame to a value in dB
+def bcd_to_db(high, low):
+    return (BCD_HIGH_DECI[high] + BCD_LOW_DECI[low]) / 10
+
+
+# Status frames carry no data, so one shared instance of each is reused
+STATUS_FRAMES = {
+    KEY_FAST: SpeedFrame("FAST"),
+    KEY_SLOW: SpeedFrame("SLOW"),
+    KEY_RANGE_50_100: RangeFrame(50, 100),
+    KEY_RANGE_80_130: RangeFrame(80, 130),
+    KEY_RANGE_30_130: RangeFrame(30, 130),
+    KEY_RANGE_30_80: RangeFrame(30, 80),
+    KEY_MAX: MinMaxFrame("MAX"),
+    KEY_MIN: MinMaxFrame("MIN"),
+    KEY_RECORD_ON: RecordFrame(True),
+    KEY_RECORD_OFF: RecordFrame(False),
+}
+
+
+# Status frame for every possible key, None for dB and unknown keys
+FRAME_TABLE = tuple(STATUS_FRAMES.get(key) for key in range(256))
+
+
+# Turn one raw frame (without delimiters) into a typed frame
+def decode_frame(frame):
+    key = frame[0]
+    if key == KEY_DB:
+        if len(frame) > 2:
+            # Inline bcd_to_db, this is the hot path
+            return DbFrame((BCD_HIGH_DECI[frame[1]] + BCD_LOW_DECI[frame[2]]) / 10)
+        return ShortFrame(key, bytes(frame[1:]))
+    status = FRAME_TABLE[key]
+    if status is not None:
+        return status
+    return UnknownFrame(key, bytes(frame[1:]))
+
+
+# Incremental frame decoder
+#
+# Bytes are copied into one reusable buffer and split on the delimiter with
+# bytearray.find, so a whole serial read is handled in a single pass with no
+# per-byte work.  Anything before the first delimiter is discarded because
+# the frame it belongs to started before we were listening.
+class FrameDecoder:
+    def __init__(self, capacity=4096):
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._length = 0
+        self._synced = False
+
+        # Counters
+        self.frames = 0
+        self.empty_frames = 0
+        self.bytes_discarded = 0
+
+    # Forget any partial frame, e.g. after the serial port is reopened
+    def reset(self):
+        self._length = 0
+        self._synced = False
+
+    # Yield each complete raw frame as a memoryview into the buffer.
+    # A view is only valid until the next frame is requested.
+    def split(self, data):
+        buffer = self._buffer
+        size = len(data)
+        if self._length + size > len(buffer):
+            # No delimiter for a whole buffer: drop it and resynchronise
+            self.bytes_discarded += self._length
+            self.reset()
+            if size > len(buffer):
+                self.bytes_discarded += size - len(buffer)
+                data = data[-len(buffer):]
+                size = len(buffer)
+        buffer[self._length:self._length + size] = data
+        self._length += size
+
+        start = 0
+        try:
+            while True:
+                end = buffer.find(DELIMITER, start, self._length)
+                if end < 0:
+                    break
+                if not self._synced:
+                    self._synced = True
+                    self.bytes_discarded += end - start
+                elif end > start:
+                    self.frames += 1
+                    frame_start = start
+                    start = end + 1
+                    yield self._view[frame_start:end]
+                    continue
+                else:
+                    self.empty_frames += 1
+                start = end + 1
+        finally:
+            # Keep the unfinished frame (and anything not yet consumed)
+            remaining = self._length - start
+            if start and remaining:
+                buffer[:remaining] = buffer[start:self._length]
+            self._length = remaining
+
+    # Yield typed frames for a chunk of serial data
+    def feed(self, data):
+        for frame in self.split(data):
+            yield decode_frame(frame)
+
+
+# Sample flags describing the meter's settings, packed into 16 bits:
+# bits 0-2 range, bits 3-4 speed, bits 5-6 MIN/MAX hold, bit 7 record,
+# bit 8 over range, bit 9 under range, bit 10 settings changed during an
+# interval (see merge_flags)
+RANGE_FLAGS = {(30, 130): 1, (30, 80): 2, (50, 100): 3, (80, 130): 4}
+RANGE_NAMES = {code: f"{low}-{high}" for (low, high), code in RANGE_FLAGS.items()}
+RANGE_LIMITS = {code: limits for limits, code in RANGE_FLAGS.items()}
+SPEED_FLAGS = {"FAST": 1, "SLOW": 2}
+SPEED_NAMES = {code: speed for speed, code in SPEED_FLAGS.items()}
+MINMAX_FLAGS = {"MAX": 1, "MIN": 2}
+MINMAX_NAMES = {code: mode.lower() for mode, code in MINMAX_FLAGS.items()}
+FLAG_RANGE_MASK = 0x07
+FLAG_SPEED_SHIFT = 3
+FLAG_SPEED_MASK = 0x18
+FLAG_MINMAX_SHIFT = 5
+FLAG_MINMAX_MASK = 0x60
+FLAG_RECORD = 0x80
+FLAG_OVER_RANGE = 0x100
+FLAG_UNDER_RANGE = 0x200
+FLAG_CHANGED = 0x400
+# Settings that change what the meter reports, each zero while unknown
+FLAG_SETTINGS_MASKS = (FLAG_RANGE_MASK, FLAG_SPEED_MASK, FLAG_MINMAX_MASK)
+
+# Bits each status frame clears and the bits it then sets
+STATUS_FLAGS = {
+    frame: (FLAG_RANGE_MASK, RANGE_FLAGS[frame])
+    for frame in STATUS_FRAMES.values()
+    if type(frame) is RangeFrame
+}
+STATUS_FLAGS.update(
+    {
+        SpeedFrame(speed): (FLAG_SPEED_MASK, code << FLAG_SPEED_SHIFT)
+        for speed, code in SPEED_FLAGS.items()
+    }
+)
+STATUS_FLAGS.update(
+    {
+        MinMaxFrame(mode): (FLAG_MINMAX_MASK, code << FLAG_MINMAX_SHIFT)
+        for mode, code in MINMAX_FLAGS.items()
+    }
+)
+STATUS_FLAGS[RecordFrame(True)] = (FLAG_RECORD, FLAG_RECORD)
+STATUS_FLAGS[RecordFrame(False)] = (FLAG_RECORD, 0)
+
+
+# Meter settings, updated from the status frames the meter sends between
+# dB frames.  Unknown settings are zero in the flags.
+class MeterState:
+    def __init__(self):
+        self.flags = 0
+
+    def update(self, frame):
+        change = STATUS_FLAGS.get(frame)
+        if change is not None:
+            mask, bits = change
+            self.flags = (self.flags & ~mask) | bits
+
+    # Flags for a sample of dB taken now, marked over or under range if it
+    # is outside the range the meter is set to
+    def sample_flags(self, dB):
+        flags = self.flags
+        limits = RANGE_LIMITS.get(flags & FLAG_RANGE_MASK)
+        if limits is not None:
+            if dB > limits[1]:
+                return flags | FLAG_OVER_RANGE
+            if dB < limits[0]:
+                return flags | FLAG_UNDER_RANGE
+        return flags
+
+    @property
+    def range(self):
+        return RANGE_NAMES.get(self.flags & FLAG_RANGE_MASK)
+
+    @property
+    def speed(self):
+        return SPEED_NAMES.get((self.flags & FLAG_SPEED_MASK) >> FLAG_SPEED_SHIFT)
+
+
+# Flags for an interval holding samples with flags earlier and then later:
+# the later settings, over or under range if any sample was, and marked as
+# changed if a setting did not stay the same.  A setting becoming known
+# (e.g. the first status frames after starting) is not a change.
+def merge_flags(earlier, later):
+    merged = later | (earlier & (FLAG_OVER_RANGE | FLAG_UNDER_RANGE | FLAG_CHANGED))
+    changed = earlier ^ later
+    for mask in FLAG_SETTINGS_MASKS:
+        if changed & mask and earlier & mask:
+            merged |= FLAG_CHANGED
+            break
+    return merged
+
+
+# Range, speed and status of a set of flags, e.g. ("30-130", "FAST",
+# "over-range"), with empty strings for anything unknown or not set.  The
+# status lists the hold mode, over or under range and changed settings.
+def describe_flags(flags):
+    status = []
+    minmax = MINMAX_NAMES.get((flags & FLAG_MINMAX_MASK) >> FLAG_MINMAX_SHIFT)
+    if minmax:
+        status.append(f"{minmax}-hold")
+    if flags & FLAG_OVER_RANGE:
+        status.append("over-range")
+    if flags & FLAG_UNDER_RANGE:
+        status.append("under-range")
+    if flags & FLAG_CHANGED:
+        status.append("settings-changed")
+    return (
+        RANGE_NAMES.get(flags & FLAG_RANGE_MASK, ""),
+        SPEED_NAMES.get((flags & FLAG_SPEED_MASK) >> FLAG_SPEED_SHIFT, ""),
+        " ".join(status),
+    )
+
+
+# Read from an open serial port and yield typed frames forever.  Each read
+# takes everything the port has buffered, or waits for at least one byte.
+def read_frames(ser, decoder=None):
+    if decoder is None:
+        decoder = FrameDecoder()
+    while True:
+        data = ser.read(ser.in_waiting or 1)
+        if data:
+            yield from decoder.feed(data)
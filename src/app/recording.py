@@ -0,0 +1,152 @@
+import argparse
+import configparser
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+from datetime import datetime, timezone
+
+import pytz
+
+from csv_sink import next_local_midnight_ns
+from qm1592 import describe_flags
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# Binary recording format
+#
+# A 16 byte header followed by fixed-width little-endian records:
+#   header: magic "SLMB", uint16 version, uint16 record size,
+#           int64 creation time in ns since the epoch
+#   record: int64 timestamp in ns since the epoch, uint16 level in tenths
+#           of a dB, uint16 meter flags (see qm1592.MeterState)
+# A record cut short by a crash is ignored by the reader.
+MAGIC = b"SLMB"
+VERSION = 1
+HEADER = struct.Struct("<4sHHq")
+RECORD = struct.Struct("<qHH")
+RECORD_DTYPE = [("timestamp_ns", "<i8"), ("deci_db", "<u2"), ("flags", "<u2")]
+
+
+# Daily binary recording of every dB frame
+#
+# Files are {directory}/{YYYY-MM-DD}-{name}.slm, rotated at local midnight
+# in tz like the CSV logs.
+class BinaryRecordingSink:
+    def __init__(self, directory, name, tz, flush_interval=1.0):
+        self.directory = directory
+        self.name = name
+        self.tz = tz
+        self.flush_interval = flush_interval
+
+        self._file = None
+        self._rotate_at_ns = 0
+        self._next_flush = 0.0
+        self.records_written = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, timestamp_ns, dB, flags):
+        if timestamp_ns >= self._rotate_at_ns:
+            self._rotate(timestamp_ns)
+        self._file.write(RECORD.pack(timestamp_ns, round(dB * 10), flags))
+        self.records_written += 1
+        if time.monotonic() >= self._next_flush:
+            self.flush()
+
+    def flush(self):
+        self._next_flush = time.monotonic() + self.flush_interval
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        self._rotate_at_ns = 0
+
+    def _rotate(self, timestamp_ns):
+        self.close()
+        date = datetime.fromtimestamp(timestamp_ns / 1e9, self.tz).strftime("%Y-%m-%d")
+        path = os.path.join(self.directory, f"{date}-{self.name}.slm")
+        self._file = open(path, "ab")
+        if self._file.tell() == 0:
+            self._file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, time.time_ns()))
+        else:
+            # Appending after a crash: drop any partial record at the end
+            excess = (self._file.tell() - HEADER.size) % RECORD.size
+            if excess:
+                self._file.truncate(self._file.tell() - excess)
+                self._file.seek(0, os.SEEK_END)
+        self._rotate_at_ns = next_local_midnight_ns(timestamp_ns, self.tz)
+        logger.info("Recording to %s", path)
+
+
+# Map a recording into memory and return its records as a NumPy structured
+# array (fields timestamp_ns, deci_db and flags) viewing the file directly,
+# so nothing is copied until the data is used.
+def read_recording(path):
+    # Imported here so the logger itself does not need NumPy
+    import numpy as np
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            raise ValueError(f"{path} is not a sound level recording")
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, record_size, _ = HEADER.unpack_from(data)
+    if magic != MAGIC or record_size != RECORD.size:
+        raise ValueError(f"{path} is not a sound level recording")
+    if version != VERSION:
+        raise ValueError(f"{path} has unsupported version {version}")
+    count = (size - HEADER.size) // RECORD.size
+    return np.frombuffer(data, dtype=RECORD_DTYPE, count=count, offset=HEADER.size)
+
+
+# Write a recording out in the same layout as the daily CSV logs, with the
+# meter's range, speed and status
+def recording_to_csv(path, out, tz):
+    records = read_recording(path)
+    levels = records["deci_db"] / 10
+    columns = {}
+    for timestamp_ns, dB, flags in zip(
+        records["timestamp_ns"].tolist(), levels.tolist(), records["flags"].tolist()
+    ):
+        local = datetime.fromtimestamp(timestamp_ns // 1000 / 1e6, timezone.utc)
+        timestamp = local.astimezone(tz).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4]
+        suffix = columns.get(flags)
+        if suffix is None:
+            suffix = columns[flags] = ",".join(describe_flags(flags))
+        out.write(f"{timestamp},{round(dB, 1)},{suffix}\n")
+
+
+def main():
+    # Default to the logger's time zone
+    config = configparser.ConfigParser()
+    config.read("slm-log.ini")
+    default_tz = config.get("Monitoring", "timezone", fallback="UTC")
+
+    parser = argparse.ArgumentParser(
+        description="Convert a binary sound level recording to CSV"
+    )
+    parser.add_argument("recording", help="recording file (.slm)")
+    parser.add_argument("--timezone", default=default_tz)
+    parser.add_argument("--output", help="CSV file to write (default: stdout)")
+    args = parser.parse_args()
+
+    tz = pytz.timezone(args.timezone)
+    if args.output:
+        with open(args.output, "w") as out:
+            recording_to_csv(args.recording, out, tz)
+    else:
+        recording_to_csv(args.recording, sys.stdout, tz)
+
+
+if __name__ == "__main__":
+    main()
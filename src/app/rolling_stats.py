@@ -0,0 +1,163 @@
+import math
+from collections import deque
+
+# Levels are binned in tenths of a dB, the meter's resolution
+MAX_DECI_DB = 2000
+
+# Sound energy of each level bin, 10^(L/10), as integers scaled by
+# ENERGY_SCALE so running sums are exact however many samples pass through
+ENERGY_SCALE = 1000
+ENERGY = [
+    round(10 ** (deci_db / 100) * ENERGY_SCALE) for deci_db in range(MAX_DECI_DB + 1)
+]
+
+# Statistics that can be used for violation detection
+STATISTICS = ("median", "max", "leq", "l10", "l90")
+
+
+# Energy-average (equivalent continuous) level of a sequence of levels
+def leq(levels):
+    levels = list(levels)
+    if not levels:
+        return None
+    return 10 * math.log10(math.fsum(10 ** (dB / 10) for dB in levels) / len(levels))
+
+
+# Sliding-window statistics over the most recent samples
+#
+# The window holds the last `size` samples, or the samples from the last
+# `duration` seconds if a duration is given.  Samples are kept in a deque
+# for eviction and counted in a Fenwick tree indexed by level in tenths of
+# a dB, so adding or evicting a sample and reading any order statistic
+# (median, max, L10, L90) costs O(log levels) however long the window is.
+# Leq comes from a running integer energy sum.
+class RollingStatistics:
+    def __init__(self, size=None, duration=None):
+        if not size and not duration:
+            raise ValueError("Either a window size or duration is required")
+        self.size = size
+        self.duration_ns = int(duration * 1e9) if duration else None
+
+        self._samples = deque()
+        self._tree = [0] * (MAX_DECI_DB + 2)
+        self._energy = 0
+        self._first_timestamp_ns = None
+        self._last_timestamp_ns = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    # The samples in the window, oldest first, as (timestamp_ns, tenths of
+    # a dB)
+    def __iter__(self):
+        return iter(self._samples)
+
+    def clear(self):
+        self._samples.clear()
+        self._tree = [0] * (MAX_DECI_DB + 2)
+        self._energy = 0
+        self._first_timestamp_ns = None
+
+    # True once the window covers its full size or duration
+    @property
+    def full(self):
+        if self.duration_ns:
+            return (
+                self._first_timestamp_ns is not None
+                and self._last_timestamp_ns - self._first_timestamp_ns >= self.duration_ns
+            )
+        return len(self._samples) >= self.size
+
+    def add(self, timestamp_ns, dB):
+        deci_db = min(max(round(dB * 10), 0), MAX_DECI_DB)
+        if self._first_timestamp_ns is None:
+            self._first_timestamp_ns = timestamp_ns
+        self._last_timestamp_ns = timestamp_ns
+        self._samples.append((timestamp_ns, deci_db))
+        self._update(deci_db, 1)
+        self._energy += ENERGY[deci_db]
+
+        # Evict samples that have fallen out of the window
+        samples = self._samples
+        if self.duration_ns:
+            oldest = timestamp_ns - self.duration_ns
+            while samples[0][0] <= oldest:
+                self._evict()
+        if self.size:
+            while len(samples) > self.size:
+                self._evict()
+
+    def _evict(self):
+        _, deci_db = self._samples.popleft()
+        self._update(deci_db, -1)
+        self._energy -= ENERGY[deci_db]
+
+    # Fenwick tree update, bins are offset by one
+    def _update(self, deci_db, delta):
+        tree = self._tree
+        index = deci_db + 1
+        while index < len(tree):
+            tree[index] += delta
+            index += index & -index
+
+    # Level of the k-th smallest sample (0-based), in tenths of a dB
+    def _kth(self, k):
+        tree = self._tree
+        index = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            next_index = index + step
+            if next_index < len(tree) and tree[next_index] <= k:
+                index = next_index
+                k -= tree[next_index]
+            step >>= 1
+        return index
+
+    @property
+    def minimum(self):
+        return self._kth(0) / 10 if self._samples else None
+
+    @property
+    def maximum(self):
+        return self._kth(len(self._samples) - 1) / 10 if self._samples else None
+
+    @property
+    def median(self):
+        count = len(self._samples)
+        if not count:
+            return None
+        if count % 2:
+            return self._kth(count // 2) / 10
+        return (self._kth(count // 2 - 1) + self._kth(count // 2)) / 20
+
+    # Level at the given percentile (0-100), nearest rank
+    def percentile(self, percent):
+        count = len(self._samples)
+        if not count:
+            return None
+        rank = max(math.ceil(percent / 100 * count), 1)
+        return self._kth(rank - 1) / 10
+
+    # Level exceeded n percent of the time, e.g. exceeded(10) is L10
+    def exceeded(self, percent):
+        return self.percentile(100 - percent)
+
+    @property
+    def leq(self):
+        if not self._samples:
+            return None
+        return 10 * math.log10(self._energy / (len(self._samples) * ENERGY_SCALE))
+
+    # Value of one of STATISTICS by name
+    def statistic(self, name):
+        if name == "median":
+            return self.median
+        elif name == "max":
+            return self.maximum
+        elif name == "leq":
+            return self.leq
+        elif name == "l10":
+            return self.exceeded(10)
+        elif name == "l90":
+            return self.exceeded(90)
+        raise ValueError(f"Unknown statistic {name}")
@@ -0,0 +1,266 @@
+import json
+import logging
+import os
+import struct
+import time
+from multiprocessing import resource_tracker, shared_memory
+
+# Create a logger
+logger = logging.getLogger(__name__)
+
+# Shared memory layout
+#
+# A 512 byte header followed by a ring of fixed-width little-endian records:
+#   header: magic "SLMQ", uint16 version, uint16 record size, uint32
+#           capacity in records, uint32 closed flag, int64 creation time in
+#           ns since the epoch, then at offset 24 the uint64 write sequence
+#           (records published so far), at offset 32 the uint32 process id
+#           of the logger publishing it and at offset 40 the meter
+#           locations as a NUL-padded JSON list
+#   record: uint64 sequence, int64 timestamp in ns since the epoch, uint16
+#           level in tenths of a dB, uint16 meter flags (see
+#           qm1592.MeterState), uint8 kind, uint8 meter index, 2 bytes pad
+# Record n is stored in slot n % capacity.
+MAGIC = b"SLMQ"
+VERSION = 2
+HEADER = struct.Struct("<4sHHIIq")
+SEQUENCE = struct.Struct("<Q")
+CLOSED_OFFSET = 12
+SEQUENCE_OFFSET = 24
+OWNER = struct.Struct("<I")
+OWNER_OFFSET = 32
+METERS_OFFSET = 40
+HEADER_SIZE = 512
+RECORD = struct.Struct("<QqHHBB2x")
+RECORD_DTYPE = {
+    "names": ["sequence", "timestamp_ns", "deci_db", "flags", "kind", "meter"],
+    "formats": ["<u8", "<i8", "<u2", "<u2", "u1", "u1"],
+    "offsets": [0, 8, 16, 18, 20, 21],
+    "itemsize": RECORD.size,
+}
+
+# Record kinds: a dB frame, or a change of the meter's settings (level 0)
+KIND_LEVEL = 1
+KIND_SETTINGS = 2
+
+
+# Publishes every sample into a shared memory ring for other processes
+#
+# publish() packs one record into the next slot and then advances the
+# write sequence; nothing else happens, whether any reader is attached or
+# not, and readers never write to the ring, so adding readers costs the
+# logger nothing.  The oldest records are overwritten once the ring is
+# full; readers that fall more than capacity records behind detect it
+# from the sequence numbers.
+#
+# The ring records the process id of its logger.  A ring of the same name
+# is only replaced if that process is no longer running, so a second
+# logger (e.g. a replay next to the live logger) refuses to start rather
+# than taking over the first one's ring.
+class SampleRing:
+    def __init__(self, name, capacity=65536, meters=()):
+        self.name = name
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * RECORD.size
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            remove_stale_ring(name)
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        self._buf = self._shm.buf
+        HEADER.pack_into(
+            self._buf, 0, MAGIC, VERSION, RECORD.size, capacity, 0, time.time_ns()
+        )
+        OWNER.pack_into(self._buf, OWNER_OFFSET, os.getpid())
+        locations = json.dumps(list(meters)).encode()[: HEADER_SIZE - METERS_OFFSET]
+        self._buf[METERS_OFFSET : METERS_OFFSET + len(locations)] = locations
+        self.sequence = 0
+        logger.info("Publishing samples to shared memory %s", name)
+
+    def publish(self, timestamp_ns, deci_db, flags, kind=KIND_LEVEL, meter=0):
+        sequence = self.sequence
+        RECORD.pack_into(
+            self._buf,
+            HEADER_SIZE + sequence % self.capacity * RECORD.size,
+            sequence,
+            timestamp_ns,
+            deci_db,
+            flags,
+            kind,
+            meter,
+        )
+        self.sequence = sequence + 1
+        SEQUENCE.pack_into(self._buf, SEQUENCE_OFFSET, sequence + 1)
+
+    # Mark the ring closed so readers look for the next logger's ring
+    def close(self):
+        if self._buf is None:
+            return
+        struct.pack_into("<I", self._buf, CLOSED_OFFSET, 1)
+        self._buf.release()
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+# Remove a ring left behind by a logger that was killed, or raise
+# RuntimeError if the ring belongs to a logger that is still running or is
+# not a ring this version wrote
+def remove_stale_ring(name):
+    # Attached untracked, so exiting does not remove a running logger's ring
+    stale = attach(name)
+    try:
+        magic, version = HEADER.unpack_from(stale.buf)[:2]
+        owner = OWNER.unpack_from(stale.buf, OWNER_OFFSET)[0]
+    finally:
+        stale.close()
+    if magic != MAGIC or version != VERSION:
+        raise RuntimeError(
+            f"Shared memory {name} exists and is not a sample ring this logger "
+            f"wrote; remove /dev/shm/{name} or set another name in [SampleRing]"
+        )
+    if process_running(owner):
+        raise RuntimeError(
+            f"Sample ring {name} is in use by process {owner}; stop that "
+            "logger or set another name in [SampleRing]"
+        )
+    logger.warning("Removing sample ring %s left behind by process %d", name, owner)
+    stale = shared_memory.SharedMemory(name)
+    stale.close()
+    stale.unlink()
+
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # Running as another user
+        return True
+    return True
+
+
+# Attach to an existing shared memory block without the resource tracker
+# removing it when this process exits (Python < 3.13 tracks every attach)
+def attach(name):
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+# Reads the ring published by slm-log.py from another process
+#
+# read() returns the records published since the last call as a NumPy
+# structured array (fields sequence, timestamp_ns, deci_db, flags, kind and
+# meter) viewing the shared memory directly, copied only when it wraps
+# around the end of the ring, and the number of records lost because the
+# reader fell more than capacity records behind.  A view stays valid until
+# the writer laps it, so copy records that are kept for longer.  Reading
+# starts at the newest record unless from_start is given.
+#
+# If the logger restarts, the reader attaches to the new ring the next
+# time read() finds nothing new.
+class SampleRingReader:
+    def __init__(self, name, from_start=False, restart_check_interval=1.0):
+        self.name = name
+        self.from_start = from_start
+        self.restart_check_interval = restart_check_interval
+        self.records_lost = 0
+        self._shm = None
+        self._next_restart_check = 0.0
+        self._attach(attach(name))
+
+    def _attach(self, shm):
+        # Imported here so the logger itself does not need NumPy
+        import numpy as np
+
+        magic, version, record_size, capacity, _, created_ns = HEADER.unpack_from(
+            shm.buf
+        )
+        if magic != MAGIC or record_size != RECORD.size:
+            shm.close()
+            raise ValueError(f"{self.name} is not a sample ring")
+        if version != VERSION:
+            shm.close()
+            raise ValueError(f"{self.name} has unsupported version {version}")
+        if self._shm is not None:
+            self.close()
+        self._shm = shm
+        self.capacity = capacity
+        self.created_ns = created_ns
+        self.meters = json.loads(
+            bytes(shm.buf[METERS_OFFSET:HEADER_SIZE]).rstrip(b"\0") or b"[]"
+        )
+        self.records = np.ndarray(
+            capacity,
+            dtype=np.dtype(RECORD_DTYPE),
+            buffer=shm.buf,
+            offset=HEADER_SIZE,
+        )
+        self.position = 0 if self.from_start else self._end()
+
+    def _end(self):
+        return SEQUENCE.unpack_from(self._shm.buf, SEQUENCE_OFFSET)[0]
+
+    @property
+    def closed(self):
+        return struct.unpack_from("<I", self._shm.buf, CLOSED_OFFSET)[0] == 1
+
+    def read(self, max_records=None):
+        end = self._end()
+        start = self.position
+        if end == start:
+            self._check_restart()
+            return self.records[:0], 0
+        lost = max(end - self.capacity - start, 0)
+        start += lost
+        if max_records is not None:
+            end = min(end, start + max_records)
+        first = start % self.capacity
+        last = first + end - start
+        if last <= self.capacity:
+            records = self.records[first:last]
+        else:
+            import numpy as np
+
+            records = np.concatenate(
+                (self.records[first:], self.records[: last - self.capacity])
+            )
+        # Drop whatever the writer overwrote while this was going on
+        overwritten = min(max(self._end() - self.capacity - start, 0), end - start)
+        if overwritten:
+            records = records[overwritten:]
+            lost += overwritten
+        self.position = end
+        self.records_lost += lost
+        return records, lost
+
+    # Follow the logger to a new ring if it has restarted
+    def _check_restart(self):
+        now = time.monotonic()
+        if now < self._next_restart_check:
+            return
+        self._next_restart_check = now + self.restart_check_interval
+        try:
+            shm = attach(self.name)
+        except FileNotFoundError:
+            return
+        if HEADER.unpack_from(shm.buf)[5] == self.created_ns:
+            shm.close()
+            return
+        logger.info("Attaching to the restarted sample ring %s", self.name)
+        self.from_start = True
+        self._attach(shm)
+
+    def close(self):
+        self.records = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # Records still viewed by the caller keep the old ring mapped
+            # until they are released
+            pass
@@ -1,8 +1,12 @@
 import logging
 import configparser
-from pushover import Client, Message
+import signal
 import time
 
+from pushover import Client, Message
+
+from alerts import Alert, AlertDispatcher, AlertServer
+
 # Configure logging level and output format
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -22,15 +26,22 @@ pushover_group_key = config.get("Pushover", "group_key")
 pushover_app_api_token = config.get("Pushover", "app_api_token")
 pushover_msg_title = config.get("Pushover", "msg_title")
 
+# Alerts arrive from slm-log.py on this Unix socket
+alert_socket = config.get("Pushover", "socket", fallback="slm-alerts.sock")
+# Repeated alerts of one kind within this many milliseconds are sent as one
+coalesce_interval = config.getint("Pushover", "coalesce_interval", fallback=30000)
+
 # --------------------- End of Configuration  ---------------------
 
 # --------------------- Initialise Connections  ---------------------
 # Pushover connection
+po_api = None
 if pushover_group_key and pushover_app_api_token:
     po_api = Client(pushover_group_key, pushover_app_api_token)
 # --------------------- End Initialise Connections  ---------------------
 
 
+# Read and clear messages left in the file used by older versions of slm-log.py
 def read_messages(file_path):
     messages = []
     try:
@@ -38,6 +49,8 @@ def read_messages(file_path):
             messages = file.readlines()
         # Clear the file after reading
         open(file_path, "w").close()
+    except FileNotFoundError:
+        pass
     except Exception as e:
         print(f"Error reading messages: {e}")
     return messages
@@ -49,24 +62,37 @@ def send_pushover_message(message, title=None):
             pushover_title = title
         else:
             pushover_title = pushover_msg_title
+        # Exceptions propagate so the dispatcher retries the message
         po_send = po_api.send(Message(message, title=pushover_title))
         logger.info(f"Pushover message sent: {message}")
         logger.info(f"Pushover Send returned {po_send}")
 
 
-def main():
-    file_path = "pushover_messages.txt"  # Path to the local file for violation messages
+# Turn SIGTERM (e.g. systemctl stop) into a normal exit
+def handle_sigterm(signum, frame):
+    raise SystemExit(0)
+
 
-    # Create the file if it does not exist
-    open(file_path, "a").close()
+def main():
+    signal.signal(signal.SIGTERM, handle_sigterm)
 
-    while True:
-        messages = read_messages(file_path)
+    dispatcher = AlertDispatcher(
+        send_pushover_message, coalesce_window=coalesce_interval / 1000
+    ).start()
+    server = AlertServer(alert_socket, dispatcher).start()
 
-        for message in messages:
-            send_pushover_message(message.strip())
+    # Send anything left over from before the upgrade to the alert socket
+    for number, message in enumerate(read_messages("pushover_messages.txt")):
+        dispatcher.submit(Alert(f"legacy-{number}", None, message.strip(), None))
 
-        time.sleep(5)  # Wait for 5 seconds before checking for new messages
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        dispatcher.stop()
 
 
 if __name__ == "__main__":
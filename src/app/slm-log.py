@@ -1,15 +1,33 @@
+import argparse
+import asyncio
 import configparser
+import importlib
 import logging
+import queue
+import signal
+import threading
 import time
 import traceback
-import statistics
-from datetime import datetime, timezone
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
 
 import pytz
-import serial
-from influxdb_client import InfluxDBClient, Point, WritePrecision
-from influxdb_client.client.write_api import SYNCHRONOUS
-from pushover import Client, Message
+from influx_writer import InfluxBatchWriter
+import metrics
+from acquisition import SerialReader
+from aggregation import IntervalAggregator
+from alerts import AlertClient
+from async_runtime import AsyncAlertDispatcher, AsyncInfluxWriter, AsyncSerialReader
+from capture import ReplaySerial
+from csv_sink import DailyCsvLogs
+from episodes import EpisodeTracker
+from journal import SampleJournal
+from monitor import MonitorServer
+from passings import PassingFeed, PassingJoin
+from qm1592 import DbFrame, MeterState, ShortFrame, describe_flags
+from recording import BinaryRecordingSink
+from sample_ring import KIND_SETTINGS, SampleRing
+from rolling_stats import STATISTICS, RollingStatistics
 
 # Configure logging level and output format
 logging.basicConfig(
@@ -34,41 +52,309 @@ influxdb_org = config.get("InfluxDB", "org")
 influxdb_bucket = config.get("InfluxDB", "bucket")
 influxdb_measurement = config.get("InfluxDB", "measurement")
 influxdb_measurement_compliance = f"{influxdb_measurement}-compliance"
+influxdb_measurement_violations = f"{influxdb_measurement}-violations"
 influxdb_location = config.get("InfluxDB", "location")
 influxdb_timeout = int(config.getint("InfluxDB", "timeout"))
+influxdb_batch_size = config.getint("InfluxDB", "batch_size", fallback=100)
+influxdb_flush_interval = config.getint("InfluxDB", "flush_interval", fallback=1000)
+influxdb_queue_size = config.getint("InfluxDB", "queue_size", fallback=10000)
+influxdb_spill_file = config.get("InfluxDB", "spill_file", fallback="influx-spill.lp")
+influxdb_journal_directory = config.get(
+    "InfluxDB", "journal_directory", fallback="influx-journal"
+)
+influxdb_journal_segment_size = config.getint(
+    "InfluxDB", "journal_segment_size", fallback=4194304
+)
+influxdb_journal_sync_interval = config.getint(
+    "InfluxDB", "journal_sync_interval", fallback=1000
+)
+influxdb_backfill_batch_size = config.getint(
+    "InfluxDB", "backfill_batch_size", fallback=5000
+)
+influxdb_rollup_intervals = [
+    int(interval)
+    for interval in config.get(
+        "InfluxDB", "rollup_intervals", fallback="10000, 60000"
+    ).split(",")
+    if interval.strip()
+]
 
 # Pushover server configuration
 pushover_group_key = config.get("Pushover", "group_key")
 pushover_app_api_token = config.get("Pushover", "app_api_token")
 pushover_msg_title = config.get("Pushover", "msg_title")
+alert_socket = config.get("Pushover", "socket", fallback="slm-alerts.sock")
+# Used by --asyncio, which sends alerts itself
+alert_coalesce_interval = config.getint(
+    "Pushover", "coalesce_interval", fallback=30000
+)
 
 # Minimum noise level for logging events (in dB)
 maximum_noise_level = int(config.get("Monitoring", "maximum_noise_level"))
 
-# device path for serial communication
-serial_device = config.get("Hardware", "serial_device")
+# Violation detection window, by sample count or by duration in milliseconds
+violation_window_samples = config.getint(
+    "Monitoring", "violation_window_samples", fallback=4
+)
+violation_window_duration = config.getint(
+    "Monitoring", "violation_window_duration", fallback=0
+)
+violation_statistic = config.get("Monitoring", "violation_statistic", fallback="median")
+if violation_statistic not in STATISTICS:
+    raise ValueError(f"violation_statistic must be one of {', '.join(STATISTICS)}")
+
+# Violation episodes end once the level falls back to the exit level, must
+# last the minimum duration (ms) and alert no more than once per interval (ms)
+violation_exit_level = config.getfloat(
+    "Monitoring", "violation_exit_level", fallback=maximum_noise_level - 3
+)
+violation_min_duration = config.getint(
+    "Monitoring", "violation_min_duration", fallback=0
+)
+violation_alert_interval = config.getint(
+    "Monitoring", "violation_alert_interval", fallback=60000
+)
+
+# Meters, from [Hardware] for a single meter or one [Hardware:name] section
+# per meter, each with its own serial device, location tag and thresholds
+meter_sections = [s for s in config.sections() if s.startswith("Hardware:")]
+if not meter_sections and config.has_section("Hardware"):
+    meter_sections = ["Hardware"]
+if not meter_sections:
+    raise ValueError("No [Hardware] section in slm-log.ini")
 
 # sample interval in milliseconds
 sample_interval = int(config.get("Monitoring", "sample_interval"))
+sample_interval_ns = sample_interval * 1_000_000
 compliance_sample_interval = int(config.get("Monitoring", "compliance_sample_interval"))
 
 # CSV logging timezone
 log_tz = pytz.timezone(config.get("Monitoring", "timezone"))
 
+# CSV log files
+csv_directory = config.get("CSV", "directory", fallback="logs")
+csv_flush_interval = config.getint("CSV", "flush_interval", fallback=1000)
+csv_fsync = config.getboolean("CSV", "fsync", fallback=True)
+csv_index_interval = config.getint("CSV", "index_interval", fallback=10000)
+
+# Binary recording of every dB frame
+recording_enabled = config.getboolean("Recording", "enabled", fallback=False)
+recording_directory = config.get("Recording", "directory", fallback="logs")
+
+# Prometheus metrics endpoint
+metrics_enabled = config.getboolean("Metrics", "enabled", fallback=False)
+metrics_address = config.get("Metrics", "address", fallback="127.0.0.1")
+metrics_port = config.getint("Metrics", "port", fallback=9108)
+
+# Live terminal monitor served to monitor.py
+monitor_enabled = config.getboolean("Monitor", "enabled", fallback=False)
+monitor_socket = config.get("Monitor", "socket", fallback="slm-monitor.sock")
+monitor_interval = config.getint("Monitor", "interval", fallback=250)
+
+# Shared memory ring of every sample for other local processes
+sample_ring_enabled = config.getboolean("SampleRing", "enabled", fallback=False)
+sample_ring_name = config.get("SampleRing", "name", fallback="slm-samples")
+sample_ring_capacity = config.getint("SampleRing", "capacity", fallback=65536)
+
+# Passings from the timing system, matched to the levels and violations.
+# offset (ms) is from the timing loop to the meter, tolerance (ms) either
+# side of the expected time, and feed_delay (ms) how late passings arrive.
+timing_enabled = config.getboolean("Timing", "enabled", fallback=False)
+timing_address = config.get("Timing", "address", fallback="127.0.0.1")
+timing_port = config.getint("Timing", "port", fallback=9110)
+timing_offset = config.getint("Timing", "offset", fallback=0)
+timing_tolerance = config.getint("Timing", "tolerance", fallback=3000)
+timing_feed_delay = config.getint("Timing", "feed_delay", fallback=1000)
+
 # --------------------- End of Configuration  ---------------------
 
 logger.info("Configuration loaded")
 logger.info("InfluxDB Host: %s", influxdb_host)
 
 # --------------------- Initialise Connections  ---------------------
-# InfluxDB connection
-influxdb_client = InfluxDBClient(
-    url=f"http://{influxdb_host}:{influxdb_port}",
-    token=influxdb_token,
-    org=influxdb_org,
-    timeout=influxdb_timeout,
+# InfluxDB connection, created by get_influxdb_client() on first use so
+# importing the client library never delays the first sample
+influxdb_client = None
+influxdb_client_lock = threading.Lock()
+
+
+def get_influxdb_client():
+    global influxdb_client
+    with influxdb_client_lock:
+        if influxdb_client is None:
+            from influxdb_client import InfluxDBClient
+
+            influxdb_client = InfluxDBClient(
+                url=f"http://{influxdb_host}:{influxdb_port}",
+                token=influxdb_token,
+                org=influxdb_org,
+                timeout=influxdb_timeout,
+            )
+        return influxdb_client
+
+
+# Called by the writer thread the first time it writes.  The client library
+# is imported by get_influxdb_client() first, under its lock, as importing
+# its modules from two threads at once can deadlock.
+def connect_influxdb():
+    client = get_influxdb_client()
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    return client.write_api(write_options=SYNCHRONOUS)
+
+
+# Every point is journaled until InfluxDB has acknowledged it
+influx_journal = None
+if influxdb_journal_directory:
+    influx_journal = SampleJournal(
+        influxdb_journal_directory,
+        influxdb_journal_segment_size,
+        influxdb_journal_sync_interval / 1000,
+    )
+    # Points spilled before the journal was enabled
+    influx_journal.import_file(influxdb_spill_file)
+
+# Background batch writer so a slow database never stalls the serial loop.
+# Points wait in the journal (or queue up and spill to disk) until the
+# database can be reached.
+influx_writer = InfluxBatchWriter(
+    None,
+    influxdb_bucket,
+    influxdb_org,
+    batch_size=influxdb_batch_size,
+    flush_interval=influxdb_flush_interval / 1000,
+    queue_size=influxdb_queue_size,
+    spill_path=influxdb_spill_file,
+    connect=connect_influxdb,
+    journal=influx_journal,
+    backfill_batch_size=influxdb_backfill_batch_size,
 )
-write_api = influxdb_client.write_api(write_options=SYNCHRONOUS)
+
+# Alerts to send_pushover.py over a Unix socket
+alert_client = AlertClient(alert_socket)
+
+# Daily CSV logs for every meter, kept open and rotated at local midnight
+csv_logs = DailyCsvLogs(
+    csv_directory,
+    log_tz,
+    csv_flush_interval / 1000,
+    csv_fsync,
+    csv_index_interval / 1000,
+)
+
+
+# Rolled-up measurement for an interval in milliseconds, e.g. sound-levels-10s
+def rollup_measurement(interval):
+    for unit, ms in (("h", 3_600_000), ("m", 60_000), ("s", 1000)):
+        if interval % ms == 0:
+            return f"{influxdb_measurement}-{interval // ms}{unit}"
+    return f"{influxdb_measurement}-{interval}ms"
+
+
+# Latest sample of a meter for the live monitor: its time in ns since the
+# epoch, level, flags, the median, Leq and violation statistic over the
+# detection window (None until the window is full), and the violation
+# state and episode in progress
+LiveLevels = namedtuple(
+    "LiveLevels",
+    ["timestamp_ns", "dB", "flags", "median", "leq", "window_dB", "state", "episode"],
+)
+
+
+# Everything kept for one meter: its settings, the sinks it logs to and the
+# state of its compliance interval and violation detection.  The meter's
+# logs are named with the section suffix (e.g. noise-pit-lane.csv) unless
+# it is the only meter, configured by a plain [Hardware] section.
+class Meter:
+    def __init__(self, section, index=0):
+        self.name = section.partition(":")[2]
+        # Position in meters, identifying the meter in the sample ring
+        self.index = index
+        suffix = f"-{self.name}" if self.name else ""
+        self.serial_device = config.get(section, "serial_device")
+        self.location = config.get(
+            section, "location", fallback=self.name or influxdb_location
+        )
+        self.tags = {"location": self.location}
+        # Label for log messages and alerts when there is more than one meter
+        self.label = f"{self.location}: " if self.name else ""
+        self.alert_key = f"violation{suffix}"
+
+        # Thresholds, keeping the same hysteresis as [Monitoring] by default
+        self.maximum_noise_level = config.getfloat(
+            section, "maximum_noise_level", fallback=maximum_noise_level
+        )
+        self.violation_exit_level = config.getfloat(
+            section,
+            "violation_exit_level",
+            fallback=self.maximum_noise_level
+            - (maximum_noise_level - violation_exit_level),
+        )
+
+        self.noise_csv = csv_logs.sink(f"noise{suffix}")
+        self.compliance_csv = csv_logs.sink(f"noise-compliance{suffix}")
+        # Violation episodes, recorded once each has ended
+        self.violations_csv = csv_logs.sink(f"violations{suffix}")
+
+        # Optional full-rate binary recording
+        self.recording = None
+        if recording_enabled:
+            self.recording = BinaryRecordingSink(
+                recording_directory, f"noise{suffix}", log_tz, csv_flush_interval / 1000
+            )
+
+        self.episode_tracker = EpisodeTracker(
+            self.maximum_noise_level,
+            self.violation_exit_level,
+            violation_min_duration / 1000,
+            violation_alert_interval / 1000,
+        )
+
+        # Leq, Lmax and Lmin of every frame in each compliance interval
+        self.compliance_aggregator = IntervalAggregator(compliance_sample_interval)
+        # and in each rollup interval, by measurement
+        self.rollups = [
+            (rollup_measurement(interval), IntervalAggregator(interval))
+            for interval in influxdb_rollup_intervals
+        ]
+
+        # Rolling statistics over the violation detection window
+        if violation_window_duration:
+            self.violation_window = RollingStatistics(
+                duration=violation_window_duration / 1000
+            )
+        else:
+            self.violation_window = RollingStatistics(size=violation_window_samples)
+
+        # Meter settings from the status frames
+        self.meter_state = MeterState()
+
+        # Serial reader, and the time the next sample is due, set by update()
+        self.reader = None
+        self.next_sample_ns = 0
+
+        # Latest LiveLevels, set only while the live monitor is enabled
+        self.live = None
+
+        # Passings expected at this meter, each meter being its own distance
+        # from the timing loop, and the level logged as each car passed
+        self.passing_join = None
+        if timing_enabled:
+            self.passing_join = PassingJoin(
+                config.getint(section, "timing_offset", fallback=timing_offset) / 1000,
+                timing_tolerance / 1000,
+                timing_feed_delay / 1000,
+            )
+            self.passings_csv = csv_logs.sink(f"passings{suffix}")
+
+
+meters = [Meter(section, index) for index, section in enumerate(meter_sections)]
+
+# Shared memory ring, created by main() if enabled
+sample_ring = None
+
+# Timing system feed, started by main() if enabled
+passing_feed = None
 
 # --------------------- End Initialise Connections  ---------------------
 
@@ -79,207 +365,750 @@ failed_influxdb_pings = 0
 last_dB = None
 last_timestamp = None
 
-# List to store the last 4 samples
-last_4_samples = []
+# Violation detection window, for log messages
+if violation_window_duration:
+    violation_window_label = f"last {violation_window_duration / 1000:g} s"
+else:
+    violation_window_label = f"last {violation_window_samples} samples"
+
+# Start of the Unix epoch, for nanosecond database timestamps
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Metrics updated by the serial loop
+frames_discarded = metrics.counter(
+    "slm_frames_discarded_total", "dB frames skipped by the sample_interval gate"
+)
+short_buffers = metrics.counter(
+    "slm_short_buffers_total", "Frames too short to extract a dB value"
+)
+loop_lag = metrics.histogram(
+    "slm_loop_lag_seconds", "Time from a sample arriving to it being logged"
+)
+
 
+# Queue an alert for send_pushover.py.  Alerts with the same key are
+# coalesced into one notification per burst.
+def write_pushover_message(message, key=None):
+    alert_client.send(message, key=key)
 
-# Get the high and low nibbles of a byte
-def get_high_nibble(byte):
-    return (byte & 0xF0) >> 4
+# Queue data for the background InfluxDB writer
+def write_data_to_influxdb(dB, timestamp_ns, measurement_point, tags, flags=0):
+    fields = {"dB": dB}
+    fields.update(describe_sample_flags(flags)[1])
+    influx_writer.write(measurement_point, tags, fields, timestamp_ns)
 
 
-def get_low_nibble(byte):
-    return byte & 0x0F
+# Meter range, speed and status for each set of sample flags, as extra CSV
+# columns and InfluxDB fields.  Flags rarely change, so each set is only
+# described once.
+flag_descriptions = {}
 
-def write_pushover_message(message):
-    with open("pushover_messages.txt", "a") as file:
-        file.write(message + "\n")
 
-# Write data to InfluxDB
-def write_data_to_influxdb(dB, timestamp, measurement_point):
-    point = (
-        Point(measurement_point)
-        .tag("location", influxdb_location)
-        .field("dB", dB)
-        .time(timestamp, WritePrecision.NS)
+def describe_sample_flags(flags):
+    description = flag_descriptions.get(flags)
+    if description is None:
+        columns = describe_flags(flags)
+        fields = {
+            name: value
+            for name, value in zip(("range", "speed", "status"), columns)
+            if value
+        }
+        description = ("," + ",".join(columns), fields)
+        flag_descriptions[flags] = description
+    return description
+
+# Local time for the CSV logs, e.g. 2024-10-05T14:32:05.250
+def format_timestamp(timestamp_ns):
+    now = epoch + timedelta(microseconds=timestamp_ns // 1000)
+    return now.astimezone(log_tz).strftime("%Y-%m-%dT%H:%M:%S.%fZ")[:-4]
+
+
+# Log the levels for one compliance interval to CSV and InfluxDB
+def write_compliance_levels(meter, levels):
+    meter.compliance_csv.write(
+        levels.timestamp_ns,
+        f"{format_timestamp(levels.timestamp_ns)},{levels.leq},"
+        f"{levels.lmax},{levels.lmin},{levels.count}"
+        f"{describe_sample_flags(levels.flags)[0]}\n",
     )
-    try:
-        write_api.write(bucket=influxdb_bucket, org=influxdb_org, record=point)
-    except Exception as e:
-        logger.error(f"Error writing to InfluxDB")
-
-# Function to update noise level and log it
-def update():
-    # Declare global variables
-    global last_4_samples
-
-    # Initialize variables
-    # Data processing variables
-    dB = None
-    key = None
-    tracking_peak = False
-
-    # Serial communication variables
-    ser = serial.Serial(serial_device, 9600, timeout=1)
-    message_buffer = bytearray()
-    key = 0x00
-
-    # time tracking variables
-    now = datetime.now(pytz.utc)
-    start_of_script = datetime(now.year, now.month, now.day, tzinfo=timezone.utc)
-    milliseconds_since_start_of_script = int(
-        (now - start_of_script).total_seconds() * 1000
+    # write a copy to influxdb for display in Grafana
+    write_levels_to_influxdb(influxdb_measurement_compliance, meter.tags, levels)
+
+
+# dB is the Leq so existing panels keep working
+def write_levels_to_influxdb(measurement, tags, levels):
+    fields = {
+        "dB": levels.leq,
+        "Leq": levels.leq,
+        "Lmax": levels.lmax,
+        "Lmin": levels.lmin,
+        "count": levels.count,
+    }
+    fields.update(describe_sample_flags(levels.flags)[1])
+    influx_writer.write(measurement, tags, fields, levels.timestamp_ns)
+
+
+# Alert when a violation episode starts, and record it once it ends
+def handle_violation_event(
+    meter, kind, episode, statistic_name=None, window_dB=None
+):
+    if kind == "start":
+        if meter.passing_join is not None:
+            meter.passing_join.keep(episode.start_ns)
+        logger.info(
+            "%sVIOLATION: %s Noise Level of %.1f dB",
+            meter.label,
+            statistic_name,
+            window_dB,
+        )
+        if meter.episode_tracker.should_alert(episode.start_ns):
+            cars = ""
+            if meter.passing_join is not None:
+                # Only the passings so far, the rest are in the violation row
+                likely = meter.passing_join.cars(
+                    episode.start_ns, episode.peak_ns, episode.peak_ns
+                )
+                if likely:
+                    cars = f", likely car {', '.join(likely)}"
+            write_pushover_message(
+                f"{meter.label}VIOLATION: {statistic_name} Noise Level of "
+                f"{window_dB:.1f} dB{cars}",
+                key=meter.alert_key,
+            )
+        return
+
+    duration = (episode.end_ns - episode.start_ns) / 1e9
+    logger.info(
+        "%sViolation ended: peak %.1f dB, Leq %.1f dB over %.1f s",
+        meter.label,
+        episode.peak_db,
+        episode.leq,
+        duration,
     )
-    next_sample_time = milliseconds_since_start_of_script + sample_interval
-    next_compliance_sample_time = (
-        milliseconds_since_start_of_script + compliance_sample_interval
+    if meter.passing_join is not None:
+        # Recorded once every passing that could match it has arrived
+        meter.passing_join.hold(episode.start_ns, episode.end_ns, episode)
+        return
+    record_violation(meter, episode)
+
+
+# Record a violation episode that has ended, with the cars expected at the
+# meter during it, nearest the peak first, if passings are being matched
+def record_violation(meter, episode, cars=None):
+    duration = (episode.end_ns - episode.start_ns) / 1e9
+    fields = {
+        "text": f"Violation: peak {episode.peak_db} dB, "
+        f"Leq {episode.leq} dB over {duration:.1f} s",
+        "duration": duration,
+        "peak": episode.peak_db,
+        "Leq": episode.leq,
+        "samples": episode.samples,
+        "end": episode.end_ns,
+    }
+    cars_column = ""
+    if cars is not None:
+        cars_column = f",{' '.join(cars)}"
+        if cars:
+            fields["text"] += f", likely car {', '.join(cars)}"
+            fields["cars"] = " ".join(cars)
+    meter.violations_csv.write(
+        episode.start_ns,
+        f"{format_timestamp(episode.start_ns)},{format_timestamp(episode.end_ns)},"
+        f"{duration:.2f},{episode.peak_db},{format_timestamp(episode.peak_ns)},"
+        f"{episode.leq},{episode.samples}{cars_column}\n",
+    )
+    # Annotation point for Grafana
+    influx_writer.write(
+        influxdb_measurement_violations, meter.tags, fields, episode.start_ns
     )
 
+
+# Log the level of each passing once its window has closed, and record the
+# violations whose passings have all arrived
+def match_passings(meter, timestamp_ns, dB):
+    join = meter.passing_join
+    for level in join.add_sample(timestamp_ns, dB):
+        write_passing(meter, level)
+    for episode in join.release(timestamp_ns):
+        record_violation(
+            meter, episode, join.cars(episode.start_ns, episode.end_ns, episode.peak_ns)
+        )
+
+
+def write_passing(meter, level):
+    passing = level.passing
+    peak = ""
+    peak_time = ""
+    if level.peak_db is not None:
+        peak = level.peak_db
+        peak_time = format_timestamp(level.peak_ns)
+        logger.info("%sCar %s passed at %.1f dB", meter.label, passing.car, peak)
+    meter.passings_csv.write(
+        passing.timestamp_ns,
+        f"{format_timestamp(passing.timestamp_ns)},{passing.car},"
+        f"{passing.transponder},{format_timestamp(level.expected_ns)},"
+        f"{peak},{peak_time}\n",
+    )
+
+
+# Passing from the timing feed thread, expected at every meter
+def add_passing(passing):
+    for meter in meters:
+        meter.passing_join.add(passing)
+
+
+# Function to update noise level and log it for every meter.  If replay is
+# given (a capture.ReplaySerial) it is read as replay_meter, by default the
+# first meter, and the other meters are not started.
+def update(replay=None, replay_meter=None):
+    # One queue for every reader, each sample tagged with its meter
+    samples = queue.Queue(maxsize=1024 * len(meters))
+    if replay:
+        replay_meter = replay_meter or meters[0]
+        replay_meter.reader = SerialReader(
+            "replay",
+            clock=replay,
+            open_serial=lambda: replay,
+            block=True,
+            source=replay_meter,
+            samples=samples,
+        )
+        active_meters = [replay_meter]
+    else:
+        for meter in meters:
+            meter.reader = SerialReader(
+                meter.serial_device, source=meter, samples=samples
+            )
+        active_meters = meters
+    readers = start_readers(active_meters)
+
+    while True:
+        try:
+            sample = samples.get(timeout=1)
+        except queue.Empty:
+            if readers_finished(readers):
+                return
+            # Nothing from the meters, write out whatever is buffered
+            csv_logs.flush()
+            flush_recordings()
+            continue
+        process_sample(sample)
+
+
+# The same as update(), with the serial ports read by event loop callbacks
+# and the sinks set up by main_async() running as tasks in the same loop
+async def update_async(replay=None, replay_meter=None):
+    samples = asyncio.Queue(maxsize=1024 * len(meters))
+    if replay:
+        replay_meter = replay_meter or meters[0]
+        replay_meter.reader = AsyncSerialReader(
+            "replay",
+            samples,
+            source=replay_meter,
+            clock=replay,
+            open_serial=lambda: replay,
+        )
+        active_meters = [replay_meter]
+    else:
+        for meter in meters:
+            meter.reader = AsyncSerialReader(meter.serial_device, samples, source=meter)
+        active_meters = meters
+    readers = start_readers(active_meters)
+
     while True:
-        current_date = now.astimezone(log_tz).strftime("%Y-%m-%d")
-        # Scan incoming packets for a dB value
-        message_buffer = bytearray()  # Reset the message buffer for the next message
-        while True:
-            # receive bytes from serial until a db value is received
+        if samples.empty():
             try:
-                byte = ser.read(1)
-            except serial.SerialException:
-                logger.error("Serial communication error")
-                # loop until serial communication is restored
-                while True:
-                    try:
-                        ser.close()
-                        ser = serial.Serial(serial_device, 9600, timeout=1)
-                        byte = ser.read(1)
-                        if byte:
-                            logger.info("Serial communication restored")
-                        # reset message buffer
-                        message_buffer = bytearray()
-                        break
-                    except serial.SerialException:
-                        logger.error("Serial communication error")
-                        time.sleep(5)
-                break
-            if byte:
-                # Check if the byte is the delimiter (165 -> '¥')
-                if byte.hex() == "a5":  # '\xa5' is the hex representation of 165
-                    if message_buffer:
-                        # Read the first byte of the message to determine the cursor position
-                        msg = message_buffer
-                        key = msg[0]
-                        if key:
-                            if key == 0x0D:
-                                # Record time of collection
-                                now = datetime.now(pytz.utc)
-                                # logging.info("Message: %s", message_buffer.hex())
-                                # Check if msg[1] and msg[2] exist
-                                if len(msg) > 2:
-                                    # DB Noise Level
-                                    hundreds = get_high_nibble(msg[1])
-                                    tens = get_low_nibble(msg[1])
-                                    ones = get_high_nibble(msg[2])
-                                    tenths = get_low_nibble(msg[2])
-                                    dB = hundreds * 100 + tens * 10 + ones + tenths / 10
-                                    # Calculate next sample time
-                                    timestamp = now.astimezone(log_tz).strftime(
-                                        "%Y-%m-%dT%H:%M:%S.%fZ"
-                                    )[:-4]
-                                    # Fractional seconds since epoc in UTC
-                                    database_timestamp = now.isoformat()
-                                    milliseconds_since_start_of_script = int(
-                                        (now - start_of_script).total_seconds() * 1000
-                                    )
-                                else:
-                                    logger.warning(
-                                        "Message buffer too short to extract dB values"
-                                    )
-                    break
-                else:
-                    # Accumulate the byte in the buffer
-                    message_buffer += byte
-        while True:
-            if (key == 0x0D) and (
-                milliseconds_since_start_of_script >= next_sample_time
-            ):
-                next_sample_time = milliseconds_since_start_of_script + sample_interval
-                logger.info("%s, %.1f dB", timestamp, round(dB, 1))
-                write_data_to_influxdb(dB, database_timestamp, influxdb_measurement)
-                # if dB > maximum_noise_level or tracking_peak:
-                #     if not tracking_peak:
-                #         # Start tracking the peak
-                #         tracking_peak = True
-                #         sample_count = 0
-                #         max_dB = dB
-                #     else:
-                #         # Update the maximum dB value
-                #         if dB > max_dB:
-                #             max_dB = dB
-                #
-                #     sample_count += 1
-                #
-                #     if sample_count >= 20:
-                #         # Log the maximum dB value found in the 20 samples
-                #         send_pushover_message(
-                #             f"VIOLATION: Peak Noise Level of {max_dB} dB"
-                #         )
-                #         logger.info("VIOLATION: Peak Noise Level of %.1f dB", max_dB)
-                #         tracking_peak = False  # Stop tracking after logging the peak
-                #         max_dB = None  # Reset the peak value
-                #         sample_count = 0  # Reset the sample count
-
-                # Update the list of last 4 samples
-                last_4_samples.append(dB)
-                if len(last_4_samples) > 4:
-                    last_4_samples.pop(0)
-
-                # Calculate the median value in the last 4 samples
-                if len(last_4_samples) == 4:
-                    median_dB_last_4 = statistics.median(last_4_samples)
-                    logger.info("Median dB in last 4 samples: %.1f dB", median_dB_last_4)
-
-                    if median_dB_last_4 > maximum_noise_level:
-                        write_pushover_message(
-                            f"VIOLATION: Median Noise Level of {median_dB_last_4} dB"
-                        )
-                        logger.info("VIOLATION: Median Noise Level of %.1f dB", median_dB_last_4)
-
-                # Log data to CSV
-                # Full resolution
-                with open(f"logs/{current_date}-noise.csv", "a") as f:
-                    f.write(f"{timestamp},{round(dB, 1)}\n")
-
-                # Compliance resolution
-                if milliseconds_since_start_of_script >= next_compliance_sample_time:
-                    next_compliance_sample_time = (
-                        milliseconds_since_start_of_script + compliance_sample_interval
-                    )
-                    with open(f"logs/{current_date}-noise-compliance.csv", "a") as f:
-                        f.write(f"{timestamp},{round(dB, 1)}\n")
-                    # write a copy to influxdb for display in Grafana
-                    write_data_to_influxdb(
-                        dB, database_timestamp, influxdb_measurement_compliance
-                    )
-                break
-            else:
-                # Discard the current sample and select the next sample
-                break
+                sample = await asyncio.wait_for(samples.get(), 1)
+            except asyncio.TimeoutError:
+                if readers_finished(readers):
+                    return
+                flush_recordings()
+                continue
+        else:
+            sample = samples.get_nowait()
+        process_sample(sample)
+
+
+# Start each meter's reader, returning the readers
+def start_readers(active_meters):
+    for meter in active_meters:
+        meter.next_sample_ns = meter.reader.clock.now_ns() + sample_interval_ns
+        meter.reader.start()
+        logger.info("Reading %s at %s", meter.reader.device, meter.location)
+    readers = [meter.reader for meter in active_meters]
+
+    # Metrics read from their owners when scraped
+    metrics.counter(
+        "slm_frames_decoded_total",
+        "Frames decoded from the serial port",
+        lambda: sum(reader.decoder.frames for reader in readers),
+    )
+    metrics.counter(
+        "slm_serial_overruns_total",
+        "Frames dropped because the serial loop fell behind",
+        lambda: sum(reader.overruns for reader in readers),
+    )
+    metrics.counter(
+        "slm_serial_reconnects_total",
+        "Times the serial port was reopened",
+        lambda: sum(reader.reconnects for reader in readers),
+    )
+    return readers
+
+
+# True once a replay has finished; raises if a reader has died
+def readers_finished(readers):
+    for reader in readers:
+        if not reader.is_alive():
+            if reader.finished:
+                logger.info("Replay finished")
+                return True
+            raise RuntimeError(f"Serial reader for {reader.device} stopped")
+    return False
+
+
+def flush_recordings():
+    for meter in meters:
+        if meter.recording:
+            meter.recording.flush()
+
+
+# Log one sample from any meter
+def process_sample(sample):
+    # Scan incoming frames for dB values
+    meter = sample.source
+    frame = sample.frame
+    if type(frame) is ShortFrame:
+        short_buffers.inc()
+        logger.warning("Message buffer too short to extract dB values")
+        return
+    meter_state = meter.meter_state
+    if type(frame) is not DbFrame:
+        flags = meter_state.flags
+        meter_state.update(frame)
+        if meter_state.flags != flags:
+            if sample_ring is not None:
+                sample_ring.publish(
+                    sample.timestamp_ns, 0, meter_state.flags, KIND_SETTINGS, meter.index
+                )
+            range_name, speed, status = describe_flags(meter_state.flags)
+            logger.info(
+                "%sMeter set to range %s, speed %s, %s",
+                meter.label,
+                range_name or "unknown",
+                speed or "unknown",
+                status or "no hold",
+            )
+        return
+
+    # Time of collection, stamped by the reader
+    dB = frame.dB
+    database_timestamp = sample.timestamp_ns
+    # Range, speed and over or under range, stored with every sample
+    flags = meter_state.sample_flags(dB)
+    if sample_ring is not None:
+        sample_ring.publish(
+            database_timestamp, round(dB * 10), flags, meter=meter.index
+        )
+    if meter.recording:
+        meter.recording.write(database_timestamp, dB, flags)
+    # Every frame counts towards the peak level of a passing
+    if meter.passing_join is not None:
+        match_passings(meter, database_timestamp, dB)
+
+    # Every frame counts towards the compliance interval levels
+    compliance_levels = meter.compliance_aggregator.add(database_timestamp, dB, flags)
+    if compliance_levels:
+        write_compliance_levels(meter, compliance_levels)
+    for measurement, aggregator in meter.rollups:
+        levels = aggregator.add(database_timestamp, dB, flags)
+        if levels:
+            write_levels_to_influxdb(measurement, meter.tags, levels)
+
+    if database_timestamp < meter.next_sample_ns:
+        # Discard the current sample and select the next sample
+        frames_discarded.inc()
+        return
+    loop_lag.observe((meter.reader.clock.now_ns() - database_timestamp) / 1e9)
+
+    timestamp = format_timestamp(database_timestamp)
+    meter.next_sample_ns = database_timestamp + sample_interval_ns
+    logger.info("%s%s, %.1f dB", meter.label, timestamp, round(dB, 1))
+    write_data_to_influxdb(
+        dB, database_timestamp, influxdb_measurement, meter.tags, flags
+    )
+    # Update the violation detection window
+    violation_window = meter.violation_window
+    violation_window.add(database_timestamp, dB)
+
+    # Calculate the window statistic once the window is full
+    window_dB = None
+    if violation_window.full:
+        statistic_name = violation_statistic.capitalize()
+        window_dB = violation_window.statistic(violation_statistic)
+        logger.info(
+            "%s%s dB in %s: %.1f dB",
+            meter.label,
+            statistic_name,
+            violation_window_label,
+            window_dB,
+        )
+
+        event = meter.episode_tracker.update(
+            database_timestamp, window_dB, dB, violation_window
+        )
+        if event:
+            handle_violation_event(meter, *event, statistic_name, window_dB)
+
+    # One tuple replaced per sample, so the monitor thread never sees a
+    # half-updated meter
+    if monitor_server is not None:
+        tracker = meter.episode_tracker
+        meter.live = LiveLevels(
+            database_timestamp,
+            dB,
+            flags,
+            violation_window.median,
+            violation_window.leq,
+            window_dB,
+            tracker.state,
+            tracker.episode,
+        )
+
+    # Log data to CSV
+    # Full resolution
+    meter.noise_csv.write(
+        database_timestamp,
+        f"{timestamp},{round(dB, 1)}{describe_sample_flags(flags)[0]}\n",
+    )
+
+
+# Log what is still in progress for every meter and close the logs
+def finish_meters():
+    for meter in meters:
+        # Log the compliance interval in progress
+        compliance_levels = meter.compliance_aggregator.flush()
+        if compliance_levels:
+            write_compliance_levels(meter, compliance_levels)
+        for measurement, aggregator in meter.rollups:
+            levels = aggregator.flush()
+            if levels:
+                write_levels_to_influxdb(measurement, meter.tags, levels)
+        # Record a violation still in progress
+        event = meter.episode_tracker.flush()
+        if event:
+            handle_violation_event(meter, *event)
+        # Record what is held back waiting for passings
+        join = meter.passing_join
+        if join is not None:
+            for level in join.flush():
+                write_passing(meter, level)
+            for episode in join.release():
+                record_violation(
+                    meter,
+                    episode,
+                    join.cars(episode.start_ns, episode.end_ns, episode.peak_ns),
+                )
+        if meter.recording:
+            meter.recording.close()
+    # Make sure every CSV row is on disk
+    csv_logs.close()
+
+
+# Flush the CSV logs in a worker thread, so fsync never stalls the loop
+async def flush_logs_periodically():
+    while True:
+        await asyncio.sleep(csv_flush_interval / 1000)
+        await asyncio.to_thread(csv_logs.flush)
+
+
+# Check InfluxDB from a background thread, so sampling starts straight away
+def check_influxdb():
+    try:
+        heath_check = get_influxdb_client().health().status
+    except Exception as e:
+        # e.g. the server is unreachable
+        logger.error("Exception while connecting to InfluxDB: %s", e)
+        write_pushover_message("Sound Level Meter failed to connect to InfluxDB")
+        return
+    logger.info("InfluxDB health check returned %s", heath_check)
+    if heath_check == "pass":
+        logger.info("Connected to InfluxDB successfully.")
+    elif heath_check == "fail":
+        logger.error("Exception while connecting to InfluxDB")
+        write_pushover_message("Sound Level Meter failed to connect to InfluxDB")
+
+
+# InfluxDB connection for --asyncio, created on first use
+influxdb_client_async = None
+
+
+async def get_influxdb_client_async():
+    global influxdb_client_async
+    if influxdb_client_async is None:
+        # Imported in a worker thread so the event loop keeps reading meters
+        module = await asyncio.to_thread(
+            importlib.import_module, "influxdb_client.client.influxdb_client_async"
+        )
+        if influxdb_client_async is None:
+            influxdb_client_async = module.InfluxDBClientAsync(
+                url=f"http://{influxdb_host}:{influxdb_port}",
+                token=influxdb_token,
+                org=influxdb_org,
+                timeout=influxdb_timeout,
+            )
+    return influxdb_client_async
+
+
+# Called by the writer task the first time it writes
+async def connect_influxdb_async():
+    return (await get_influxdb_client_async()).write_api()
+
+
+async def check_influxdb_async():
+    try:
+        client = await get_influxdb_client_async()
+        if await client.ping():
+            logger.info("Connected to InfluxDB successfully.")
+            return
+        logger.error("Exception while connecting to InfluxDB")
+    except Exception as e:
+        logger.error("Exception while connecting to InfluxDB: %s", e)
+    write_pushover_message("Sound Level Meter failed to connect to InfluxDB")
+
+
+# Send one alert to Pushover for --asyncio.  Runs in a worker thread, which
+# also takes the time to import the Pushover client on first use.
+def send_pushover_alert(message, title):
+    from send_pushover import send_pushover_message
+
+    send_pushover_message(message, title)
+
+
+# Run everything in one event loop: the serial readers, the InfluxDB writer
+# using the async client, Pushover alerts (replacing send_pushover.py) and
+# CSV flushing
+async def main_async(replay=None, replay_meter=None):
+    global influx_writer, alert_client
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    influx_writer = AsyncInfluxWriter(
+        None,
+        influxdb_bucket,
+        influxdb_org,
+        batch_size=influxdb_batch_size,
+        flush_interval=influxdb_flush_interval / 1000,
+        queue_size=influxdb_queue_size,
+        spill_path=influxdb_spill_file,
+        connect=connect_influxdb_async,
+        journal=influx_journal,
+        backfill_batch_size=influxdb_backfill_batch_size,
+    ).start()
+    alert_client = AsyncAlertDispatcher(
+        send_pushover_alert, coalesce_window=alert_coalesce_interval / 1000
+    ).start()
+    csv_logs.disable_auto_flush()
+    tasks = [
+        loop.create_task(flush_logs_periodically()),
+        loop.create_task(check_influxdb_async()),
+    ]
+    try:
+        write_pushover_message("SDMA Sound Level Meter starting")
+        await update_async(replay, replay_meter)
+    except asyncio.CancelledError:
+        logger.info("Stopping")
+    finally:
+        for task in tasks:
+            task.cancel()
+        finish_meters()
+        # Flush queued points, leaving them in the journal or spill file if
+        # InfluxDB is down
+        await influx_writer.close()
+        if influx_journal:
+            influx_journal.close()
+        await alert_client.close()
+        if influxdb_client_async is not None:
+            await influxdb_client_async.close()
+
+
+# Metrics kept by the InfluxDB writer and the alert client
+def register_metrics():
+    metrics.gauge(
+        "slm_influxdb_queue_depth",
+        "Points waiting for the InfluxDB writer",
+        lambda: influx_writer.queue_depth,
+    )
+    metrics.counter(
+        "slm_influxdb_points_dropped_total",
+        "Points dropped because the InfluxDB queue was full",
+        lambda: influx_writer.points_dropped,
+    )
+    metrics.counter(
+        "slm_influxdb_points_spilled_total",
+        "Points spilled to disk while InfluxDB was unavailable",
+        lambda: influx_writer.points_spilled,
+    )
+    if influx_journal:
+        metrics.gauge(
+            "slm_journal_pending_bytes",
+            "Journaled points not yet acknowledged by InfluxDB",
+            influx_journal.pending_bytes,
+        )
+        metrics.counter(
+            "slm_journal_segments_compacted_total",
+            "Journal segments deleted once acknowledged",
+            lambda: influx_journal.segments_compacted,
+        )
+    metrics.gauge(
+        "slm_alert_queue_depth",
+        "Alerts waiting to be sent to send_pushover.py",
+        lambda: alert_client.queue_depth,
+    )
+    metrics.counter(
+        "slm_alerts_dropped_total",
+        "Alerts dropped because the alert queue was full",
+        lambda: alert_client.alerts_dropped,
+    )
+    if timing_enabled:
+        metrics.counter(
+            "slm_passings_received_total",
+            "Passings received from the timing system",
+            lambda: passing_feed.passings_received if passing_feed else 0,
+        )
+        metrics.counter(
+            "slm_passings_rejected_total",
+            "Malformed lines received from the timing system",
+            lambda: passing_feed.lines_rejected if passing_feed else 0,
+        )
+
+
+# Live monitor server, started by main() if enabled
+monitor_server = None
+
+
+# State of every meter and of the pipeline for monitor.py, read from the
+# monitor thread.  Only values the sample loop replaces whole are read.
+def monitor_snapshot():
+    snapshot_meters = []
+    for meter in meters:
+        live = meter.live
+        range_name, speed, status = describe_flags(
+            live.flags if live else meter.meter_state.flags
+        )
+        episode = live.episode if live else None
+        snapshot_meters.append(
+            {
+                "location": meter.location,
+                "limit": meter.maximum_noise_level,
+                "statistic": violation_statistic,
+                "window": violation_window_label,
+                "dB": live.dB if live else None,
+                "median": live.median if live else None,
+                "leq": round(live.leq, 1) if live else None,
+                "window_dB": live.window_dB if live else None,
+                "state": live.state if live else "idle",
+                "episode_start_ns": episode.start_ns if episode else None,
+                "episode_peak": episode.peak_db if episode else None,
+                "range": range_name,
+                "speed": speed,
+                "status": status,
+                "sample_age": round(
+                    (meter.reader.clock.now_ns() - live.timestamp_ns) / 1e9, 1
+                )
+                if live and meter.reader
+                else None,
+            }
+        )
+    readers = [meter.reader for meter in meters if meter.reader]
+    return {
+        "time_ns": time.time_ns(),
+        "meters": snapshot_meters,
+        "health": {
+            "influx_queue": influx_writer.queue_depth,
+            "influx_dropped": influx_writer.points_dropped,
+            "journal_pending_bytes": influx_journal.pending_bytes()
+            if influx_journal
+            else 0,
+            "overruns": sum(reader.overruns for reader in readers),
+            "reconnects": sum(reader.reconnects for reader in readers),
+            "frames_discarded": frames_discarded.value,
+            "alerts_queued": alert_client.queue_depth,
+        },
+    }
+
+
+# Turn SIGTERM (e.g. systemctl stop) into a normal exit so logs are flushed
+def handle_sigterm(signum, frame):
+    raise SystemExit(0)
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Sound level meter logger")
+    parser.add_argument(
+        "--replay", metavar="CAPTURE", help="read a serial capture instead of the meter"
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="replay speed, e.g. 10 for 10x, 0 for as fast as possible",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="run in one asyncio event loop, sending Pushover alerts directly",
+    )
+    parser.add_argument(
+        "--meter",
+        help="meter to replay as, the name of its [Hardware:name] section",
+    )
+    args = parser.parse_args()
+    replay_meter = None
+    if args.meter:
+        replay_meter = next((m for m in meters if m.name == args.meter), None)
+        if replay_meter is None:
+            parser.error(f"no [Hardware:{args.meter}] section in slm-log.ini")
+
+    global monitor_server, sample_ring, passing_feed
+    signal.signal(signal.SIGTERM, handle_sigterm)
     try:
         logger.info("Starting Sound Level Meter")
+        if metrics_enabled:
+            register_metrics()
+            metrics.start_server(metrics_address, metrics_port)
+        if sample_ring_enabled:
+            sample_ring = SampleRing(
+                sample_ring_name,
+                sample_ring_capacity,
+                [meter.location for meter in meters],
+            )
+        if monitor_enabled:
+            monitor_server = MonitorServer(
+                monitor_socket, monitor_snapshot, monitor_interval / 1000
+            ).start()
+        if timing_enabled:
+            passing_feed = PassingFeed(
+                timing_address, timing_port, add_passing, log_tz
+            ).start()
+        replay = None
+        if args.replay:
+            logger.info("Replaying %s at speed %g", args.replay, args.speed)
+            replay = ReplaySerial(args.replay, args.speed)
+        if args.asyncio:
+            asyncio.run(main_async(replay, replay_meter))
+            return
+
+        alert_client.start()
         write_pushover_message("SDMA Sound Level Meter starting")
 
-        heath_check = influxdb_client.health().status
-        logger.info("InfluxDB health check returned %s", heath_check)
-        if heath_check == "pass":
-            logger.info("Connected to InfluxDB successfully.")
-        elif heath_check == "fail":
-            logger.error("Exception while connecting to InfluxDB")
-            write_pushover_message("Sound Level Meter failed to connect to InfluxDB")
+        threading.Thread(
+            target=check_influxdb, name="influxdb-health", daemon=True
+        ).start()
 
-        # Start updating noise level
-        update()
+        # Start updating noise level straight away, whatever state InfluxDB
+        # and the alert sender are in
+        influx_writer.start()
+        update(replay, replay_meter)
 
     except Exception as e:
         with open("error.log", "a") as f:
@@ -287,6 +1116,21 @@ def main():
             f.write(traceback.format_exc())
             logger.error(str(e))
             logger.error(traceback.format_exc())
+    finally:
+        if monitor_server is not None:
+            monitor_server.close()
+        if sample_ring is not None:
+            sample_ring.close()
+        if passing_feed is not None:
+            passing_feed.close()
+        if not args.asyncio:
+            finish_meters()
+            # Flush queued points, leaving them in the journal or spill file if
+            # InfluxDB is down
+            influx_writer.close()
+            if influx_journal:
+                influx_journal.close()
+            alert_client.close()
 
 
 # Execute the main function
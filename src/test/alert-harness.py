@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from alerts import Alert, AlertClient, AlertDispatcher, AlertServer
+
+
+# Stand-in for api.pushover.net: records each message and can be told to
+# fail the next few requests
+class StubPushover(BaseHTTPRequestHandler):
+    received = []
+    fail_next = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if StubPushover.fail_next:
+            StubPushover.fail_next -= 1
+            self.send_response(500)
+            self.end_headers()
+            return
+        StubPushover.received.append((time.monotonic(), json.loads(body)))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(b'{"status":1}')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def wait_for(count, timeout=10):
+    deadline = time.monotonic() + timeout
+    while len(StubPushover.received) < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return len(StubPushover.received)
+
+
+def main():
+    stub = HTTPServer(("127.0.0.1", 0), StubPushover)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{stub.server_port}/1/messages.json"
+
+    def send(message, title):
+        request = urllib.request.Request(
+            url,
+            data=json.dumps({"message": message, "title": title}).encode(),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request, timeout=5).read()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), "alerts.sock")
+    dispatcher = AlertDispatcher(send, coalesce_window=1.0).start()
+    server = AlertServer(socket_path, dispatcher).start()
+    client = AlertClient(socket_path).start()
+
+    # Latency of a single alert
+    started = time.monotonic()
+    client.send("Sound Level Meter starting")
+    assert wait_for(1) == 1, "alert not delivered"
+    latency = StubPushover.received[0][0] - started
+    print(f"single alert latency: {latency * 1000:.1f} ms")
+    assert latency < 1.0
+
+    # A loud car: one violation every 250 ms for 2 s is coalesced into the
+    # first alert plus one summary per window
+    for i in range(8):
+        client.send(f"VIOLATION: Median Noise Level of {90 + i}.0 dB", key="violation")
+        time.sleep(0.25)
+    wait_for(4, timeout=3)
+    time.sleep(1.5)
+    violations = [m for _, m in StubPushover.received if "VIOLATION" in m["message"]]
+    for message in violations:
+        print(f"  {message['message']}")
+    print(f"8 violations sent as {len(violations)} notifications")
+    assert 2 <= len(violations) <= 3
+
+    # Pushover failing: the alert is retried until it gets through
+    StubPushover.fail_next = 2
+    before = len(StubPushover.received)
+    client.send("Sound Level Meter failed to connect to InfluxDB")
+    assert wait_for(before + 1, timeout=10) == before + 1, "alert lost after failures"
+    print(f"delivered after {dispatcher.send_failures} failed attempts")
+
+    # The same alert id twice is only sent once
+    before = len(StubPushover.received)
+    duplicate = Alert("duplicate-id", None, "Sent once", None)
+    client._queue.put(duplicate)
+    client._queue.put(duplicate)
+    wait_for(before + 2, timeout=2)
+    sent = [m for _, m in StubPushover.received[before:] if m["message"] == "Sent once"]
+    print(f"duplicate alert delivered {len(sent)} time(s)")
+    assert len(sent) == 1
+
+    # Sender down with the queue full: the alert being delivered is kept,
+    # and only the newest alert is dropped
+    down_path = os.path.join(tempfile.mkdtemp(), "alerts.sock")
+    down_client = AlertClient(down_path, queue_size=2).start()
+    down_client.send("Queued 1")
+    while down_client._queue.qsize():
+        time.sleep(0.01)
+    for i in range(2, 5):
+        down_client.send(f"Queued {i}")
+    down_server = AlertServer(down_path, dispatcher).start()
+    before = len(StubPushover.received)
+    wait_for(before + 3, timeout=10)
+    time.sleep(0.5)
+    queued = [m["message"] for _, m in StubPushover.received[before:]]
+    print(f"sender down, queue full: delivered {queued}, "
+          f"{down_client.alerts_dropped} dropped")
+    assert queued == ["Queued 1", "Queued 2", "Queued 3"]
+    assert down_client.alerts_dropped == 1
+
+    down_client.close()
+    down_server.close()
+    client.close()
+    server.close()
+    dispatcher.stop()
+    stub.shutdown()
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from capture import read_capture
+from qm1592 import DbFrame, FrameDecoder, get_high_nibble, get_low_nibble
+
+
+# Build a stream that looks like the meter: a dB frame followed by the
+# status frames it sends in between
+def synthetic_stream(frames):
+    status = [b"\x02", b"\x4b\x00", b"\x0c\x00\x00", b"\x1b\x00", b"\x06\x00"]
+    stream = bytearray()
+    for i in range(frames):
+        tenths = 600 + (i * 7) % 400
+        stream += b"\xa5\x0d" + bytes(
+            [((tenths // 1000) << 4) | (tenths // 100) % 10, ((tenths // 10) % 10) << 4 | tenths % 10]
+        )
+        stream += b"\xa5" + status[i % len(status)]
+    return bytes(stream + b"\xa5")
+
+
+# Serial port stand-in: each read is a real read() system call on a file
+# holding the stream, and in_waiting reports up to chunk bytes at a time
+class FakeSerial:
+    def __init__(self, path, size, chunk):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._size = size
+        self._position = 0
+        self._chunk = chunk
+
+    @property
+    def in_waiting(self):
+        return min(self._chunk, self._size - self._position)
+
+    def read(self, size=1):
+        data = os.read(self._fd, size)
+        self._position += len(data)
+        return data
+
+    def close(self):
+        os.close(self._fd)
+
+
+# The byte-at-a-time loop that slm-log.py used before FrameDecoder.  Each
+# loop returns the number of dB frames and the sum of their values, so both
+# do the same work and can be checked against each other.
+def legacy(ser):
+    values = 0
+    total = 0.0
+    message_buffer = bytearray()
+    while True:
+        byte = ser.read(1)
+        if not byte:
+            return values, total
+        if byte.hex() == "a5":
+            if message_buffer:
+                msg = message_buffer
+                if msg[0] == 0x0D and len(msg) > 2:
+                    hundreds = get_high_nibble(msg[1])
+                    tens = get_low_nibble(msg[1])
+                    ones = get_high_nibble(msg[2])
+                    tenths = get_low_nibble(msg[2])
+                    dB = hundreds * 100 + tens * 10 + ones + tenths / 10
+                    values += 1
+                    total += dB
+            message_buffer = bytearray()
+        else:
+            message_buffer += byte
+
+
+def chunked(ser):
+    values = 0
+    total = 0.0
+    decoder = FrameDecoder()
+    while True:
+        data = ser.read(ser.in_waiting or 1)
+        if not data:
+            return values, total
+        for frame in decoder.feed(data):
+            if type(frame) is DbFrame:
+                values += 1
+                total += frame.dB
+
+
+def run(name, function, path, size, chunk, repeat):
+    best = None
+    for _ in range(repeat):
+        ser = FakeSerial(path, size, chunk)
+        started = time.perf_counter()
+        values, total = function(ser)
+        elapsed = time.perf_counter() - started
+        ser.close()
+        best = elapsed if best is None else min(best, elapsed)
+    print(
+        f"{name:>10}: {values} dB frames (sum {total:.1f}), "
+        f"{size / best / 1e6:8.2f} MB/s, {best / values * 1e6:6.2f} us/frame"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark QM1592 frame decoding")
+    parser.add_argument("capture", nargs="?", help="capture saved by dump-raw-values.py")
+    parser.add_argument("--frames", type=int, default=200000, help="synthetic dB frames")
+    parser.add_argument("--chunk", type=int, default=64, help="bytes available per read")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.capture:
+        _, records = read_capture(args.capture)
+        data = b"".join(chunk for _, chunk in records)
+    else:
+        data = synthetic_stream(args.frames)
+
+    with tempfile.NamedTemporaryFile(suffix=".bin") as f:
+        f.write(data)
+        f.flush()
+        print(f"{len(data)} bytes, {args.chunk} bytes per read")
+        run("legacy", legacy, f.name, len(data), args.chunk, args.repeat)
+        run("chunked", chunked, f.name, len(data), args.chunk, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
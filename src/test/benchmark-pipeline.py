@@ -0,0 +1,339 @@
+import argparse
+import configparser
+import cProfile
+import gc
+import importlib.util
+import logging
+import os
+import pstats
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from array import array
+from http.server import ThreadingHTTPServer
+
+here = os.path.dirname(os.path.abspath(__file__))
+app = os.path.join(here, "..", "app")
+sys.path.insert(0, app)
+from acquisition import Sample
+from capture import read_capture
+from passings import Passing
+from qm1592 import DbFrame, FrameDecoder, decode_frame
+from sample_ring import SampleRing
+
+# Times taken for every dB frame: decoding it, and slm-log.py process_sample()
+STAGES = ["decode", "process", "total"]
+
+# A synthetic car crosses the timing loop this often (ns)
+PASSING_INTERVAL_NS = 45_000_000_000
+
+
+# Load a script whose file name is not a valid module name
+def load_script(name, directory=here):
+    spec = importlib.util.spec_from_file_location(
+        name.replace("-", "_"), os.path.join(directory, f"{name}.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# Chunks of serial data as (arrival offset in ns, bytes), from a capture or
+# synthesised
+def load_stream(capture, hours):
+    if capture:
+        start_ns, records = read_capture(capture)
+        return start_ns, list(records)
+    synthesise = load_script("synthesise-capture")
+    with tempfile.NamedTemporaryFile(suffix=".slmc") as f:
+        sys.argv = ["synthesise-capture", f.name, "--hours", str(hours)]
+        synthesise.main()
+        start_ns, records = read_capture(f.name)
+        return start_ns, list(records)
+
+
+# slm-log.ini for the run: the shipped settings, with every file kept in
+# directory, InfluxDB at the stub, and the sample ring and timing enabled
+def write_config(directory, influx_port):
+    config = configparser.ConfigParser()
+    config.read(os.path.join(app, "slm-log.ini"))
+    config["InfluxDB"]["host"] = "127.0.0.1"
+    config["InfluxDB"]["port"] = str(influx_port)
+    config["InfluxDB"]["journal_directory"] = os.path.join(directory, "influx-journal")
+    config["InfluxDB"]["spill_file"] = os.path.join(directory, "influx-spill.lp")
+    config["Pushover"]["socket"] = os.path.join(directory, "slm-alerts.sock")
+    config["CSV"]["directory"] = os.path.join(directory, "logs")
+    config["SampleRing"]["enabled"] = "yes"
+    config["SampleRing"]["name"] = f"slm-benchmark-{os.getpid()}"
+    config["Timing"]["enabled"] = "yes"
+    with open(os.path.join(directory, "slm-log.ini"), "w") as f:
+        config.write(f)
+
+
+# Times of the capture, as a capture.ReplaySerial gives them
+class CaptureClock:
+    def __init__(self):
+        self.timestamp_ns = 0
+
+    def now_ns(self):
+        return self.timestamp_ns
+
+
+# Start slm-log.py as main() would, reading its settings from directory and
+# logging to a file there rather than the terminal
+def start_logger(directory):
+    logging.basicConfig(
+        filename=os.path.join(directory, "slm-log.log"),
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    os.chdir(directory)
+    slm = load_script("slm-log", app)
+    slm.sample_ring = SampleRing(
+        slm.sample_ring_name,
+        slm.sample_ring_capacity,
+        [meter.location for meter in slm.meters],
+    )
+    slm.influx_writer.start()
+    return slm
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(int(len(sorted_values) * percent / 100), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+# Feed every chunk through slm-log.py as update() does: decode its frames
+# and hand each to process_sample(), with a passing from the timing system
+# now and then.  Each dB frame is timed, except in the last traced_fraction
+# of the stream, which runs under tracemalloc to measure how much each
+# frame allocates.
+def run_pipeline(slm, start_ns, records, traced_fraction, profile=None):
+    meter = slm.meters[0]
+    clock = CaptureClock()
+    meter.reader = slm.SerialReader("benchmark", clock=clock, source=meter)
+    decoder = FrameDecoder()
+    process_sample = slm.process_sample
+    feed_delay_ns = slm.timing_feed_delay * 1_000_000
+    passings = [0, start_ns + PASSING_INTERVAL_NS]
+    traced_from = int(len(records) * (1 - traced_fraction))
+
+    # Set the clock, and report each car a little after it crosses the loop
+    # as the timing system does
+    def advance(timestamp_ns):
+        clock.timestamp_ns = timestamp_ns
+        cars, passing_ns = passings
+        if timestamp_ns >= passing_ns + feed_delay_ns:
+            cars += 1
+            slm.add_passing(Passing(passing_ns, str(cars % 60 + 1), f"{cars:07d}"))
+            passings[:] = cars, passing_ns + PASSING_INTERVAL_NS
+
+    # Arrays of plain integers, so the timings themselves allocate no objects
+    timings = {stage: array("q") for stage in STAGES}
+    frames = 0
+    perf = time.perf_counter_ns
+
+    gc.collect()
+    collections_before = gc.get_stats()[0]["collections"]
+    if profile:
+        profile.enable()
+    started = perf()
+    for offset_ns, data in records[:traced_from]:
+        timestamp_ns = start_ns + offset_ns
+        advance(timestamp_ns)
+        t0 = perf()
+        for raw in decoder.split(data):
+            sample = Sample(timestamp_ns, decode_frame(raw), meter)
+            t1 = perf()
+            process_sample(sample)
+            t2 = perf()
+            if type(sample.frame) is DbFrame:
+                frames += 1
+                timings["decode"].append(t1 - t0)
+                timings["process"].append(t2 - t1)
+                timings["total"].append(t2 - t0)
+            t0 = perf()
+    elapsed = (perf() - started) / 1e9
+    collections = gc.get_stats()[0]["collections"] - collections_before
+    if profile:
+        profile.disable()
+
+    # Everything the frame had allocated at its peak, so temporaries count
+    # even though they are freed by the time it returns
+    allocated = array("q")
+    tracemalloc.start()
+    for offset_ns, data in records[traced_from:]:
+        timestamp_ns = start_ns + offset_ns
+        advance(timestamp_ns)
+        for raw in decoder.split(data):
+            sample = Sample(timestamp_ns, decode_frame(raw), meter)
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            process_sample(sample)
+            if type(sample.frame) is DbFrame:
+                allocated.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    # Time for the writer to get everything into the stub
+    drain_started = time.monotonic()
+    slm.finish_meters()
+    slm.influx_writer.close()
+    drain = time.monotonic() - drain_started
+    slm.influx_journal.close()
+    slm.sample_ring.close()
+
+    return {
+        "frames": frames,
+        "elapsed": elapsed,
+        "throughput": frames / elapsed,
+        "timings": timings,
+        "traced_frames": len(allocated),
+        "bytes_per_frame": sum(allocated) / max(len(allocated), 1),
+        "median_bytes_per_frame": statistics.median(allocated) if allocated else 0,
+        "gc_per_1000_frames": collections * 1000 / frames,
+        "influx": slm.influx_writer.stats(),
+        "influx_drain": drain,
+        "passings": passings[0],
+        "alerts": slm.alert_client.queue_depth,
+    }
+
+
+def report(result):
+    print(
+        f"\n{result['frames']} dB frames in {result['elapsed']:.2f} s: "
+        f"{result['throughput']:,.0f} frames/s"
+    )
+    print(f"{'stage':>12} {'p50 us':>10} {'p99 us':>10} {'p999 us':>10} {'max us':>10}")
+    summary = {}
+    for stage in STAGES:
+        values = sorted(result["timings"][stage])
+        p50, p99, p999 = (percentile(values, p) / 1000 for p in (50, 99, 99.9))
+        peak = values[-1] / 1000 if values else 0
+        summary[stage] = p99
+        print(f"{stage:>12} {p50:10.2f} {p99:10.2f} {p999:10.2f} {peak:10.2f}")
+    influx = result["influx"]
+    print(
+        f"\nallocated per frame over {result['traced_frames']} traced frames: "
+        f"mean {result['bytes_per_frame']:,.0f} bytes, "
+        f"median {result['median_bytes_per_frame']:,.0f} bytes"
+    )
+    print(f"gen0 collections per 1000 frames: {result['gc_per_1000_frames']:.2f}")
+    print(
+        f"influx: {influx['points_written']} points in {influx['batches_written']} "
+        f"batches, max batch latency {influx['max_batch_latency'] * 1000:.1f} ms, "
+        f"{influx['points_dropped']} dropped, drained in {result['influx_drain']:.2f} s"
+    )
+    print(f"passings: {result['passings']}, alerts queued: {result['alerts']}")
+    return summary
+
+
+# Compare against the thresholds file, returning the number of regressions
+def check_thresholds(path, result, summary):
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        print(f"\nNo thresholds file {path}, skipping regression check")
+        return 0
+    failures = 0
+    print(f"\nRegression check against {path}:")
+    minimum = config.getfloat("throughput", "min_frames_per_second", fallback=0)
+    ok = result["throughput"] >= minimum
+    failures += not ok
+    print(
+        f"  {'PASS' if ok else 'FAIL'} throughput "
+        f"{result['throughput']:,.0f} >= {minimum:,.0f}"
+    )
+    for stage, p99 in summary.items():
+        limit = config.getfloat("p99_us", stage, fallback=None)
+        if limit is None:
+            continue
+        ok = p99 <= limit
+        failures += not ok
+        print(f"  {'PASS' if ok else 'FAIL'} {stage} p99 {p99:.2f} us <= {limit:.2f} us")
+    limit = config.getfloat("allocations", "max_bytes_per_frame", fallback=None)
+    if limit is not None:
+        ok = result["median_bytes_per_frame"] <= limit
+        failures += not ok
+        print(
+            f"  {'PASS' if ok else 'FAIL'} median bytes allocated per frame "
+            f"{result['median_bytes_per_frame']:,.0f} <= {limit:,.0f}"
+        )
+    return failures
+
+
+# Write the current results, with headroom, as the new thresholds
+def write_thresholds(path, result, summary, headroom):
+    config = configparser.ConfigParser()
+    config["throughput"] = {
+        "min_frames_per_second": f"{result['throughput'] / headroom:.0f}"
+    }
+    config["p99_us"] = {stage: f"{p99 * headroom:.2f}" for stage, p99 in summary.items()}
+    config["allocations"] = {
+        "max_bytes_per_frame": f"{result['median_bytes_per_frame'] * headroom:.0f}"
+    }
+    with open(path, "w") as f:
+        f.write(
+            "# Regression thresholds for benchmark-pipeline.py, written with\n"
+            f"# --write-thresholds (headroom x{headroom:g}).  Timings depend on the\n"
+            "# machine, so write these on the hardware used at events.\n"
+        )
+        config.write(f)
+    print(f"\nThresholds written to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the slm-log pipeline")
+    parser.add_argument("capture", nargs="?", help="capture from dump-raw-values.py")
+    parser.add_argument("--hours", type=float, default=2.0, help="synthetic stream length")
+    parser.add_argument(
+        "--traced-fraction",
+        type=float,
+        default=0.1,
+        help="fraction of the stream, at the end, run under tracemalloc",
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="also print where the time goes"
+    )
+    parser.add_argument(
+        "--thresholds", default=os.path.join(here, "benchmark-thresholds.ini")
+    )
+    parser.add_argument("--write-thresholds", action="store_true")
+    parser.add_argument("--headroom", type=float, default=2.0)
+    args = parser.parse_args()
+    args.thresholds = os.path.abspath(args.thresholds)
+
+    start_ns, records = load_stream(args.capture, args.hours)
+
+    # Local stand-in for InfluxDB
+    StubInfluxDB = load_script("stub-influxdb").StubInfluxDB
+    stub = ThreadingHTTPServer(("127.0.0.1", 0), StubInfluxDB)
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+
+    cwd = os.getcwd()
+    profile = cProfile.Profile() if args.profile else None
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, stub.server_port)
+        try:
+            slm = start_logger(directory)
+            result = run_pipeline(slm, start_ns, records, args.traced_fraction, profile)
+        finally:
+            os.chdir(cwd)
+    stub.shutdown()
+
+    summary = report(result)
+    if profile:
+        print()
+        pstats.Stats(profile).sort_stats("tottime").print_stats(20)
+    if args.write_thresholds:
+        write_thresholds(args.thresholds, result, summary, args.headroom)
+        return
+    if check_thresholds(args.thresholds, result, summary):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
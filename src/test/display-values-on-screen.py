@@ -1,19 +1,85 @@
 import curses
+import os
+import sys
 from time import sleep
 import serial
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from qm1592 import (
+    DbFrame,
+    FrameDecoder,
+    MeterState,
+    MinMaxFrame,
+    RangeFrame,
+    RecordFrame,
+    SpeedFrame,
+    decode_frame,
+    describe_flags,
+)
+
 
 def clear_chars(win, y, x, num_chars):
     win.move(y, x)
     win.addstr(" " * num_chars)
 
 
-def get_high_nibble(byte):
-    return (byte & 0xF0) >> 4
+def show_db(win, frame, msg, state):
+    # DB Noise Level
+    win.addstr(1, 1, "dB: ")
+    clear_chars(win, 1, 10, 10)
+    clear_chars(win, 1, 20, 10)
+    win.addstr(1, 10, f"{frame.dB} dB")
+    win.addstr(1, 20, msg.hex())
+    show_status(win, state.sample_flags(frame.dB))
+
+
+def show_speed(win, frame, msg, state):
+    row = 2
+    win.addstr(row, 1, "Speed: ")
+    clear_chars(win, row, 10, 10)
+    win.addstr(row, 10, frame.speed)
+
+
+def show_range(win, frame, msg, state):
+    row = 3
+    win.addstr(row, 1, "Range: ")
+    clear_chars(win, row, 10, 10)
+    clear_chars(win, row, 20, 10)
+    win.addstr(row, 10, f"{frame.low} - {frame.high}")
+    win.addstr(row, 20, msg.hex())
+
 
+def show_minmax(win, frame, msg, state):
+    row = 4
+    win.addstr(row, 1, "MIN/MAX: ")
+    clear_chars(win, row, 10, 10)
+    win.addstr(row, 10, frame.mode)
 
-def get_low_nibble(byte):
-    return byte & 0x0F
+
+def show_record(win, frame, msg, state):
+    win.addstr(23, 1, "Record: ")
+    clear_chars(win, 23, 9, 21)
+    win.addstr(23, 9, "ON" if frame.on else "OFF")
+    win.addstr(23, 20, msg.hex())
+
+
+# Status of the latest dB frame, as logged with every sample
+def show_status(win, flags):
+    row = 19
+    win.addstr(row, 1, "Status: ")
+    win.move(row, 10)
+    win.clrtoeol()
+    win.addstr(row, 10, " ".join(filter(None, describe_flags(flags))))
+
+
+# Screen update for each kind of frame
+HANDLERS = {
+    DbFrame: show_db,
+    SpeedFrame: show_speed,
+    RangeFrame: show_range,
+    MinMaxFrame: show_minmax,
+    RecordFrame: show_record,
+}
 
 
 def main(stdscr):
@@ -43,145 +109,50 @@ def main(stdscr):
     # 31: Unknown
     # 26: Unknown
 
+    # Rows for frames whose meaning is not yet known
+    unknown_rows = {
+        0x0C: 6,
+        0x1B: 5,
+        0x06: 7,
+        0x0E: 11,
+        0x08: 13,
+        0x0B: 15,
+        0x19: 17,
+        0x1F: 21,
+    }
+
+    decoder = FrameDecoder()
+    state = MeterState()
     try:
-        message_buffer = bytearray()
         while True:
-            byte = ser.read(1)
-            if byte:
-                # Check if the byte is the delimiter (165 -> '¥')
-                if byte == b"\xa5":  # '\xa5' is the hex representation of 165
-                    if message_buffer:
-                        # Read the first byte of the message to determine the cursor position
-                        msg = message_buffer
-                        key = msg[0]
-                        if key:
-                            if key == 0x0D:
-                                # DB Noise Level
-                                win.addstr(1, 1, "dB: ")
-                                clear_chars(win, 1, 10, 10)
-                                clear_chars(win, 1, 20, 10)
-                                hundreds = get_high_nibble(msg[1])
-                                tens = get_low_nibble(msg[1])
-                                ones = get_high_nibble(msg[2])
-                                tenths = get_low_nibble(msg[2])
-                                db = hundreds * 100 + tens * 10 + ones + tenths / 10
-                                win.addstr(1, 10, f"{db} dB")
-                                win.addstr(1, 20, msg.hex())
-                            elif key == 0x02:
-                                row = 2
-                                win.addstr(row, 1, "Speed: ")
-                                clear_chars(win, row, 10, 10)
-                                win.addstr(row, 10, "FAST")
-                            elif key == 0x03:
-                                row = 2
-                                win.addstr(row, 1, "Speed: ")
-                                clear_chars(win, row, 10, 10)
-                                win.addstr(row, 10, "SLOW")
-                            elif key == 0x4B:
-                                row = 3
-                                win.addstr(row, 1, "Range: ")
-                                clear_chars(win, row, 10, 10)
-                                clear_chars(win, row, 20, 10)
-                                win.addstr(row, 10, "50 - 100")
-                                win.addstr(row, 20, msg.hex())
-                            elif key == 0x4C:
-                                row = 3
-                                win.addstr(row, 1, "Range: ")
-                                clear_chars(win, row, 10, 10)
-                                clear_chars(win, row, 20, 10)
-                                win.addstr(row, 10, "80 - 130")
-                                win.addstr(row, 20, msg.hex())
-                            elif key == 0x40:
-                                row = 3
-                                win.addstr(row, 1, "Range: ")
-                                clear_chars(win, row, 10, 10)
-                                clear_chars(win, row, 20, 10)
-                                win.addstr(row, 10, "30 - 130")
-                                win.addstr(row, 20, msg.hex())
-                            elif key == 0x30:
-                                row = 3
-                                win.addstr(row, 1, "Range: ")
-                                clear_chars(win, row, 10, 10)
-                                clear_chars(win, row, 20, 10)
-                                win.addstr(row, 10, "30 - 80")
-                                win.addstr(row, 20, msg.hex())
-                            elif key == 0x04:
-                                row = 4
-                                win.addstr(row, 1, "MIN/MAX: ")
-                                clear_chars(win, row, 10, 10)
-                                win.addstr(row, 10, "MAX")
-                            elif key == 0x05:
-                                row = 4
-                                win.addstr(row, 1, "MIN/MAX: ")
-                                clear_chars(win, row, 10, 10)
-                                win.addstr(row, 10, "MIN")
-                            elif key == 0x0C:
-                                row = 6
-                                win.addstr(row, 1, "Unknown: ")
-                                clear_chars(win, row, 10, 10)
-                                win.addstr(row, 10, msg.hex())
-                            elif key == 0x1B:
-                                win.addstr(5, 1, "Unknown: ")
-                                clear_chars(win, 5, 10, 10)
-                                win.addstr(5, 10, msg.hex())
-                            elif key == 0x06:
-                                win.addstr(7, 1, "Unknown: ")
-                                clear_chars(win, 7, 10, 10)
-                                win.addstr(7, 10, msg.hex())
-                            elif key == 0x0E:
-                                win.addstr(11, 1, "Unknown: ")
-                                clear_chars(win, 11, 10, 10)
-                                win.addstr(11, 10, msg.hex())
-                            elif key == 0x08:
-                                win.addstr(13, 1, "Unknown: ")
-                                win.move(13, 10)
-                                win.clrtoeol()
-                                win.addstr(13, 10, msg.hex())
-                            elif key == 0x0B:
-                                win.addstr(15, 1, "Unknown: ")
-                                clear_chars(win, 15, 10, 10)
-                                win.addstr(15, 10, msg.hex())
-                            elif key == 0x19:
-                                win.addstr(17, 1, "Unknown: ")
-                                clear_chars(win, 17, 10, 10)
-                                win.addstr(17, 10, msg.hex())
-                            elif key == 0x1F:
-                                win.addstr(21, 1, "Unknown: ")
-                                clear_chars(win, 21, 10, 10)
-                                win.addstr(21, 10, msg.hex())
-                            elif key == 0x11:
-                                win.addstr(22, 20, "Unknown: ")
-                                clear_chars(win, 22, 30, 10)
-                                win.addstr(22, 30, msg.hex())
-                            elif key == 0x0A:
-                                win.addstr(23, 1, "Record: ")
-                                clear_chars(win, 23, 9, 21)
-                                win.addstr(23, 9, "ON")
-                                win.addstr(23, 20, msg.hex())
-                            elif key == 0x1A:
-                                win.addstr(23, 1, "Record: ")
-                                clear_chars(win, 23, 9, 21)
-                                win.addstr(23, 9, "OFF")
-                                win.addstr(23, 20, msg.hex())
-                            else:
-                                # Handle unknown byte
-                                win.move(24, 10)
-                                win.clrtoeol()
-                                win.addstr(
-                                    24,
-                                    10,
-                                    f"Unknown message: {msg.hex()}",
-                                )
-                    else:
-                        win.addstr(24, 10, "Message buffer is empty.")
-                    # Update the screen
-                    win.refresh()
-                    message_buffer = (
-                        bytearray()
-                    )  # Reset the message buffer for the next message
+            data = ser.read(ser.in_waiting or 1)
+            for msg in decoder.split(data):
+                frame = decode_frame(msg)
+                state.update(frame)
+                handler = HANDLERS.get(type(frame))
+                if handler is not None:
+                    handler(win, frame, msg, state)
+                elif msg[0] in unknown_rows:
+                    row = unknown_rows[msg[0]]
+                    win.addstr(row, 1, "Unknown: ")
+                    win.move(row, 10)
+                    win.clrtoeol()
+                    win.addstr(row, 10, msg.hex())
+                elif msg[0] == 0x11:
+                    win.addstr(22, 20, "Unknown: ")
+                    clear_chars(win, 22, 30, 10)
+                    win.addstr(22, 30, msg.hex())
                 else:
-                    # Accumulate the byte in the buffer
-                    message_buffer += byte
+                    # Handle unknown byte
+                    win.move(24, 10)
+                    win.clrtoeol()
+                    win.addstr(
+                        24,
+                        10,
+                        f"Unknown message: {msg.hex()}",
+                    )
+            # Update the screen
+            win.refresh()
     except KeyboardInterrupt:
         print("Stream reading interrupted by user.")
     finally:
@@ -1,33 +1,36 @@
+import os
+import sys
+
 import serial
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from capture import CaptureWriter
+from qm1592 import FrameDecoder
+
 
-def read_stream_from_usb_serial_with_delimiter():
+# Print every frame from the meter as hex.  If a file name is given the
+# serial bytes and their arrival times are also saved to it, for replaying
+# with slm-log.py --replay or benchmarking
+def read_stream_from_usb_serial_with_delimiter(capture_file=None):
     ser = serial.Serial("/dev/ttyUSB0", 9600, timeout=1)
+    decoder = FrameDecoder()
+    capture = CaptureWriter(capture_file) if capture_file else None
     try:
-        message_buffer = bytearray()
         while True:
-            byte = ser.read(1)
-            if byte:
-                # Check if the byte is the delimiter (165 -> '¥')
-                if byte == b"\xa5":  # '\xa5' is the hex representation of 165
-                    # Process the message
-                    if message_buffer:
-                        for b in message_buffer:
-                            print(f"{b:02x}", end=" ")
-                        print()  # Print a newline after the entire message
-                    else:
-                        print("Message buffer is empty.")
-
-                    # Reset the buffer for the next message
-                    message_buffer = bytearray()
-                else:
-                    # Accumulate the byte in the buffer
-                    message_buffer += byte
+            data = ser.read(ser.in_waiting or 1)
+            if not data:
+                continue
+            if capture:
+                capture.write(data)
+            for message in decoder.split(data):
+                print(message.hex(" "))
     except KeyboardInterrupt:
         print("Stream reading interrupted by user.")
     finally:
         ser.close()
+        if capture:
+            capture.close()
 
 
 if __name__ == "__main__":
-    read_stream_from_usb_serial_with_delimiter()
+    read_stream_from_usb_serial_with_delimiter(sys.argv[1] if len(sys.argv) > 1 else None)
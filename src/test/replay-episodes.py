@@ -0,0 +1,94 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from episodes import EpisodeTracker
+from rolling_stats import RollingStatistics
+
+# 250 ms samples, as logged by slm-log.py
+SAMPLE_NS = 250_000_000
+
+# Synthetic dB sequences shaped like a car pass, a level hovering at the
+# limit and a short blip
+CAR_PASS = [
+    72.1, 73.4, 76.0, 79.8, 84.2, 88.9, 92.4, 95.1, 96.3, 94.0,
+    90.2, 86.7, 83.1, 80.5, 77.2, 74.9, 73.0, 72.4,
+]
+HOVERING = [
+    78.0, 80.2, 84.9, 86.1, 85.4, 84.6, 86.3, 85.2, 84.4, 85.9,
+    86.6, 84.8, 83.9, 85.1, 81.0, 79.5, 78.2, 77.9,
+]
+BLIP = [74.0, 75.2, 93.5, 94.1, 91.0, 88.8, 76.3, 75.0, 74.6, 74.1]
+QUIET = [71.0] * 12
+
+
+# Feed levels through the same median window and tracker as slm-log.py
+def replay(levels, tracker, window=4):
+    statistics = RollingStatistics(size=window)
+    events = []
+    for index, dB in enumerate(levels):
+        timestamp_ns = index * SAMPLE_NS
+        statistics.add(timestamp_ns, dB)
+        if not statistics.full:
+            continue
+        event = tracker.update(timestamp_ns, statistics.median, dB, statistics)
+        if event:
+            events.append(event)
+    event = tracker.flush()
+    if event:
+        events.append(event)
+    return events
+
+
+def check(name, events, starts, ends):
+    kinds = [kind for kind, _ in events]
+    assert kinds.count("start") == starts, f"{name}: {kinds}"
+    assert kinds.count("end") == ends, f"{name}: {kinds}"
+    for kind, episode in events:
+        if kind == "end":
+            print(
+                f"{name:>12}: {episode.samples} samples, peak {episode.peak_db} dB "
+                f"at {episode.peak_ns / 1e9:.2f} s, Leq {episode.leq} dB, "
+                f"{(episode.end_ns - episode.start_ns) / 1e9:.2f} s"
+            )
+    if not ends:
+        print(f"{name:>12}: no episode")
+
+
+def main():
+    # One car pass is one episode, peak taken from the raw samples
+    events = replay(CAR_PASS, EpisodeTracker(85, 82))
+    check("car pass", events, 1, 1)
+    assert events[-1][1].peak_db == 96.3
+
+    # Hovering either side of the limit stays one episode with hysteresis...
+    events = replay(HOVERING, EpisodeTracker(85, 82))
+    check("hysteresis", events, 1, 1)
+    assert events[-1][1].peak_db == max(HOVERING), events
+    # ...and without it turns into several
+    events = replay(HOVERING, EpisodeTracker(85, 85))
+    assert len([e for e in events if e[0] == "start"]) > 1, events
+    print(f"{'no hysteresis':>12}: {len(events) // 2} episodes")
+
+    # A short blip is ignored when a minimum duration is set.  The median
+    # only crosses the limit after the loudest samples, which still count
+    # towards the peak and Leq.
+    events = replay(BLIP, EpisodeTracker(85, 82))
+    check("blip", events, 1, 1)
+    assert events[-1][1].peak_db == max(BLIP), events
+    assert events[-1][1].start_ns == BLIP.index(93.5) * SAMPLE_NS, events
+    check("blip 2 s min", replay(BLIP, EpisodeTracker(85, 82, min_duration=2)), 0, 0)
+
+    # Two passes are two episodes, but only one alert inside the interval
+    tracker = EpisodeTracker(85, 82, alert_interval=60)
+    events = replay(CAR_PASS + QUIET + CAR_PASS, tracker)
+    check("two passes", events, 2, 2)
+    alerts = [tracker.should_alert(e.start_ns) for kind, e in events if kind == "start"]
+    assert alerts == [True, False], alerts
+    print(f"{'rate limit':>12}: alerts {alerts}")
+
+    print("all checks passed")
+
+
+if __name__ == "__main__":
+    main()
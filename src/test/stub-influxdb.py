@@ -0,0 +1,100 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Stand-in for InfluxDB 2: accepts writes and health checks, counts the
+# points written, and can be slowed down or made to fail for testing
+class StubInfluxDB(BaseHTTPRequestHandler):
+    delay = 0.0
+    fail_rate = 0.0
+    lock = threading.Lock()
+    points = 0
+    writes = 0
+    failures = 0
+    measurements = {}
+
+    def do_GET(self):
+        if self.path.startswith("/health"):
+            self._reply(
+                200,
+                {
+                    "name": "influxdb",
+                    "message": "ready for queries and writes",
+                    "status": "pass",
+                    "checks": [],
+                    "version": "stub",
+                    "commit": "stub",
+                },
+            )
+        elif self.path.startswith("/ping"):
+            self._reply(204)
+        else:
+            self._reply(404, {"code": "not found", "message": self.path})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.startswith("/api/v2/write"):
+            self._reply(404, {"code": "not found", "message": self.path})
+            return
+        if self.delay:
+            time.sleep(self.delay)
+        if random.random() < self.fail_rate:
+            with self.lock:
+                StubInfluxDB.failures += 1
+            self._reply(503, {"code": "unavailable", "message": "stub failure"})
+            return
+        lines = [line for line in body.decode().split("\n") if line]
+        with self.lock:
+            StubInfluxDB.writes += 1
+            StubInfluxDB.points += len(lines)
+            for line in lines:
+                measurement = line.split(",", 1)[0].split(" ", 1)[0]
+                self.measurements[measurement] = self.measurements.get(measurement, 0) + 1
+        self._reply(204)
+
+    def _reply(self, status, body=None):
+        self.send_response(status)
+        if body is None:
+            self.end_headers()
+            return
+        data = json.dumps(body).encode()
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub InfluxDB server for testing")
+    parser.add_argument("--port", type=int, default=8086)
+    parser.add_argument("--delay", type=int, default=0, help="ms to wait per write")
+    parser.add_argument(
+        "--fail-rate", type=float, default=0.0, help="fraction of writes to fail"
+    )
+    args = parser.parse_args()
+
+    StubInfluxDB.delay = args.delay / 1000
+    StubInfluxDB.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), StubInfluxDB)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Stub InfluxDB listening on http://127.0.0.1:{args.port}")
+    try:
+        while True:
+            time.sleep(10)
+            print(
+                f"{StubInfluxDB.writes} writes, {StubInfluxDB.points} points, "
+                f"{StubInfluxDB.failures} failures: {StubInfluxDB.measurements}"
+            )
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
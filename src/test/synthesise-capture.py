@@ -0,0 +1,64 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from capture import HEADER, MAGIC, RECORD, VERSION
+
+# The meter sends several dB frames a second with status frames between
+FRAME_INTERVAL_NS = 200_000_000
+STATUS_FRAMES = [b"\x02", b"\x40", b"\x0c\x00\x00", b"\x1b\x00", b"\x06\x00"]
+
+
+def db_frame(dB):
+    tenths = round(dB * 10)
+    return b"\x0d" + bytes(
+        [
+            (tenths // 1000) << 4 | (tenths // 100) % 10,
+            ((tenths // 10) % 10) << 4 | tenths % 10,
+        ]
+    )
+
+
+# Background noise with a car passing every so often
+def level(seconds, passes):
+    dB = 68 + 3 * math.sin(seconds / 600) + random.uniform(-1.5, 1.5)
+    for centre, peak in passes:
+        distance = seconds - centre
+        if -8 < distance < 8:
+            dB = max(dB, peak - 2.5 * abs(distance))
+    return min(max(dB, 30.0), 130.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic QM1592 capture")
+    parser.add_argument("capture", help="capture file to write")
+    parser.add_argument("--hours", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    duration = args.hours * 3600
+    passes = []
+    t = 20.0
+    while t < duration:
+        passes.append((t, random.uniform(78, 98)))
+        t += random.uniform(30, 120)
+
+    frames = int(duration * 1e9 / FRAME_INTERVAL_NS)
+    with open(args.capture, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, time.time_ns() - int(duration * 1e9)))
+        for i in range(frames):
+            offset_ns = i * FRAME_INTERVAL_NS
+            data = b"\xa5" + db_frame(level(offset_ns / 1e9, passes))
+            data += b"\xa5" + STATUS_FRAMES[i % len(STATUS_FRAMES)]
+            f.write(RECORD.pack(offset_ns, len(data)))
+            f.write(data)
+    print(f"{frames} dB frames, {len(passes)} car passes, {args.hours:g} hours")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app"))
+from qm1592 import describe_flags
+from sample_ring import KIND_SETTINGS, SampleRingReader
+
+
+# Print every sample slm-log.py publishes to its shared memory ring, as an
+# example of a reader attaching to the live stream alongside the logger
+def main():
+    parser = argparse.ArgumentParser(description="Follow the slm-log.py sample ring")
+    parser.add_argument("--name", default="slm-samples", help="shared memory name")
+    parser.add_argument(
+        "--from-start", action="store_true", help="start from the oldest record"
+    )
+    parser.add_argument(
+        "--interval", type=float, default=0.1, help="seconds between reads"
+    )
+    args = parser.parse_args()
+
+    reader = SampleRingReader(args.name, from_start=args.from_start)
+    print(f"Attached to {args.name}: {reader.capacity} records, meters {reader.meters}")
+    try:
+        while True:
+            records, lost = reader.read()
+            if lost:
+                print(f"-- overrun, {lost} records lost")
+            for record in records.tolist():
+                sequence, timestamp_ns, deci_db, flags, kind, meter = record
+                location = (
+                    reader.meters[meter] if meter < len(reader.meters) else meter
+                )
+                when = datetime.fromtimestamp(timestamp_ns / 1e9).strftime(
+                    "%H:%M:%S.%f"
+                )[:-3]
+                settings = " ".join(filter(None, describe_flags(flags)))
+                if kind == KIND_SETTINGS:
+                    print(f"{sequence:>10} {when} {location}: settings {settings}")
+                else:
+                    print(
+                        f"{sequence:>10} {when} {location}: {deci_db / 10:.1f} dB "
+                        f"{settings}"
+                    )
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()